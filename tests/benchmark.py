@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Simulated bus throughput benchmark
+#
+# Drives back to back max packet size OUT/IN transaction pairs at the
+# loopback endpoint of the loopback binaries (bulk and iso) for a given
+# simulated duration. For each architecture, endpoint type and direction it
+# reports MB/s, data packets per 125us microframe, the NAK ratio and the
+# simulated time per byte.
+#
+# Results are written as JSON. --baseline compares them with an earlier
+# result file and fails if throughput dropped (or the NAK ratio rose) by
+# more than the tolerance; --update-baseline writes the results as the new
+# baseline.
+#
+# The control endpoint is not covered: the control binaries handle a single
+# transfer and exit, so there is no sustained control traffic to measure.
+
+import xmostest
+import argparse
+import json
+import math
+import random
+import sys
+
+from helpers import do_rx_test, get_usb_clk_phy, RecordingTester
+from ipg_search import LOOPBACK_EP, PROBE_BINARIES, append_loopback_kill
+from usb_capture import PacketCapture
+from usb_packet import *
+
+MICROFRAME = 125000 # ns
+
+MAX_PACKET_SIZE = {'bulk' : 512, 'iso' : 1024}
+
+# Gaps before the IN and OUT tokens, from the hand tuned loopback tests
+DEFAULT_GAPS = {'bulk' : (417, 500), 'iso' : (477, 500)}
+
+DEFAULT_DURATION = 1000 # us
+DEFAULT_TOLERANCE = 0.02
+
+NAK = 0x5a
+DATA_PIDS = (0x3, 0xb, 0x7, 0xf)
+
+def estimate_transactions(duration, clock_period, max_packet, in_gap, out_gap):
+    """ Number of OUT/IN pairs to fill duration ns, estimated from the bus
+        time of the packets and the gaps
+    """
+    # Tokens are 2 bytes presented over 5 clocks each, handshakes 1 byte
+    clocks = 2 * (max_packet + 3) + 2 * 10 + 2 * 1
+    pair_time = clocks * clock_period + in_gap + out_gap
+    return max(1, int(math.ceil(duration / pair_time)))
+
+def benchmark_packets(ep_type, transactions, in_gap, out_gap, seed=1):
+    """ Returns the packets and the number of them that are traffic (the
+        rest make the binary exit)
+    """
+    rand = random.Random()
+    rand.seed(seed)
+    bulk = (ep_type == 'bulk')
+    length = MAX_PACKET_SIZE[ep_type]
+
+    packets = PacketTrace()
+    data_pid = 0x3 #DATA0
+    dataval = 0
+
+    for i in range(transactions):
+        AppendOutToken(packets, LOOPBACK_EP, inter_pkt_gap=out_gap)
+        packets.append(TxDataPacket(rand, data_start_val=dataval, length=length, pid=data_pid))
+        if bulk:
+            packets.append(RxHandshakePacket(timeout=9))
+
+        AppendInToken(packets, LOOPBACK_EP, inter_pkt_gap=in_gap)
+        packets.append(RxDataPacket(rand, data_start_val=dataval, length=length, pid=data_pid, timeout=9))
+        if bulk:
+            packets.append(TxHandshakePacket())
+            data_pid = data_pid ^ 8
+
+        dataval += length
+
+    traffic = len(packets)
+    kill = []
+    append_loopback_kill(kill, rand)
+    packets.extend(kill)
+    return (packets, traffic)
+
+def _direction_result(data_bytes, data_packets, responses, naks, elapsed):
+    return {'bytes' : data_bytes,
+            'packets' : data_packets,
+            'mb_per_s' : data_bytes * 1000.0 / elapsed if elapsed else 0.0,
+            'packets_per_microframe' : data_packets * float(MICROFRAME) / elapsed if elapsed else 0.0,
+            'nak_ratio' : float(naks) / responses if responses else 0.0,
+            'ns_per_byte' : float(elapsed) / data_bytes if data_bytes else None}
+
+def measure(packets, traffic, phy):
+    """ Works out the figures for each direction from the packets sent and
+        what the PHY captured
+    """
+    elapsed = phy.packet_end_times[traffic - 1] - phy.packet_start_times[0]
+
+    # OUT: data sent by the host, NAKs in the handshakes
+    out_bytes = 0
+    out_packets = 0
+    expected_handshakes = 0
+    for i in range(traffic):
+        if packets.kind[i] == KIND_TX_DATA:
+            out_packets += 1
+            out_bytes += packets.payload_length[i]
+        elif packets.kind[i] == KIND_RX_HANDSHAKE:
+            expected_handshakes += 1
+
+    # IN: data received from the DUT, NAKs in place of it
+    in_bytes = 0
+    in_packets = 0
+    in_responses = 0
+    in_naks = 0
+    out_naks = 0
+    for record in phy.capture.records():
+        if record.index >= traffic or not record.data:
+            continue
+        pid = record.data[0]
+        if packets.kind[record.index] == KIND_RX_DATA:
+            in_responses += 1
+            if pid == NAK:
+                in_naks += 1
+            elif pid & 0xf in DATA_PIDS:
+                in_packets += 1
+                in_bytes += max(0, len(record.data) - 3)
+        elif pid == NAK:
+            # The OUT data packet before the handshake wasn't taken
+            out_naks += 1
+            out_packets -= 1
+            out_bytes -= packets.payload_length[record.index - 1]
+
+    return {'elapsed_ns' : elapsed,
+            'out' : _direction_result(out_bytes, out_packets, expected_handshakes, out_naks, elapsed),
+            'in' : _direction_result(in_bytes, in_packets, in_responses, in_naks, elapsed)}
+
+def run_benchmark(arch, ep_type, duration, gaps=None, transactions=None):
+    (in_gap, out_gap) = gaps or DEFAULT_GAPS[ep_type]
+    (clk, phy) = get_usb_clk_phy(verbose=False, arch=arch)
+    if transactions is None:
+        transactions = estimate_transactions(duration * 1000.0, clk.get_period(),
+                                             MAX_PACKET_SIZE[ep_type], in_gap, out_gap)
+
+    (packets, traffic) = benchmark_packets(ep_type, transactions, in_gap, out_gap)
+
+    # Hold every received packet so none are dropped from the ring
+    phy.capture = PacketCapture(buffer_size=packets.total_wire_bytes() + 1024,
+                                max_records=len(packets))
+
+    name = 'benchmark_{}_{}'.format(ep_type, arch)
+    tester = do_rx_test(arch, clk, phy, packets, PROBE_BINARIES[ep_type], 1,
+                        level='smoke', output_name=name, tester_class=RecordingTester)
+    # run_on_simulator() may only queue the simulation
+    xmostest.complete_all_jobs()
+
+    result = measure(packets, traffic, phy)
+    result['transactions'] = transactions
+    result['in_gap'] = in_gap
+    result['out_gap'] = out_gap
+    result['output_matched'] = bool(tester.result)
+    return result
+
+def compare_with_baseline(results, baseline, tolerance):
+    """ Returns a list of the figures that are worse than the baseline by
+        more than tolerance
+    """
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if result['mb_per_s'] < old['mb_per_s'] * (1 - tolerance):
+            regressions.append("{}: throughput dropped from {:.3f} to {:.3f} MB/s".format(
+                name, old['mb_per_s'], result['mb_per_s']))
+        if result['nak_ratio'] > old['nak_ratio'] + tolerance:
+            regressions.append("{}: NAK ratio rose from {:.3f} to {:.3f}".format(
+                name, old['nak_ratio'], result['nak_ratio']))
+    return regressions
+
+def print_results(results):
+    print "{:<18} {:>9} {:>8} {:>7} {:>9} {:>9}".format(
+        'benchmark', 'MB/s', 'pkt/uf', 'NAK', 'ns/byte', 'packets')
+    for (name, result) in sorted(results.items()):
+        print "{:<18} {:>9.3f} {:>8.3f} {:>7.3f} {:>9} {:>9}".format(
+            name, result['mb_per_s'], result['packets_per_microframe'], result['nak_ratio'],
+            '-' if result['ns_per_byte'] is None else '{:.3f}'.format(result['ns_per_byte']),
+            result['packets'])
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="XMOS lib_xud simulated throughput benchmark")
+    argparser.add_argument('--arch', choices=['xs1', 'xs2'], type=str, action='append', help='Architectures to run (default both)')
+    argparser.add_argument('--ep-type', choices=sorted(MAX_PACKET_SIZE), type=str, action='append', help='Endpoint types to run (default all)')
+    argparser.add_argument('--duration', type=int, default=DEFAULT_DURATION, help='Simulated duration of the traffic in us')
+    argparser.add_argument('--transactions', type=int, help='Number of OUT/IN pairs (overrides --duration)')
+    argparser.add_argument('--in-gap', type=int, help='Gap before each IN token')
+    argparser.add_argument('--out-gap', type=int, help='Gap before each OUT token')
+    argparser.add_argument('--output', type=str, default='benchmark.json', help='File to write the results to')
+    argparser.add_argument('--baseline', type=str, help='Baseline results to compare against')
+    argparser.add_argument('--update-baseline', action='store_true', help='Write the results to the baseline file')
+    argparser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Allowed relative throughput drop against the baseline')
+
+    args = xmostest.init(argparser)
+
+    results = {}
+    runs = {}
+    for arch in args.arch or ['xs1', 'xs2']:
+        for ep_type in args.ep_type or sorted(MAX_PACKET_SIZE):
+            (in_gap, out_gap) = DEFAULT_GAPS[ep_type]
+            gaps = (args.in_gap or in_gap, args.out_gap or out_gap)
+            run = run_benchmark(arch, ep_type, args.duration, gaps, args.transactions)
+            runs['{}/{}'.format(arch, ep_type)] = run
+            for direction in ('out', 'in'):
+                results['{}/{}/{}'.format(arch, ep_type, direction)] = run[direction]
+            if not run['output_matched']:
+                print "WARNING: {} {}: DUT responses did not all match".format(arch, ep_type)
+
+    with open(args.output, 'w') as f:
+        json.dump({'results' : results, 'runs' : runs}, f, indent=2, sort_keys=True)
+
+    print_results(results)
+
+    status = 0
+    if args.baseline:
+        if args.update_baseline:
+            with open(args.baseline, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        else:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = compare_with_baseline(results, baseline, args.tolerance)
+            for line in regressions:
+                print "ERROR: " + line
+            if regressions:
+                status = 1
+
+    xmostest.finish()
+    sys.exit(status)
@@ -0,0 +1,206 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Randomised seed-sweep campaigns
+#
+# Generates a long mixed stream of transactions from a seed and runs it
+# against the bulk loopback binary, for many seeds. The responses of the DUT
+# come from the device model (usb_device.py) of the loopback endpoint:
+#
+#   endpoint empty   OUT + DATA            ACK, the data is held for the IN
+#                    PING                  ACK
+#                    IN                    NAK, nothing to send yet
+#   endpoint full    IN                    the held data, host ACKs
+#                    OUT + DATA            NAK, the data is not taken
+#                    PING                  NAK
+#
+# Payload lengths are random within --data-len-min/--data-len-max and the
+# DATA0/DATA1 PIDs toggle on every ACKed OUT and every completed IN, as a
+# host and the DUT would. Each stream has about --num-packets packets.
+#
+#   ./runtests.py --campaign --seeds 50 --num-packets 400
+#
+# runs the campaign with the options of runtests.py: --seed/--seeds choose
+# the seeds (DEFAULT_SEEDS random ones by default), --arch the architecture
+# and --jobs how many seeds run in parallel.
+#
+# The packets of each seed are kept in a stimulus file. The failing seeds
+# and the parameters they ran with are written to a JSON file, and
+# --replay runs exactly those again.
+
+import xmostest
+import json
+import multiprocessing
+import random
+import sys
+
+import runner
+from helpers import do_rx_test, get_stimulus, get_usb_clk_phy, create_if_needed, RecordingTester
+from ipg_search import LOOPBACK_EP, append_loopback_kill
+from usb_device import DeviceModel, Endpoint, loopback
+from usb_packet import *
+
+CAMPAIGN_BINARY = 'test_bulk_loopback.py'
+CAMPAIGN_NAME = 'campaign_bulk'
+
+BULK_MAX_PACKET_SIZE = 512
+
+ACK = 0xd2
+
+# Gap ranges before each token. An IN that collects looped back data needs
+# at least the hand tuned loopback gap.
+TOKEN_GAP = (500, 2000)
+LOOPBACK_IN_GAP = (417, 2000)
+
+# Relative weights of the transactions in each state of the endpoint
+EMPTY_WEIGHTS = (('out', 6), ('ping', 2), ('in_nak', 1))
+FULL_WEIGHTS = (('in', 6), ('ping_nak', 2), ('out_nak', 1))
+
+DEFAULT_SEEDS = 20
+
+def _choose(rand, weights):
+    value = rand.uniform(0, sum(weight for (name, weight) in weights))
+    for (name, weight) in weights:
+        value -= weight
+        if value <= 0:
+            return name
+    return weights[-1][0]
+
+def campaign_packets(seed, num_packets=100, data_len_min=46, data_len_max=500, ep=LOOPBACK_EP):
+    """ Returns a transaction stream of about num_packets packets for seed,
+        followed by the transaction that makes the loopback binary exit
+    """
+    if not 0 <= data_len_min <= data_len_max:
+        raise ValueError("Data lengths must satisfy 0 <= min <= max")
+    data_len_max = min(data_len_max, BULK_MAX_PACKET_SIZE)
+    data_len_min = min(data_len_min, data_len_max)
+
+    rand = random.Random()
+    rand.seed(seed)
+
+    (on_out, on_in) = loopback([ep])
+    model = DeviceModel([Endpoint(ep)], on_out=on_out, on_in=on_in, data_timeout=9)
+    packets = PacketTrace()
+    out_pid = 0x3 #DATA0
+
+    def send(*host_packets):
+        """ Appends the host packets and the responses of the DUT, returns
+            the last response
+        """
+        responses = []
+        for packet in host_packets:
+            packets.append(packet)
+            responses = model.host_packet(packet)
+            packets.extend(responses)
+        return responses[-1] if responses else None
+
+    def send_token(append_token, gap):
+        tokens = []
+        append_token(tokens, ep, inter_pkt_gap=gap)
+        return send(*tokens)
+
+    while len(packets) < num_packets:
+        gap = rand.randint(*TOKEN_GAP)
+
+        if not model.in_eps[ep].queue:
+            transaction = _choose(rand, EMPTY_WEIGHTS)
+        else:
+            transaction = _choose(rand, FULL_WEIGHTS)
+            if transaction == 'in':
+                gap = rand.randint(*LOOPBACK_IN_GAP)
+
+        if transaction in ('out', 'out_nak'):
+            send_token(AppendOutToken, gap)
+            length = rand.randint(data_len_min, data_len_max)
+            response = send(TxDataPacket(rand, length=length, pid=out_pid, data_random=True))
+            if response.pid == ACK:
+                out_pid ^= 8
+        elif transaction in ('ping', 'ping_nak'):
+            send_token(AppendPingToken, gap)
+        elif transaction == 'in':
+            send_token(AppendInToken, gap)
+            send(TxHandshakePacket())
+        else:
+            send_token(AppendInToken, gap)
+
+    if model.in_eps[ep].queue:
+        # Collect the data still held so the endpoint is idle at the end
+        send_token(AppendInToken, LOOPBACK_IN_GAP[1])
+        send(TxHandshakePacket())
+
+    append_loopback_kill(packets, rand)
+    return packets
+
+def run_seed(run):
+    """ Runs the campaign for one seed, returns (run, passed). The output
+        of a failing run is kept in campaign/.
+    """
+    params = run['params']
+    (clk, phy) = get_usb_clk_phy(verbose=False, arch=run['arch'])
+    packets = get_stimulus(CAMPAIGN_NAME, run['seed'],
+                           lambda: campaign_packets(run['seed'], **params), **params)
+    name = '{}_{}'.format(CAMPAIGN_NAME, run['seed'])
+    tester = do_rx_test(run['arch'], clk, phy, packets, CAMPAIGN_BINARY, run['seed'],
+                        level='smoke', output_name=name, tester_class=RecordingTester)
+    # run_on_simulator() may only queue the simulation
+    xmostest.complete_all_jobs()
+
+    passed = bool(tester.result)
+    if not passed and tester.output is not None:
+        log_folder = create_if_needed("campaign")
+        output = tester.output
+        if not isinstance(output, str):
+            output = '\n'.join(line.rstrip('\n') for line in output) + '\n'
+        with open('{}/{}_{}.log'.format(log_folder, name, run['arch']), 'w') as f:
+            f.write(output)
+    return (run, passed)
+
+def run_campaign(runs, jobs):
+    """ Runs the seeds, returns the list of runs that failed """
+    failures = []
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        results = pool.imap_unordered(run_seed, runs) if pool else (run_seed(run) for run in runs)
+        for (i, (run, passed)) in enumerate(results):
+            print "[{}/{}] {} seed {} ({}): {}".format(
+                i + 1, len(runs), CAMPAIGN_NAME, run['seed'], run['arch'], 'PASS' if passed else 'FAIL')
+            sys.stdout.flush()
+            if not passed:
+                failures.append(run)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return sorted(failures, key=lambda run: (run['arch'], run['seed']))
+
+def add_arguments(argparser):
+    argparser.add_argument('--campaign', action='store_true', help='Run the randomised seed-sweep campaign against the bulk loopback instead of the tests')
+    argparser.add_argument('--campaign-failures', type=str, default='campaign_failures.json', help='File to write the failing seeds of the campaign to')
+    argparser.add_argument('--replay', type=str, help='Run the failing campaign seeds recorded in this file, with the parameters they failed with')
+
+def run(args):
+    """ Runs the campaign selected by args, returns True if all seeds
+        passed
+    """
+    if args.replay:
+        with open(args.replay) as f:
+            runs = json.load(f)['failures']
+    else:
+        params = {'num_packets' : args.num_packets,
+                  'data_len_min' : args.data_len_min,
+                  'data_len_max' : args.data_len_max}
+        seeds = runner.choose_seeds(args, DEFAULT_SEEDS)
+        runs = [{'arch' : arch, 'seed' : seed, 'params' : params}
+                for arch in ([args.arch] if args.arch else runner.ARCHS) for seed in seeds]
+
+    failures = run_campaign(runs, args.jobs)
+
+    with open(args.campaign_failures, 'w') as f:
+        json.dump({'runs' : len(runs), 'failures' : failures}, f, indent=2, sort_keys=True)
+
+    print "{} of {} runs failed".format(len(failures), len(runs))
+    for run in failures:
+        print "  {} seed {}".format(run['arch'], run['seed'])
+    if failures:
+        print "Replay them with --replay {}".format(args.campaign_failures)
+    return not failures
@@ -0,0 +1,163 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Streaming expect files
+#
+# Expect files are written line by line (optionally gzip compressed) while a
+# rolling digest of the lines is kept. The digest and line count are stored
+# next to the expect file in a .digest file, so checking the simulator output
+# on a passing run only needs the output's digest and length. The expect file
+# itself is only read back, from the start up to a little past the first
+# divergence, when the digests differ.
+
+import difflib
+import gzip
+import hashlib
+import itertools
+import json
+import os
+
+try:
+    from itertools import izip_longest as zip_longest
+except ImportError:
+    from itertools import zip_longest
+
+DIGEST_EXTENSION = '.digest'
+COMPRESSED_EXTENSION = '.gz'
+
+# Number of lines of context shown either side of the first difference
+DIFF_CONTEXT = 5
+
+def normalise_line(line):
+    """ Lines are compared without their trailing whitespace/line ending """
+    if isinstance(line, bytes) and not isinstance(line, str):
+        line = line.decode('utf-8', 'replace')
+    return line.rstrip()
+
+class RollingDigest(object):
+    """ Digest and count of a sequence of lines """
+
+    def __init__(self):
+        self._hash = hashlib.sha1()
+        self.lines = 0
+
+    def update(self, line):
+        self._hash.update((normalise_line(line) + '\n').encode('utf-8'))
+        self.lines += 1
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def as_dict(self):
+        return {'sha1' : self.hexdigest(), 'lines' : self.lines}
+
+def _open(filename, mode):
+    if filename.endswith(COMPRESSED_EXTENSION):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+def expect_filename(filename, compress=False):
+    if compress and not filename.endswith(COMPRESSED_EXTENSION):
+        return filename + COMPRESSED_EXTENSION
+    return filename
+
+class ExpectWriter(object):
+    """ Writes an expect file one line at a time. Writes are batched and the
+        digest file is written on close().
+    """
+
+    BATCH_LINES = 4096
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.digest = RollingDigest()
+        self._file = _open(filename, 'wb')
+        self._pending = []
+
+    def write_line(self, line):
+        self.digest.update(line)
+        self._pending.append(line)
+        if len(self._pending) >= self.BATCH_LINES:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._file.write(('\n'.join(self._pending) + '\n').encode('utf-8'))
+            self._pending = []
+
+    def close(self):
+        self._flush()
+        self._file.close()
+        with open(self.filename + DIGEST_EXTENSION, 'w') as f:
+            json.dump(self.digest.as_dict(), f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def iter_expect_lines(filename):
+    with _open(filename, 'rb') as f:
+        for line in f:
+            yield normalise_line(line)
+
+def read_expect_digest(filename):
+    """ Returns the digest of an expect file, from its .digest file if there
+        is one, otherwise by reading the expect file
+    """
+    digest_filename = filename + DIGEST_EXTENSION
+    if os.path.exists(digest_filename) and \
+            os.path.getmtime(digest_filename) >= os.path.getmtime(filename):
+        with open(digest_filename) as f:
+            return json.load(f)
+
+    digest = RollingDigest()
+    for line in iter_expect_lines(filename):
+        digest.update(line)
+    return digest.as_dict()
+
+def first_difference(expected_lines, actual_lines):
+    """ Returns the index of the first differing line (or the length of the
+        shorter sequence if one is a prefix of the other), or None if equal
+    """
+    for (i, (expected, actual)) in enumerate(zip_longest(expected_lines, actual_lines)):
+        if expected is None or actual is None or expected != normalise_line(actual):
+            return i
+    return None
+
+def diff_report(filename, output, index, context=DIFF_CONTEXT):
+    """ Unified diff of the expect file against the output around line index """
+    start = max(0, index - context)
+    stop = index + context + 1
+    expected = list(itertools.islice(iter_expect_lines(filename), start, stop))
+    actual = [normalise_line(line) for line in itertools.islice(output, start, stop)]
+    return list(difflib.unified_diff(expected, actual,
+                                     fromfile=filename, tofile='output',
+                                     lineterm='', n=context))
+
+def compare_with_expect(filename, output):
+    """ Checks simulator output (a sequence of lines) against an expect file.
+
+        Returns (result, report). On the pass path only the digest and line
+        count of the output are computed. Otherwise the report describes the
+        first difference with some lines of context.
+    """
+    expected = read_expect_digest(filename)
+
+    digest = RollingDigest()
+    for line in output:
+        digest.update(line)
+
+    if digest.lines == expected['lines'] and digest.hexdigest() == expected['sha1']:
+        return (True, [])
+
+    index = first_difference(iter_expect_lines(filename), output)
+    if index is None:
+        # Digest file is stale, the content matches
+        return (True, [])
+
+    report = ["Output differs from {} at line {} (expected {} lines, got {})".format(
+        filename, index + 1, expected['lines'], digest.lines)]
+    report += diff_report(filename, output, index)
+    return (False, report)
@@ -0,0 +1,160 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Profiling of the Python side of a simulation
+#
+# HarnessProfiler.attach() wraps the wait(), wait_until() and run() of a
+# SimThread (Clock, UsbPhy, UsbMonitor ...) on that instance only, so
+# nothing is slowed down unless a test asks for it (runtests.py --profile).
+# For each thread it counts
+#
+#   wakeups     returns from wait() ('wait') and wait_until() ('wait_until')
+#   time        wall time the thread ran between waking up and waiting
+#               again, by how it was woken
+#   conditions  evaluations of the wait() lambdas by the simulator, and the
+#               wall time they took
+#
+# Everything the threads didn't use of the wall time of the run was spent in
+# xsim. The summary gives the simulated time per wall second and the
+# wakeups and condition evaluations per simulated us.
+
+import json
+from timeit import default_timer
+
+WAIT_KINDS = ('start', 'wait', 'wait_until')
+
+class ThreadProfile(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.wakeups = dict((kind, 0) for kind in WAIT_KINDS)
+        self.time = dict((kind, 0.0) for kind in WAIT_KINDS)
+        self.conditions = 0
+        self.condition_time = 0.0
+        self.sim_time = None
+        self._kind = 'start'
+        self._resumed = None
+
+    def suspend(self):
+        """ The thread is about to wait """
+        if self._resumed is not None:
+            self.time[self._kind] += default_timer() - self._resumed
+            self._resumed = None
+
+    def resume(self, kind, sim_time):
+        """ The thread was woken up by kind at sim_time (ns) """
+        self.wakeups[kind] += 1
+        self.sim_time = sim_time
+        self._kind = kind
+        self._resumed = default_timer()
+
+    def python_time(self):
+        return sum(self.time.values()) + self.condition_time
+
+    def as_dict(self, sim_us):
+        per_us = lambda count: count / sim_us if sim_us else None
+        wakeups = sum(self.wakeups.values())
+        return {'wakeups' : self.wakeups,
+                'time' : self.time,
+                'conditions' : self.conditions,
+                'condition_time' : self.condition_time,
+                'python_time' : self.python_time(),
+                'wakeups_per_us' : per_us(wakeups),
+                'conditions_per_us' : per_us(self.conditions)}
+
+
+class HarnessProfiler(object):
+
+    def __init__(self):
+        self.threads = []
+        self.wall_time = None
+        self.sim_time = None
+        self._start = None
+        self._attached = []
+
+    def attach(self, thread, name=None):
+        """ Profiles thread from now on """
+        name = name or type(thread).__name__
+        if any(profile.name == name for profile in self.threads):
+            name = '{}_{}'.format(name, len(self.threads))
+        profile = ThreadProfile(name)
+        self.threads.append(profile)
+        self._attached.append(thread)
+        (run, wait, wait_until) = (thread.run, thread.wait, thread.wait_until)
+
+        def profiled_run():
+            if self._start is None:
+                # The simulation starts now, which may be long after the
+                # run was queued
+                self.start()
+            profile.resume('start', thread.xsi.get_time())
+            try:
+                run()
+            finally:
+                profile.suspend()
+
+        def profiled_wait(f):
+            def condition(x):
+                profile.conditions += 1
+                start = default_timer()
+                try:
+                    return f(x)
+                finally:
+                    profile.condition_time += default_timer() - start
+
+            profile.suspend()
+            wait(condition)
+            profile.resume('wait', thread.xsi.get_time())
+
+        def profiled_wait_until(t):
+            profile.suspend()
+            wait_until(t)
+            profile.resume('wait_until', thread.xsi.get_time())
+
+        thread.run = profiled_run
+        thread.wait = profiled_wait
+        thread.wait_until = profiled_wait_until
+        return profile
+
+    def start(self):
+        self._start = default_timer()
+
+    def stop(self):
+        """ Ends the run and puts the methods of the threads back. Call it
+            once the simulation has finished.
+        """
+        self.wall_time = default_timer() - self._start if self._start is not None else 0.0
+        times = [profile.sim_time for profile in self.threads if profile.sim_time is not None]
+        self.sim_time = max(times) if times else None
+        for thread in self._attached:
+            for name in ('run', 'wait', 'wait_until'):
+                thread.__dict__.pop(name, None)
+        self._attached = []
+
+    def summary(self, extra=None):
+        sim_us = self.sim_time / 1000.0 if self.sim_time else None
+        python_time = sum(thread.python_time() for thread in self.threads)
+        summary = {'wall_time' : self.wall_time,
+                   'sim_time' : self.sim_time,
+                   'python_time' : python_time,
+                   'xsim_time' : self.wall_time - python_time,
+                   'sim_us_per_wall_s' : sim_us / self.wall_time if sim_us and self.wall_time else None,
+                   'threads' : dict((thread.name, thread.as_dict(sim_us)) for thread in self.threads)}
+        if extra:
+            summary.update(extra)
+        return summary
+
+    def write_summary(self, filename, extra=None):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(extra), f, indent=2, sort_keys=True)
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = ["Profile: {:.2f}s wall, {:.2f}s in Python threads, {:.2f}s in xsim, {}".format(
+            summary['wall_time'], summary['python_time'], summary['xsim_time'],
+            "{:.1f} simulated us per second".format(summary['sim_us_per_wall_s'])
+            if summary['sim_us_per_wall_s'] else "no simulated time")]
+        for (name, thread) in sorted(summary['threads'].items()):
+            lines.append("  {}: {} wakeups, {} condition evaluations, {:.2f}s".format(
+                name, sum(thread['wakeups'].values()), thread['conditions'], thread['python_time']))
+        return lines
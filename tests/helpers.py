@@ -2,58 +2,133 @@
 # Copyright 2016-2021 XMOS LIMITED.
 # This Software is subject to the terms of the XMOS Public Licence: Version 1.
 import xmostest
+import inspect
 import os
 import random
 import sys
 from usb_clock import Clock
 from usb_phy import UsbPhy
-from usb_packet import RxPacket
+from usb_ports import USB_PORTS
+from usb_packet import iter_packets
+from usb_stimulus import load_stimulus, stimulus_hash, STIMULUS_EXTENSION
+from expect_stream import ExpectWriter, compare_with_expect, expect_filename
+from usb_txrdy import parse_txrdy_pattern
+from usb_latency import endpoint_type_from_testname
+from usb_monitor import UsbMonitor
+from sim_cache import SimCache, file_hash, make_key
+from sim_trace import TraceCapture, TraceWindow, parse_range
+from harness_profile import HarnessProfiler
 
 args = None
 
-def create_if_needed(folder):
+# Folder the output folders (expect/, logs/ etc.) are created in. The
+# parallel runner (runner.py) gives each job its own so that jobs running at
+# the same time don't write the same files.
+output_dir = None
+
+# Results of the tests run by this process, collected for the parallel
+# runner, which reports them to xmostest. None when not running under it, in
+# which case the testers report their results themselves.
+job_results = None
+
+_cache = None
+
+def create_if_needed(folder, shared=False):
+    """ Creates folder (inside output_dir unless shared) if it doesn't exist
+        and returns its path
+    """
+    if output_dir and not shared:
+        folder = os.path.join(output_dir, folder)
     if not os.path.exists(folder):
-        os.makedirs(folder)
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # Created by another job in the meantime
+            if not os.path.isdir(folder):
+                raise
     return folder
 
 def get_usb_clk_phy(verbose=True, test_ctrl=None, do_timeout=True,
                        complete_fn=None, expect_loopback=False,
-                       dut_exit_time=350000, initial_del=40000, arch='xs2'):
-
-    if arch=='xs2':
-        clk = Clock('tile[0]:XS1_PORT_1J', Clock.CLK_60MHz)
-        phy = UsbPhy('tile[0]:XS1_PORT_8B',
-                         'tile[0]:XS1_PORT_1F', #rxa
-                         'tile[0]:XS1_PORT_1I', #rxv
-                         'tile[0]:XS1_PORT_1G', #rxe
-                         'tile[0]:XS1_PORT_1E', #vld
-                         'tile[0]:XS1_PORT_8A', #txd
-                         'tile[0]:XS1_PORT_1K', #txv
-                         'tile[0]:XS1_PORT_1H', #txrdy
-                         clk,
-                         verbose=verbose, test_ctrl=test_ctrl,
-                         do_timeout=do_timeout, complete_fn=complete_fn,
-                         expect_loopback=expect_loopback,
-                         dut_exit_time=dut_exit_time, initial_delay=initial_del)
-  
-    if arch=='xs1':
-        clk = Clock('tile[0]:XS1_PORT_1J', Clock.CLK_60MHz)
-        phy = UsbPhy('tile[0]:XS1_PORT_8C',
-                         'tile[0]:XS1_PORT_1O', #rxa
-                         'tile[0]:XS1_PORT_1M', #rxv
-                         'tile[0]:XS1_PORT_1P', #rxe
-                         'tile[0]:XS1_PORT_1N', #vld
-                         'tile[0]:XS1_PORT_8A', #txd
-                         'tile[0]:XS1_PORT_1K', #txv
-                         'tile[0]:XS1_PORT_1H', #txrdy
-                         clk,
-                         verbose=verbose, test_ctrl=test_ctrl,
-                         do_timeout=do_timeout, complete_fn=complete_fn,
-                         expect_loopback=expect_loopback,
-                         dut_exit_time=dut_exit_time, initial_delay=initial_del)
-        
+                       dut_exit_time=350000, initial_del=40000, arch='xs2',
+                       edge_scheduled=None, print_rx_bytes=None, txrdy_pattern=None,
+                       clock_ppm=None, clock_jitter=None):
+
+    if edge_scheduled is None:
+        edge_scheduled = not (args and args.phy_polling)
+
+    if print_rx_bytes is None:
+        print_rx_bytes = bool(args and args.print_rx_bytes)
+
+    if txrdy_pattern is None and args and args.txrdy:
+        txrdy_pattern = parse_txrdy_pattern(args.txrdy)
+
+    if clock_ppm is None:
+        clock_ppm = args.clock_ppm if args else 0
+
+    if clock_jitter is None:
+        clock_jitter = args.clock_jitter if args else 0
+
+    seed = args.seed if args and args.seed is not None else 0
+
+    ports = USB_PORTS[arch]
+    clk = Clock(ports['clk'], Clock.CLK_60MHz, ppm=clock_ppm,
+                jitter=clock_jitter, seed=seed)
+    phy = UsbPhy(ports['rxd'], ports['rxa'], ports['rxdv'], ports['rxer'], ports['vld'],
+                 ports['txd'], ports['txv'], ports['txrdy'], clk,
+                 verbose=verbose, test_ctrl=test_ctrl,
+                 do_timeout=do_timeout, complete_fn=complete_fn,
+                 expect_loopback=expect_loopback,
+                 dut_exit_time=dut_exit_time, initial_delay=initial_del,
+                 edge_scheduled=edge_scheduled, print_rx_bytes=print_rx_bytes,
+                 txrdy_pattern=txrdy_pattern)
+
     return (clk, phy)
 
+def get_cache():
+    """ Returns the expect file and result cache, or None unless --cache is
+        given. The cache folder is shared by all jobs.
+    """
+    global _cache
+    if not (args and args.cache):
+        return None
+    if _cache is None:
+        _cache = SimCache(create_if_needed(args.cache_dir, shared=True), args.cache_size << 20)
+    return _cache
+
+def can_cache_result(tester_class, extra_tasks):
+    """ Results can only be reused when the test does nothing but compare
+        the output with the expect file: no extra simulator threads and no
+        trace or other output files that would be missing on a cached pass
+    """
+    if tester_class is not None or extra_tasks:
+        return False
+    return not (trace_enabled() or args.capture or args.txrdy or args.latency or args.monitor or
+                args.profile)
+
+def trace_enabled():
+    return bool(args and (args.trace or trace_windowed()))
+
+def trace_windowed():
+    """ True if the traces are to be windowed or compressed (sim_trace.py)
+        rather than written whole by the simulator
+    """
+    return bool(args and (args.trace_window or args.trace_packets or
+                          args.trace_ring or args.trace_compress))
+
+def get_trace_window():
+    """ The TraceWindow selected by --trace-window (us), --trace-packets or
+        --trace-ring (us); the whole run if none is given
+    """
+    if args.trace_window:
+        (start, end) = parse_range(args.trace_window)
+        return TraceWindow(start=start * 1000, end=end * 1000)
+    if args.trace_packets:
+        return TraceWindow(packets=parse_range(args.trace_packets, int))
+    if args.trace_ring:
+        return TraceWindow(ring=args.trace_ring * 1000)
+    return TraceWindow()
+
 def run_on(**kwargs):
     if not args:
         return True
@@ -80,11 +155,25 @@ def runall_rx(test_fn):
 
 
 def do_rx_test(arch, tx_clk, tx_phy, packets, test_file, seed,
-               level='nightly', extra_tasks=[]):
+               level='nightly', extra_tasks=[], ep_types=None,
+               output_name=None, tester_class=None):
 
     """ Shared test code for all RX tests using the test_rx application.
+        ep_types optionally maps endpoint numbers to their type (e.g. 'bulk')
+        for the turnaround latency figures, otherwise the type is taken
+        from the test name.
+
+        The binary is the one for test_file. output_name (default the test
+        name) names the expect and other output files, so several runs of
+        the same binary can be made with different packets. tester_class
+        defaults to ExpectDigestTester. Returns the tester.
+
+        With --cache, the expect file is copied from the cache when one was
+        made from the same packets before, and the simulation is skipped if
+        it passed before with the same binary, packets and settings.
     """
     testname,extension = os.path.splitext(os.path.basename(test_file))
+    output_name = output_name or testname
 
     resources = xmostest.request_resource("xsim")
 
@@ -98,46 +187,259 @@ def do_rx_test(arch, tx_clk, tx_phy, packets, test_file, seed,
             arch=arch, clk=tx_clk.get_name(), seed=seed)
 
     tx_phy.set_packets(packets)
+    tx_phy.get_txrdy_pattern().reset(seed)
+
+    tx_phy.latency.reset()
+    tx_phy.latency.ep_types = ep_types or {}
+    tx_phy.latency.default_ep_type = endpoint_type_from_testname(testname)
     #rx_phy.set_expected_packets(packets)
 
     expect_folder = create_if_needed("expect")
-    expect_filename = '{folder}/{test}_{arch}.expect'.format(
-        folder=expect_folder, test=testname, phy=tx_phy.get_name(), clk=tx_clk.get_name(), arch=arch)
-    create_expect(packets, expect_filename)
-
-    tester = xmostest.ComparisonTester(open(expect_filename),
-                                      'lib_xud', 'xud_sim_tests', testname,
-                                     {'clk':tx_clk.get_name(), 'arch':arch})
+    filename = '{folder}/{test}_{arch}.expect'.format(
+        folder=expect_folder, test=output_name, phy=tx_phy.get_name(), clk=tx_clk.get_name(), arch=arch)
+    filename = expect_filename(filename, compress=bool(args and args.compress_expect))
+
+    cache = get_cache()
+    stimulus = stimulus_hash(packets) if cache else None
+    if cache:
+        expect_key = make_key(kind='expect', stimulus=stimulus,
+                              print_rx_bytes=tx_phy.get_print_rx_bytes(),
+                              compressed=filename.endswith('.gz'))
+    if not (cache and cache.get_expect(expect_key, filename)):
+        create_expect(packets, filename, print_rx_bytes=tx_phy.get_print_rx_bytes())
+        if cache:
+            cache.put_expect(expect_key, filename)
+
+    if args and args.capture:
+        capture_folder = create_if_needed("captures")
+        tx_phy.set_capture_file('{folder}/{test}_{arch}.{ext}'.format(
+            folder=capture_folder, test=output_name, arch=arch, ext=args.capture))
+
+    if args and args.txrdy:
+        throughput_folder = create_if_needed("throughput")
+        tx_phy.set_throughput_file('{folder}/{test}_{arch}.json'.format(
+            folder=throughput_folder, test=output_name, arch=arch))
+
+    if args and args.latency:
+        latency_folder = create_if_needed("latency")
+        tx_phy.set_latency_file('{folder}/{test}_{arch}'.format(
+            folder=latency_folder, test=output_name, arch=arch))
+
+    monitor_tasks = []
+    if args and args.monitor:
+        monitor_folder = create_if_needed("monitor")
+        monitor_tasks.append(UsbMonitor.from_phy(tx_phy, '{folder}/{test}_{arch}.{ext}'.format(
+            folder=monitor_folder, test=output_name, arch=arch, ext=args.monitor)))
+
+    cacheable = bool(cache) and can_cache_result(tester_class, extra_tasks)
+
+    if tester_class is None:
+        tester_class = ExpectDigestTester
+    tester = tester_class(filename,
+                          'lib_xud', 'xud_sim_tests', testname,
+                          {'clk':tx_clk.get_name(), 'arch':arch})
 
     tester.set_min_testlevel(level)
 
-    simargs = get_sim_args(testname, tx_clk, tx_phy, arch)
+    simargs = get_sim_args(output_name, tx_clk, tx_phy, arch)
+
+    if (cacheable and os.path.exists(binary) and
+            tx_phy.get_config() is not None and
+            xmostest.testlevel_is_at_least(xmostest.get_testlevel(), level)):
+        # The packets and the clock jitter are covered by their own hashes,
+        # so the seed only counts when the TXRDY pattern draws on it
+        fields = {'binary' : file_hash(binary), 'stimulus' : stimulus, 'simargs' : simargs,
+                  'clock' : tx_clk.get_config(), 'phy' : tx_phy.get_config(),
+                  'arch' : arch, 'level' : level}
+        if tx_phy.get_txrdy_pattern().uses_seed:
+            fields['seed'] = seed
+        result_key = make_key(kind='result', **fields)
+        cached = cache.get_result(result_key)
+        if cached and cached['result']:
+            tester.report_cached(cached['output'])
+            return tester
+        tester.set_cache(cache, result_key, fields)
+
+    simthreads = [tx_clk, tx_phy] + extra_tasks + monitor_tasks
+
+    if args and args.profile:
+        # Timed from when the first thread runs to when the simulation has
+        # finished
+        profiler = HarnessProfiler()
+        for thread in simthreads:
+            profiler.attach(thread)
+        profile_filename = '{folder}/{test}_{arch}.json'.format(
+            folder=create_if_needed("profile"), test=output_name, arch=arch)
+
+        def write_profile():
+            profiler.stop()
+            profiler.write_summary(profile_filename,
+                {'test' : output_name, 'arch' : arch, 'seed' : seed, 'packets' : len(packets),
+                 'clock_waits' : {'edge_scheduled' : tx_phy._edge_waits,
+                                  'polled' : tx_phy._poll_waits}})
+            for line in profiler.format_summary():
+                print line
+        tester.add_complete_fn(write_profile)
+
     xmostest.run_on_simulator(resources['xsim'], binary,
-                              simthreads=[tx_clk, tx_phy] + extra_tasks,
+                              simthreads=simthreads,
                               tester=tester,
                               simargs=simargs)
 
-def create_expect(packets, filename):
-    """ Create the expect file for what packets should be reported by the DUT
+    for monitor in monitor_tasks:
+        tester.add_complete_fn(monitor.close)
+
+    capture = tx_phy.trace_capture
+    if capture:
+        tester.add_complete_fn(lambda: close_trace(tx_phy, capture))
+    return tester
+
+def close_trace(phy, capture):
+    """ Finishes the windowed trace capture of a run of phy """
+    if phy.trace_capture is capture:
+        phy.set_trace_capture(None)
+    for filename in capture.close():
+        print "WARNING: {} truncated at the trace budget".format(filename)
+
+def stimulus_version(generate_fn):
+    """ Version of the code that generates a stimulus: the harness version
+        and the hash of the file generate_fn is defined in
     """
-    with open(filename, 'w') as f:
-        for i,packet in enumerate(packets):
+    source = inspect.getsourcefile(generate_fn)
+    return make_key(kind='stimulus', source=file_hash(source) if source else None)
+
+def get_stimulus(testname, seed, generate_fn, **params):
+    """ Returns the packets for a test from a stimulus file, calling
+        generate_fn() to build them only when the file doesn't exist yet or
+        was generated with a different seed, parameters or generating code
+        (stimulus_version()). The file is shared by all architectures and
+        reused across runs.
+    """
+    stimulus_folder = create_if_needed("stimulus", shared=True)
+    filename = '{folder}/{test}_{seed}{ext}'.format(
+        folder=stimulus_folder, test=testname, seed=seed, ext=STIMULUS_EXTENSION)
+    return load_stimulus(filename, generate_fn, seed=seed, generator=testname, params=params,
+                         version=stimulus_version(generate_fn))
+
+def create_expect(packets, filename, print_rx_bytes=False):
+    """ Create the expect file for what packets should be reported by the DUT.
+        The file is gzip compressed if filename ends in .gz. print_rx_bytes
+        must match the setting of the phy, as the bytes received are only
+        printed when it is set.
+    """
+    with ExpectWriter(filename) as f:
+        for i,packet in enumerate(iter_packets(packets)):
             #if not packet.dropped:
-            if isinstance(packet, RxPacket):
-                f.write("Receiving packet {}\n".format(i))
+            if packet.is_rx:
+                f.write_line("Receiving packet {}".format(i))
 
-                for (i, byte) in enumerate(packet.get_bytes()):
-                    f.write("Received byte: {0:#x}\n".format(byte))
+                if print_rx_bytes:
+                    for byte in packet.get_bytes():
+                        f.write_line("Received byte: {0:#x}".format(byte))
             
             else:
-                f.write("Sending packet {}\n".format(i))
+                f.write_line("Sending packet {}".format(i))
         
-        f.write("Test done\n")
+        f.write_line("Test done")
+
+class ExpectDigestTester(xmostest.Tester):
+    """ Checks the simulator output against an expect file. Equivalent to
+        xmostest.ComparisonTester, but on a pass only the digest and length
+        of the output are compared with those recorded when the expect file
+        was written, and on a failure only the lines around the first
+        difference are diffed.
+    """
+
+    def __init__(self, expect_filename, product, group, test, config = {}, env = {}):
+        super(ExpectDigestTester, self).__init__()
+        self.register_test(product, group, test, config)
+        self._expect_filename = expect_filename
+        self.product = product
+        self.group = group
+        self.test = test
+        self.config = config
+        self.env = env
+        self._cache = None
+        self._complete_fns = []
+
+    def set_cache(self, cache, key, fields=None):
+        """ Store the verdict and output in cache under key """
+        self._cache = (cache, key, fields)
+
+    def add_complete_fn(self, fn):
+        """ Calls fn() once the simulation has finished, before the output
+            is checked. run_on_simulator() may only queue the simulation, so
+            whatever needs the threads to have run (closing their files,
+            summaries) is done from here rather than after it returns.
+        """
+        self._complete_fns.append(fn)
+
+    def _simulation_complete(self):
+        (fns, self._complete_fns) = (self._complete_fns, [])
+        for fn in fns:
+            fn()
+
+    def run(self, output):
+        self._simulation_complete()
+
+        (result, report) = compare_with_expect(self._expect_filename, output)
+
+        for line in report:
+            print line
+
+        self._set_result(result, output, report)
+
+        if self._cache:
+            (cache, key, fields) = self._cache
+            cache.put_result(key, result, output, fields)
+
+    def report_cached(self, output):
+        """ Reports a pass cached from an earlier run of the same binary and
+            packets, without simulating
+        """
+        print "Cached pass: {} {}".format(self.test, self.config.get('arch'))
+        self._set_result(True, output, ["Cached pass"], cached=True)
+
+    def _set_result(self, result, output, report, cached=False):
+        # Same shape as the output xmostest.ComparisonTester reports
+        output = {'output' : ''.join(output)}
+        if not result:
+            output['failures'] = '\n'.join(report)
+
+        if job_results is None:
+            xmostest.set_test_result(self.product, self.group, self.test,
+                                     self.config, result, output=output,
+                                     env=self.env)
+        else:
+            job_results.append({'product' : self.product, 'group' : self.group,
+                                'test' : self.test, 'config' : self.config,
+                                'env' : self.env, 'result' : bool(result),
+                                'output' : output, 'report' : list(report),
+                                'cached' : cached})
+
+class RecordingTester(ExpectDigestTester):
+    """ Records whether the output matched the expect file instead of
+        reporting a test result. Used by tools that run the simulator to
+        measure something rather than to test.
+    """
+
+    def __init__(self, expect_filename, product, group, test, config = {}, env = {}):
+        xmostest.Tester.__init__(self)
+        self._expect_filename = expect_filename
+        self._complete_fns = []
+        self.result = None
+        self.output = None
+
+    def run(self, output):
+        self._simulation_complete()
+
+        self.output = output
+        (self.result, report) = compare_with_expect(self._expect_filename, output)
 
 def get_sim_args(testname, clk, phy, arch='xs2'):
     sim_args = []
 
-    if args and args.trace:
+    if trace_enabled():
         log_folder = create_if_needed("logs")
         #if phy.get_name() == 'rgmii':
         #arch = 'xs2'
@@ -145,18 +447,23 @@ def get_sim_args(testname, clk, phy, arch='xs2'):
             log=log_folder, test=testname,
             clk=clk.get_name(), phy=phy.get_name(), arch=arch)
 
-        sim_args += ['--trace-to', '{0}.txt'.format(filename), '--enable-fnop-tracing']
-
-        vcd_args  = '-o {0}.vcd'.format(filename)
-        vcd_args += (' -tile tile[0] -ports -ports-detailed -instructions'
-                     ' -functions -cycles -clock-blocks -pads -cores')
+        vcd_args = ('-tile tile[0] -ports -ports-detailed -instructions'
+                    ' -functions -cycles -clock-blocks -pads -cores')
 
         # The RGMII pins are on tile[1]
         #if phy.get_name() == 'rgmii':
          #       vcd_args += (' -tile tile[0] -ports -ports-detailed -instructions'
           #                   ' -functions -cycles -clock-blocks -cores')
 
-        sim_args += ['--vcd-tracing', vcd_args]
+        if trace_windowed():
+            # The traces go through pipes to be windowed and compressed
+            capture = TraceCapture(filename, get_trace_window(),
+                                   args.trace_compress or 'gzip', args.trace_budget << 20)
+            phy.set_trace_capture(capture)
+            sim_args += capture.sim_args(vcd_args)
+        else:
+            sim_args += ['--trace-to', '{0}.txt'.format(filename), '--enable-fnop-tracing']
+            sim_args += ['--vcd-tracing', '-o {0}.vcd {1}'.format(filename, vcd_args)]
 
 #        sim_args += ['--xscope', '-offline logs/xscope.xmt']
 
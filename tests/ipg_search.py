@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Minimum inter-packet gap search
+#
+# For each endpoint type, direction and payload length, finds the smallest
+# inter_pkt_gap before the token at which the DUT still responds correctly
+# (no NAK, no timeout). Each probe is a short packet sequence run through
+# do_rx_test() against an existing test binary:
+#
+#   bulk/iso 'in'   IN token gap after an OUT to the loopback endpoint
+#   bulk/iso 'out'  OUT token gap after the previous IN transaction
+#   control 'in'    IN (data stage) token gap after the SETUP transaction
+#   control 'out'   OUT (status stage) token gap after the IN data stage
+#
+# The search assumes any gap above the minimum also passes. Each round
+# probes several gaps of every unfinished search in parallel, narrowing the
+# range between the largest failing and smallest passing gap.
+#
+# The result is a table (JSON) that can be checked in; --check compares a
+# run against such a table and fails if any minimum has grown.
+
+import xmostest
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+
+from helpers import do_rx_test, get_usb_clk_phy, RecordingTester
+from usb_packet import *
+
+# Binary used for each endpoint type, and its endpoints
+LOOPBACK_EP = 3
+LOOPBACK_KILL_EP = 2
+PROBE_BINARIES = {'bulk' : 'test_bulk_loopback.py',
+                  'iso' : 'test_iso_loopback.py',
+                  'control' : 'test_control_basic_get.py'}
+
+# Data stage length sent by the control test binary
+CONTROL_IN_LENGTH = 10
+
+DEFAULT_LENGTHS = {'bulk' : [0, 1, 64, 512],
+                   'iso' : [1, 200, 1024],
+                   'control' : [CONTROL_IN_LENGTH]}
+
+# Gap known to pass, from the hand tuned tests, and the number of loopback
+# transactions per probe
+DEFAULT_MAX_GAP = 6000
+PROBE_TRANSACTIONS = 3
+SETTLE_GAP = 2000
+
+DIRECTIONS = ('in', 'out')
+
+def _loopback_packets(rand, ep_type, direction, length, gap):
+    packets = []
+    data_pid = 0x3 #DATA0
+    bulk = (ep_type == 'bulk')
+    dataval = 0
+
+    for i in range(PROBE_TRANSACTIONS):
+        out_gap = gap if direction == 'out' else SETTLE_GAP
+        in_gap = gap if direction == 'in' else SETTLE_GAP
+
+        AppendOutToken(packets, LOOPBACK_EP, inter_pkt_gap=out_gap)
+        packets.append(TxDataPacket(rand, data_start_val=dataval, length=length, pid=data_pid))
+        if bulk:
+            packets.append(RxHandshakePacket(timeout=9))
+
+        AppendInToken(packets, LOOPBACK_EP, inter_pkt_gap=in_gap)
+        packets.append(RxDataPacket(rand, data_start_val=dataval, length=length, pid=data_pid, timeout=9))
+        if bulk:
+            packets.append(TxHandshakePacket())
+            data_pid = data_pid ^ 8
+
+        dataval += length
+
+    append_loopback_kill(packets, rand)
+    return packets
+
+def append_loopback_kill(packets, rand):
+    """ Loops a packet back on the endpoint that makes the loopback
+        binaries exit
+    """
+    AppendOutToken(packets, LOOPBACK_KILL_EP, inter_pkt_gap=SETTLE_GAP)
+    packets.append(TxDataPacket(rand, length=10, pid=3)) #DATA0
+    packets.append(RxHandshakePacket())
+
+    AppendInToken(packets, LOOPBACK_KILL_EP, inter_pkt_gap=SETTLE_GAP)
+    packets.append(RxDataPacket(rand, length=10, pid=3)) #DATA0
+    packets.append(TxHandshakePacket())
+
+def _control_packets(rand, direction, gap):
+    ep = 0
+    packets = []
+
+    # SETUP transaction
+    AppendSetupToken(packets, ep)
+    packets.append(TxDataPacket(rand, length=8, pid=3))
+    packets.append(RxHandshakePacket(timeout=11))
+
+    # IN (data stage)
+    AppendInToken(packets, ep, inter_pkt_gap=gap if direction == 'in' else SETTLE_GAP)
+    packets.append(RxDataPacket(rand, length=CONTROL_IN_LENGTH, pid=0x4b))
+    packets.append(TxHandshakePacket())
+
+    # 0 length OUT (status stage)
+    AppendOutToken(packets, ep, inter_pkt_gap=gap if direction == 'out' else SETTLE_GAP)
+    packets.append(TxDataPacket(rand, length=0, pid=0xb))
+    packets.append(RxHandshakePacket())
+    return packets
+
+def probe_packets(ep_type, direction, length, gap, seed=1):
+    """ Packet sequence for one probe """
+    rand = random.Random()
+    rand.seed(seed)
+    if ep_type == 'control':
+        return _control_packets(rand, direction, gap)
+    return _loopback_packets(rand, ep_type, direction, length, gap)
+
+def run_probe(probe):
+    """ Runs one probe in the simulator, returns (probe, passed) """
+    (arch, ep_type, direction, length, gap) = probe
+    (clk, phy) = get_usb_clk_phy(verbose=False, arch=arch)
+    packets = probe_packets(ep_type, direction, length, gap)
+    name = 'ipg_{}_{}_{}_{}_{}'.format(ep_type, direction, length, gap, arch)
+    tester = do_rx_test(arch, clk, phy, packets, PROBE_BINARIES[ep_type], 1,
+                        level='smoke', output_name=name, tester_class=RecordingTester)
+    # run_on_simulator() may only queue the simulation
+    xmostest.complete_all_jobs()
+    return (probe, bool(tester.result))
+
+
+class GapSearch(object):
+    """ Search for the minimum gap of one (arch, ep_type, direction, length)
+        between a failing gap lo (-1 for none known) and a passing gap hi
+    """
+
+    def __init__(self, key, max_gap):
+        self.key = key
+        self.lo = -1
+        self.hi = max_gap
+        self.checked_hi = False
+        self.probes = 0
+
+    def done(self):
+        return self.checked_hi and self.hi - self.lo <= 1
+
+    def next_gaps(self, count):
+        if not self.checked_hi:
+            return [self.hi]
+        span = self.hi - self.lo
+        count = min(count, span - 1)
+        return sorted(set(self.lo + (span * (i + 1)) // (count + 1) for i in range(count)))
+
+    def update(self, results):
+        """ results maps gap to pass/fail """
+        self.probes += len(results)
+        if not self.checked_hi:
+            self.checked_hi = True
+            if not results.get(self.hi):
+                # Doesn't pass even at the maximum gap
+                self.lo = self.hi
+                self.hi = None
+            return
+
+        passing = [gap for (gap, passed) in results.items() if passed]
+        if passing:
+            self.hi = min(passing)
+        failing = [gap for (gap, passed) in results.items() if not passed and gap < self.hi]
+        if failing:
+            self.lo = max(failing)
+
+    def finished(self):
+        return self.hi is None or self.done()
+
+def search(keys, max_gap, jobs):
+    """ Runs the searches for all keys, returns a dict of key to the
+        minimum gap (None if even max_gap fails) and the number of probes
+    """
+    searches = [GapSearch(key, max_gap) for key in keys]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        while True:
+            active = [s for s in searches if not s.finished()]
+            if not active:
+                break
+
+            # Share the workers between the unfinished searches
+            per_search = max(1, jobs // len(active))
+            probes = []
+            for s in active:
+                probes += [s.key + (gap,) for gap in s.next_gaps(per_search)]
+
+            results = {}
+            for (probe, passed) in pool.imap_unordered(run_probe, probes):
+                results.setdefault(probe[:-1], {})[probe[-1]] = passed
+
+            for s in active:
+                s.update(results.get(s.key, {}))
+                print "{}: gap in ({}, {}]".format(format_key(s.key), s.lo, s.hi)
+                sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict((s.key, s.hi) for s in searches), sum(s.probes for s in searches)
+
+def format_key(key):
+    return "{} {} {} {} bytes".format(*key)
+
+def key_to_string(key):
+    return "{}/{}/{}/{}".format(*key)
+
+def table_from_results(results, max_gap, probes):
+    return {'max_gap' : max_gap,
+            'probes' : probes,
+            'min_gap' : dict((key_to_string(key), gap) for (key, gap) in results.items())}
+
+def print_table(table):
+    print "{:<6} {:<8} {:<4} {:>7} {:>8}".format('arch', 'ep_type', 'dir', 'length', 'min_gap')
+    for name in sorted(table['min_gap'], key=lambda n: (n.split('/')[:3], int(n.split('/')[3]))):
+        (arch, ep_type, direction, length) = name.split('/')
+        gap = table['min_gap'][name]
+        print "{:<6} {:<8} {:<4} {:>7} {:>8}".format(
+            arch, ep_type, direction, length, '>{}'.format(table['max_gap']) if gap is None else gap)
+
+def check_against(table, baseline):
+    """ Returns the list of minimums that have grown since baseline """
+    regressions = []
+    for (name, gap) in sorted(table['min_gap'].items()):
+        if name not in baseline['min_gap']:
+            continue
+        old = baseline['min_gap'][name]
+        if old is not None and (gap is None or gap > old):
+            regressions.append("{}: minimum gap grew from {} to {}".format(
+                name, old, '>{}'.format(table['max_gap']) if gap is None else gap))
+    return regressions
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="XMOS lib_xud minimum inter-packet gap search")
+    argparser.add_argument('--arch', choices=['xs1', 'xs2'], type=str, action='append', help='Architectures to search (default both)')
+    argparser.add_argument('--ep-type', choices=sorted(PROBE_BINARIES), type=str, action='append', help='Endpoint types to search (default all)')
+    argparser.add_argument('--direction', choices=DIRECTIONS, type=str, action='append', help='Directions to search (default both)')
+    argparser.add_argument('--lengths', type=str, help='Comma separated payload lengths (default depends on the endpoint type)')
+    argparser.add_argument('--max-gap', type=int, default=DEFAULT_MAX_GAP, help='Gap that is expected to pass')
+    argparser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='Number of probes to run in parallel')
+    argparser.add_argument('--output', type=str, default='ipg_table.json', help='File to write the table of minimum gaps to')
+    argparser.add_argument('--check', type=str, help='Table to check against, fails if any minimum gap has grown')
+
+    args = xmostest.init(argparser)
+
+    keys = []
+    for arch in args.arch or ['xs1', 'xs2']:
+        for ep_type in args.ep_type or sorted(PROBE_BINARIES):
+            if args.lengths and ep_type != 'control':
+                lengths = [int(length) for length in args.lengths.split(',')]
+            else:
+                lengths = DEFAULT_LENGTHS[ep_type]
+            for direction in args.direction or DIRECTIONS:
+                for length in lengths:
+                    keys.append((arch, ep_type, direction, length))
+
+    (results, probes) = search(keys, args.max_gap, args.jobs)
+    table = table_from_results(results, args.max_gap, probes)
+
+    with open(args.output, 'w') as f:
+        json.dump(table, f, indent=2, sort_keys=True)
+
+    print_table(table)
+
+    status = 0
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+        regressions = check_against(table, baseline)
+        for line in regressions:
+            print "ERROR: " + line
+        if regressions:
+            status = 1
+
+    xmostest.finish()
+    sys.exit(status)
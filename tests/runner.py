@@ -0,0 +1,219 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Parallel test runner
+#
+# Discovers the test_*.py modules next to this file and runs each one as a
+# separate job per architecture and seed on a process pool. A job calls the
+# module's runtest() with helpers.args narrowed to its architecture and seed,
+# and with helpers.output_dir set to its own folder under the job folder, so
+# expect files, logs, captures and so on of jobs running at the same time
+# never collide. The output of each job goes to output.log in its folder.
+#
+# While a job runs, the testers only collect their results in
+# helpers.job_results. The results of all jobs are reported to xmostest in
+# the parent process and summarised, with the wall time of each job, in
+# summary.json.
+
+import xmostest
+import argparse
+import fnmatch
+import glob
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+import traceback
+
+import helpers
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHS = ('xs1', 'xs2')
+DEFAULT_JOB_DIR = 'jobs'
+
+def discover_tests(patterns=None):
+    """ Names of the test modules, optionally only those matching one of the
+        fnmatch patterns
+    """
+    tests = sorted(os.path.splitext(os.path.basename(path))[0]
+                   for path in glob.glob(os.path.join(TESTS_DIR, 'test_*.py')))
+    if patterns:
+        tests = [test for test in tests
+                 if any(fnmatch.fnmatch(test, pattern) for pattern in patterns)]
+    return tests
+
+def job_name(test, arch, seed):
+    return '{}_{}_{}'.format(test, arch, seed)
+
+def make_jobs(tests, archs, seeds, job_dir):
+    """ One job per (test, arch, seed) """
+    jobs = []
+    for test in tests:
+        for arch in archs:
+            for seed in seeds:
+                jobs.append({'test' : test, 'arch' : arch, 'seed' : seed,
+                             'dir' : os.path.join(job_dir, job_name(test, arch, seed))})
+    return jobs
+
+def choose_seeds(args, default_count=1):
+    """ The seed given on the command line, otherwise args.seeds (or
+        default_count) random ones. Seeds are never 0 as runall_rx() treats
+        that as no seed.
+    """
+    if args.seed:
+        return [args.seed]
+    return [random.randint(1, sys.maxint) for i in range(args.seeds or default_count)]
+
+def run_job(job):
+    """ Runs one job in this process, returns the job with its results """
+    test_args = argparse.Namespace(**vars(helpers.args))
+    test_args.arch = job['arch']
+    test_args.seed = job['seed']
+
+    if not os.path.exists(job['dir']):
+        os.makedirs(job['dir'])
+
+    saved = (helpers.args, helpers.output_dir, helpers.job_results)
+    helpers.args = test_args
+    helpers.output_dir = job['dir']
+    helpers.job_results = []
+
+    result = dict(job)
+    result['pid'] = os.getpid()
+    stdout = sys.stdout
+    start = time.time()
+    with open(os.path.join(job['dir'], 'output.log'), 'w') as log:
+        sys.stdout = log
+        try:
+            module = importlib.import_module(job['test'])
+            module.runtest()
+            # run_on_simulator() may only queue the simulations, the testers
+            # have run once they are complete
+            xmostest.complete_all_jobs()
+            result['error'] = None
+        except Exception:
+            result['error'] = traceback.format_exc()
+            log.write(result['error'])
+        finally:
+            sys.stdout = stdout
+            result['results'] = helpers.job_results
+            (helpers.args, helpers.output_dir, helpers.job_results) = saved
+
+    result['wall_time'] = time.time() - start
+    result['passed'] = (result['error'] is None and bool(result['results']) and
+                        all(r['result'] for r in result['results']))
+    return result
+
+def run_jobs(jobs, processes, progress=True):
+    """ Runs the jobs on a pool of processes, returns the results in job
+        order. Each worker process runs a single job, so that no module
+        state is carried from one job to the next.
+    """
+    results = []
+    if processes <= 1:
+        results_iter = (run_job(job) for job in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+        results_iter = pool.imap_unordered(run_job, jobs)
+
+    try:
+        for result in results_iter:
+            results.append(result)
+            if progress:
+                print "[{}/{}] {} {} ({:.1f}s)".format(
+                    len(results), len(jobs), job_status(result),
+                    job_name(result['test'], result['arch'], result['seed']),
+                    result['wall_time'])
+                sys.stdout.flush()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    order = dict((job['dir'], i) for (i, job) in enumerate(jobs))
+    return sorted(results, key=lambda result: order[result['dir']])
+
+def job_status(result):
+    if result['error']:
+        return 'ERROR'
+    if not result['results']:
+        return 'NORUN'
+    if not result['passed']:
+        return 'FAIL'
+    if all(r.get('cached') for r in result['results']):
+        return 'CACHED'
+    return 'PASS'
+
+def report_results(results):
+    """ Reports the results of the jobs to xmostest. The tests of jobs run
+        in another process are registered first, as their testers were only
+        made there.
+    """
+    for result in results:
+        for r in result['results']:
+            if result['pid'] != os.getpid():
+                xmostest.register_test(r['product'], r['group'], r['test'], r['config'])
+            xmostest.set_test_result(r['product'], r['group'], r['test'], r['config'],
+                                     r['result'], output=r['output'], env=r['env'])
+
+def summary(results, wall_time, processes):
+    job_time = sum(result['wall_time'] for result in results)
+    counts = {}
+    for result in results:
+        status = job_status(result)
+        counts[status] = counts.get(status, 0) + 1
+    return {'jobs' : len(results),
+            'processes' : processes,
+            'counts' : counts,
+            'wall_time' : wall_time,
+            'job_time' : job_time,
+            'speedup' : job_time / wall_time if wall_time else None,
+            'results' : [{'test' : result['test'], 'arch' : result['arch'],
+                          'seed' : result['seed'], 'dir' : result['dir'],
+                          'status' : job_status(result),
+                          'wall_time' : result['wall_time'],
+                          'error' : result['error']} for result in results]}
+
+def print_summary(summary):
+    print "{:<40} {:<4} {:>20} {:<6} {:>9}".format('test', 'arch', 'seed', 'status', 'time (s)')
+    for result in summary['results']:
+        print "{:<40} {:<4} {:>20} {:<6} {:>9.1f}".format(
+            result['test'], result['arch'], result['seed'], result['status'], result['wall_time'])
+    print "{} jobs on {} processes: {}".format(
+        summary['jobs'], summary['processes'],
+        ", ".join("{} {}".format(count, status) for (status, count) in sorted(summary['counts'].items())))
+    print "Wall time {:.1f}s, job time {:.1f}s (x{:.1f})".format(
+        summary['wall_time'], summary['job_time'], summary['speedup'] or 0)
+
+def write_summary(summary, filename):
+    with open(filename, 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+
+def add_arguments(argparser):
+    argparser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='Number of tests to run in parallel (default one per CPU)')
+    argparser.add_argument('--seeds', type=int, help='Number of random seeds to run each test (default 1) or the campaign with (ignored with --seed)')
+    argparser.add_argument('--tests', type=str, action='append', help='Run only the tests matching this pattern (e.g. test_bulk_*), can be repeated')
+    argparser.add_argument('--job-dir', type=str, default=DEFAULT_JOB_DIR, help='Folder for the output of each job')
+
+def run(args):
+    """ Runs the tests selected by args, returns True if all passed """
+    tests = discover_tests(args.tests)
+    archs = [args.arch] if args.arch else ARCHS
+    jobs = make_jobs(tests, archs, choose_seeds(args), args.job_dir)
+
+    start = time.time()
+    results = run_jobs(jobs, min(args.jobs, len(jobs)))
+    wall_time = time.time() - start
+
+    report_results(results)
+
+    result_summary = summary(results, wall_time, min(args.jobs, len(jobs)))
+    if not os.path.exists(args.job_dir):
+        os.makedirs(args.job_dir)
+    write_summary(result_summary, os.path.join(args.job_dir, 'summary.json'))
+    print_summary(result_summary)
+    return all(result['passed'] for result in results)
@@ -5,43 +5,65 @@ import xmostest
 import argparse
 
 import helpers
+import runner
+import campaign
 
 if __name__ == "__main__":
     global trace
     argparser = argparse.ArgumentParser(description="XMOS lib_xud tests")
     argparser.add_argument('--trace', action='store_true', help='Run tests with simulator and VCD traces')
+    argparser.add_argument('--trace-window', type=str, metavar='START:END', help='Keep only the traces between START and END us of simulated time (implies --trace)')
+    argparser.add_argument('--trace-packets', type=str, metavar='FIRST:LAST', help='Keep only the traces from the start of packet FIRST to the end of packet LAST (implies --trace)')
+    argparser.add_argument('--trace-ring', type=float, metavar='US', help='Keep only the last US us of the traces before the first error, nothing if there is none (implies --trace)')
+    argparser.add_argument('--trace-compress', choices=['none', 'gzip', 'zstd'], type=str, help='Compression of the windowed traces (default gzip, implies --trace)')
+    argparser.add_argument('--trace-budget', type=int, default=64, help='Size limit of the windowed traces of each run in MB')
     argparser.add_argument('--arch', choices=['xs1', 'xs2'], type=str, help='Run tests only on specified xcore architecture')
     argparser.add_argument('--clk', choices=['25Mhz', '125Mhz'], type=str, help='Run tests only at specified clock speed')
     argparser.add_argument('--mac', choices=['rt', 'rt_hp', 'standard'], type=str, help='Run tests only on specified MAC')
     argparser.add_argument('--seed', type=int, help='The seed', default=None)
     argparser.add_argument('--verbose', action='store_true', help='Enable verbose tracing in the phys')
+    argparser.add_argument('--compress-expect', action='store_true', help='Write gzip compressed expect files')
+    argparser.add_argument('--phy-polling', action='store_true', help='Drive the PHY by polling the clock every step rather than scheduling on clock edges')
+    argparser.add_argument('--print-rx-bytes', action='store_true', help='Print every byte received from the DUT (packets are checked in the PHY either way)')
+    argparser.add_argument('--capture', choices=['jsonl', 'bin'], type=str, help='Write the packets received from the DUT to captures/ in the given format')
+    argparser.add_argument('--txrdy', type=str, help='TXRDY back-pressure pattern while the DUT transmits: always, duty:<fraction>, periodic:<period>:<stall>[:<offset>], random:<stall probability> or first:<stall>. Throughput is written to throughput/')
+    argparser.add_argument('--monitor', choices=['jsonl', 'bin'], type=str, help='Run a passive bus monitor and write its transaction log to monitor/ in the given format')
+    argparser.add_argument('--latency', action='store_true', help='Write bus turnaround samples and a percentile summary to latency/')
+    argparser.add_argument('--clock-ppm', type=float, default=0, help='Offset of the 60MHz clock from nominal in ppm')
+    argparser.add_argument('--clock-jitter', type=int, default=0, help='Peak jitter of each clock edge in ps')
+    argparser.add_argument('--profile', action='store_true', help='Profile the Python simulator threads and write a summary per test to profile/')
+    argparser.add_argument('--cache', action='store_true', help='Reuse expect files and skip tests that passed before with the same binary, packets and settings')
+    argparser.add_argument('--cache-dir', type=str, default='cache', help='Folder for the --cache entries')
+    argparser.add_argument('--cache-size', type=int, default=1024, help='Size limit of the cache in MB, least recently used entries are removed past it')
 
-    argparser.add_argument('--num-packets', type=int, help='Number of packets in the test', default='100')
-    argparser.add_argument('--data-len-min', type=int, help='Minimum packet data bytes', default='46')
-    argparser.add_argument('--data-len-max', type=int, help='Maximum packet data bytes', default='500')
+    argparser.add_argument('--num-packets', type=int, help='Number of packets in each stream of the --campaign', default='100')
+    argparser.add_argument('--data-len-min', type=int, help='Minimum payload bytes of the --campaign packets', default='46')
+    argparser.add_argument('--data-len-max', type=int, help='Maximum payload bytes of the --campaign packets', default='500')
     
+    runner.add_arguments(argparser)
+    campaign.add_arguments(argparser)
+
     helpers.args = xmostest.init(argparser)
 
-   # xmostest.register_group("lib_xud",
-   #                         "xud_sim_tests",
-   #                         "XUD simulator tests",
-   # """
-#Tests are performed by running the GPIO library connected to a simulator model
-#(written as a python plugin to xsim). The simulator model checks that the pins
-#are driven and read by the ports as expected. Tests are run to test the
-#following features:
-#
-#    * Inputting on a multibit port with multiple clients using the default pin map
-#    * Inputting on a multibit port with multiple clients using a specified pin map
-#    * Inputting on a 1bit port
-#    * Inputting with timestamps
-#    * Eventing on a multibit input port
-#    * Eventing on a 1bit input port
-#    * Outputting on a multibit port with multiple clients using the default pin map
-#    * Outputting on a multibit port with multiple clients using a specified pin map
-#    * Outputting with timestamps
-#""")
-#'''
-  #  xmostest.runtests()
+    xmostest.register_group("lib_xud",
+                            "xud_sim_tests",
+                            "XUD simulator tests",
+    """
+Tests are performed by running the XUD library against a simulated USB host
+and ULPI PHY (written as python SimThreads run by xsim). The PHY sends host
+packets to the device and checks the packets the device sends back. Tests
+are run to test the following features:
+
+    * Bulk, control and isochronous transfers in and out
+    * Fast back to back packets on one or more endpoints
+    * Bad CRCs, bad PIDs and receive errors from the host
+    * Invalid tokens and repeated SETUPs
+    * PING handling
+""")
+
+    if helpers.args.campaign or helpers.args.replay:
+        campaign.run(helpers.args)
+    else:
+        runner.run(helpers.args)
 
     xmostest.finish()
@@ -0,0 +1,214 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Content addressed cache of expect files and simulation results
+#
+# Expect files are keyed on the content hash of the packets (and the
+# settings that change what is expected), so the same stimulus on xs1 and
+# xs2, or on a later run, is only turned into an expect file once.
+#
+# Simulation results are keyed on the hash of the binary, the packets, the
+# simulator arguments, the clock and PHY settings, the seed when the TXRDY
+# pattern uses it and the harness version (a hash of the Python modules
+# driving the simulation). The seed isn't otherwise part of the key, as the
+# tests pick a random one on every run. A test whose key has a cached pass
+# isn't simulated again, so after changing one source file only the tests
+# whose binaries changed are re-run.
+#
+# Entries are folders under the cache folder, written to a temporary folder
+# and renamed into place so that parallel jobs can share the cache. Using an
+# entry touches it; when the cache grows past its size limit the least
+# recently used entries are removed.
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from expect_stream import DIGEST_EXTENSION
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_SIZE = 1024 # MB
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules whose source makes up the harness version
+HARNESS_MODULES = ('helpers.py', 'expect_stream.py', 'usb_*.py')
+
+EXPECT_FILENAME = 'expect'
+RESULT_FILENAME = 'result.json'
+
+_file_hashes = {}
+
+def file_hash(filename):
+    """ Hex SHA-256 of a file, remembered while its size and mtime are
+        unchanged
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+_harness_version = None
+
+def harness_version():
+    """ Hash of the harness sources, so that changing the PHY model or the
+        expect file generation invalidates the cache
+    """
+    global _harness_version
+    if _harness_version is None:
+        digest = hashlib.sha256(str(CACHE_VERSION).encode('utf-8'))
+        filenames = set()
+        for pattern in HARNESS_MODULES:
+            filenames.update(glob.glob(os.path.join(TESTS_DIR, pattern)))
+        for filename in sorted(filenames):
+            digest.update(os.path.basename(filename).encode('utf-8'))
+            digest.update(file_hash(filename).encode('utf-8'))
+        _harness_version = digest.hexdigest()
+    return _harness_version
+
+def make_key(**fields):
+    """ Hex SHA-256 of the fields (which must be JSON serialisable) and the
+        harness version
+    """
+    fields['harness'] = harness_version()
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SimCache(object):
+    """ Cache of expect files and simulation results under folder, holding at
+        most max_size bytes
+    """
+
+    def __init__(self, folder, max_size=DEFAULT_CACHE_SIZE << 20):
+        self.folder = folder
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, kind, key):
+        return os.path.join(self.folder, kind, key)
+
+    def _touch(self, entry):
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+
+    def _store(self, kind, key, write_fn):
+        """ Creates an entry by calling write_fn(folder) on a temporary
+            folder and moving it into place
+        """
+        entry = self._entry(kind, key)
+        tmp = '{}.{}.tmp'.format(entry, os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        try:
+            write_fn(tmp)
+            if os.path.exists(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+        except OSError:
+            # Another job stored the same entry first
+            pass
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def get_expect(self, key, filename):
+        """ Copies the cached expect file (and its digest) for key to
+            filename, returns False if there is none
+        """
+        entry = self._entry('expect', key)
+        cached = os.path.join(entry, EXPECT_FILENAME)
+        try:
+            # The digest is copied last so that it is newer than the expect
+            # file
+            shutil.copyfile(cached, filename)
+            shutil.copyfile(cached + DIGEST_EXTENSION, filename + DIGEST_EXTENSION)
+        except (IOError, OSError):
+            # Not cached (or evicted by another job while copying)
+            self.misses += 1
+            return False
+        self._touch(entry)
+        self.hits += 1
+        return True
+
+    def put_expect(self, key, filename):
+        """ Stores the expect file filename and its digest """
+        def write(tmp):
+            cached = os.path.join(tmp, EXPECT_FILENAME)
+            shutil.copyfile(filename, cached)
+            shutil.copyfile(filename + DIGEST_EXTENSION, cached + DIGEST_EXTENSION)
+
+        self._store('expect', key, write)
+
+    def get_result(self, key):
+        """ Returns the cached result for key (a dict with 'result', 'output'
+            and 'time'), or None
+        """
+        entry = self._entry('result', key)
+        try:
+            with open(os.path.join(entry, RESULT_FILENAME)) as f:
+                result = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self._touch(entry)
+        self.hits += 1
+        return result
+
+    def put_result(self, key, result, output, fields=None):
+        """ Stores the verdict and output of a simulation. fields is stored
+            alongside to show what the key was made from.
+        """
+        def write(tmp):
+            with open(os.path.join(tmp, RESULT_FILENAME), 'w') as f:
+                json.dump({'result' : bool(result), 'output' : output,
+                           'time' : time.time(), 'fields' : fields}, f)
+
+        self._store('result', key, write)
+
+    def entries(self):
+        """ Returns a list of (last used time, size, folder) of all entries """
+        entries = []
+        for kind in ('expect', 'result'):
+            kind_folder = os.path.join(self.folder, kind)
+            if not os.path.isdir(kind_folder):
+                continue
+            for key in os.listdir(kind_folder):
+                entry = os.path.join(kind_folder, key)
+                if key.endswith('.tmp'):
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, name))
+                               for name in os.listdir(entry))
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    # Removed by another job
+                    pass
+        return entries
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in
+            max_size, returns the number removed
+        """
+        entries = self.entries()
+        total = sum(size for (used, size, entry) in entries)
+        removed = 0
+        for (used, size, entry) in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,572 @@
+#!/usr/bin/env python
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Pure Python stand-in for xsim
+#
+# Runs SimThreads (Clock, UsbPhy, UsbMonitor ...) without the XMOS tools, so
+# the packet and PHY layers can be tried out and unit tested on any machine.
+# It is a functional stand-in only: threads still run in Python, so while
+# packets are on the bus it simulates tens of thousands of 60MHz cycles per
+# second, not a speed to run long soaks or to compare with xsim.
+# Call install() before importing the harness modules: if xmostest can't be
+# imported it provides a module with just SimThread.
+#
+# Simulator is a discrete event scheduler over named port pins. Threads
+# blocked in wait_until() are kept in a heap by wake up time. Threads blocked
+# in wait() have their condition evaluated after every event, and again
+# until the pins stop changing and no woken thread waits again (delta
+# cycles). wait() always hands control to the simulator first, so a
+# condition that holds already is seen after the other threads due at the
+# same time have run, and the thread continues at that time.
+#
+# By default (native_clocks) a Clock isn't run as a thread and its edges are
+# not events: before the threads due at a time run, the simulator moves each
+# clock on to that time with toggle(edge_index(t)). Time only steps to each
+# clock edge while a wait() condition is pending, as a condition such as
+# clock.is_high() can change with time alone. A thread that waits for a
+# clock edge with wait_until(clock.next_edge_time()) (ClockedThread) and the
+# pin waits of wait_for_pin() don't need that, so the clock costs nothing
+# while no thread is waiting on it.
+#
+# The DUT is another SimThread on the same pins, such as LoopbackDut, which
+# sends every packet from the host back, or ScriptedDut, which drives a
+# list of pin changes.
+#
+# Threads are greenlets when the greenlet module is installed (it is listed
+# in requirements.txt as optional), otherwise Python threads that hand
+# control to each other, which take about twice as long.
+#
+#   python sim_local.py --packets 1000
+#
+# runs a Clock, a UsbPhy and a LoopbackDut, checks that every packet comes
+# back and prints how much the simulator had to do to get there.
+
+import argparse
+import heapq
+import random
+import sys
+import threading
+import time
+import types
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
+
+from usb_ports import USB_PORTS
+
+PS_PER_NS = 1000
+
+# Passes of wait() conditions at one time before time is forced on
+MAX_DELTA_CYCLES = 1000
+
+def install():
+    """ Provides xmostest.SimThread if the XMOS tools aren't installed """
+    try:
+        import xmostest
+    except ImportError:
+        module = types.ModuleType('xmostest')
+        module.SimThread = SimThread
+        module.__doc__ = "SimThread from sim_local, xmostest is not installed"
+        sys.modules['xmostest'] = module
+
+class SimThread(object):
+    """ Base of the threads when xmostest isn't installed. As with xmostest,
+        wait(), wait_until() and wait_for_pin() are methods, so they can be
+        wrapped (e.g. by HarnessProfiler) before the thread is run. The
+        Simulator gives each thread its xsi and task when it is run.
+    """
+
+    xsi = None
+    _task = None
+
+    def run(self):
+        pass
+
+    def wait_until(self, t):
+        """ Blocks until the time t (ns) """
+        self._task.sim._wait_until(self._task, t)
+
+    def wait(self, f):
+        """ Blocks until f(xsi) holds """
+        self._task.sim._wait(self._task, f, None)
+
+    def wait_for_pin(self, port, value):
+        """ Like wait(), for a condition on a pin only """
+        self._task.sim._wait(self._task, None, (port, value))
+
+
+class _Terminate(BaseException):
+    """ Unwinds a thread when the simulation ends """
+
+
+class _ThreadTask(object):
+    """ Runs a SimThread on a Python thread, one thread at a time """
+
+    def __init__(self, sim, thread):
+        self.sim = sim
+        self.thread = thread
+        self.done = False
+        self._go = threading.Lock()
+        self._go.acquire()
+        self._os_thread = threading.Thread(target=self._main)
+        self._os_thread.daemon = True
+        self._os_thread.start()
+
+    def _main(self):
+        self._go.acquire()
+        try:
+            if not self.sim.terminated:
+                self.thread.run()
+        except _Terminate:
+            pass
+        except BaseException:
+            self.sim.error = sys.exc_info()
+        finally:
+            self.done = True
+            self.sim._yield.release()
+
+    def resume(self):
+        self._go.release()
+        self.sim._yield.acquire()
+
+    def block(self):
+        self.sim._yield.release()
+        self._go.acquire()
+        if self.sim.terminated:
+            raise _Terminate()
+
+    def join(self):
+        self._os_thread.join()
+
+
+class _GreenletTask(object):
+    """ Runs a SimThread on a greenlet """
+
+    def __init__(self, sim, thread):
+        self.sim = sim
+        self.thread = thread
+        self.done = False
+        self._greenlet = greenlet.greenlet(self._main, sim._main_greenlet)
+
+    def _main(self):
+        try:
+            if not self.sim.terminated:
+                self.thread.run()
+        except _Terminate:
+            pass
+        except BaseException:
+            self.sim.error = sys.exc_info()
+        finally:
+            self.done = True
+
+    def resume(self):
+        self._greenlet.switch()
+
+    def block(self):
+        self.sim._main_greenlet.switch()
+        if self.sim.terminated:
+            raise _Terminate()
+
+    def join(self):
+        pass
+
+
+class LocalXsi(object):
+    """ The xsi of the threads """
+
+    def __init__(self, sim):
+        self._sim = sim
+        self._pins = sim.pins
+
+    def get_time(self):
+        return self._sim.time
+
+    def drive_port_pins(self, port, value):
+        if self._pins.get(port) != value:
+            self._pins[port] = value
+            self._sim.pins_changed = True
+
+    def sample_port_pins(self, port):
+        return self._pins.get(port, 0)
+
+    def terminate(self):
+        self._sim.terminate()
+
+
+class Simulator(object):
+    """ Runs threads until one calls xsi.terminate(), nothing is left to
+        happen or the time passes max_time (ns). With capture_output, what
+        the threads print is kept in output rather than printed. With
+        native_clocks, threads with begin() and toggle() (Clock) are kept up
+        to date by the simulator rather than run.
+    """
+
+    def __init__(self, threads, max_time=None, capture_output=False, use_greenlet=None,
+                 native_clocks=True):
+        if use_greenlet is None:
+            use_greenlet = greenlet is not None
+        elif use_greenlet and greenlet is None:
+            raise ImportError("The greenlet module is not installed")
+        self.threads = threads
+        self.max_time = max_time
+        self.capture_output = capture_output
+        self.use_greenlet = use_greenlet
+        self.native_clocks = native_clocks
+        self.time = 0.0
+        self.pins = {}
+        self.pins_changed = False
+        self.terminated = False
+        self.error = None
+        self.output = []
+        self.events = 0
+        # Evaluations of wait() conditions
+        self.conditions = 0
+        self.xsi = LocalXsi(self)
+        self.clocks = []
+        self._clock_ports = set()
+        # Time (ps) of the next edge of each of the clocks
+        self._clock_next = []
+        self._heap = []
+        self._seq = 0
+        self._waiters = []
+        self._current = None
+
+    def terminate(self):
+        self.terminated = True
+        if self._current is not None:
+            raise _Terminate()
+
+    def _schedule(self, task, t):
+        self._seq += 1
+        heapq.heappush(self._heap, (max(t, self.time), self._seq, task))
+
+    def _wait_until(self, task, t):
+        self._schedule(task, t)
+        task.block()
+
+    def _wait(self, task, f, pin):
+        self._waiters.append((task, f, pin))
+        task.block()
+
+    def _bind(self, task):
+        """ Gives the thread its xsi and task. The SimThread of a real
+            xmostest has no task to delegate to, so it is given wait(),
+            wait_until() and wait_for_pin() of its own.
+        """
+        sim = self
+        thread = task.thread
+        thread.xsi = self.xsi
+        thread._task = task
+        if isinstance(thread, SimThread):
+            return
+
+        thread.wait_until = lambda t: sim._wait_until(task, t)
+        thread.wait = lambda f: sim._wait(task, f, None)
+        thread.wait_for_pin = lambda port, value: sim._wait(task, None, (port, value))
+
+    def _resume(self, task):
+        self.events += 1
+        self._current = task
+        task.resume()
+        self._current = None
+
+    def _sync_clocks(self):
+        """ Moves the native clocks on to the current time """
+        t = int(round(self.time * PS_PER_NS))
+        clock_next = self._clock_next
+        for (i, clock) in enumerate(self.clocks):
+            if t >= clock_next[i]:
+                edge = clock.edge_index(t)
+                clock.toggle(edge)
+                clock_next[i] = clock.edge_time(edge + 1)
+
+    def _clock_waiters(self):
+        """ Whether a pending wait() could depend on a native clock """
+        ports = self._clock_ports
+        for (task, f, pin) in self._waiters:
+            if f is not None or pin[0] in ports:
+                return True
+        return False
+
+    def _next_clock_edge(self):
+        return float(min(self._clock_next)) / PS_PER_NS
+
+    def _settle(self):
+        """ Wakes the threads whose conditions hold, until no pin changes
+            and no thread woken starts a new wait()
+        """
+        xsi = self.xsi
+        for i in xrange(MAX_DELTA_CYCLES):
+            if not self._waiters or self.terminated:
+                return
+            self.pins_changed = False
+            waiters = self._waiters
+            self._waiters = []
+            ready = []
+            for waiter in waiters:
+                (task, f, pin) = waiter
+                self.conditions += 1
+                if f is not None:
+                    holds = f(xsi)
+                else:
+                    holds = xsi.sample_port_pins(pin[0]) == pin[1]
+                if holds:
+                    ready.append(task)
+                else:
+                    self._waiters.append(waiter)
+            blocked = len(self._waiters)
+            for task in ready:
+                if self.terminated:
+                    return
+                self._resume(task)
+            # A new wait() may already hold, check it at this time too
+            if not self.pins_changed and len(self._waiters) == blocked:
+                return
+
+    def run(self):
+        """ Returns the time the simulation ended at """
+        if self.use_greenlet:
+            self._main_greenlet = greenlet.getcurrent()
+            task_class = _GreenletTask
+        else:
+            self._yield = threading.Lock()
+            self._yield.acquire()
+            task_class = _ThreadTask
+
+        tasks = []
+        for thread in self.threads:
+            if self.native_clocks and hasattr(thread, 'toggle') and hasattr(thread, 'begin'):
+                thread.xsi = self.xsi
+                thread.begin()
+                self.clocks.append(thread)
+                self._clock_next.append(thread.edge_time(1))
+                self._clock_ports.add(thread._port)
+                continue
+            task = task_class(self, thread)
+            self._bind(task)
+            tasks.append(task)
+            self._schedule(task, 0.0)
+
+        stdout = sys.stdout
+        if self.capture_output:
+            sys.stdout = _OutputLines(self.output)
+        try:
+            self._run()
+        finally:
+            sys.stdout = stdout
+            # Unwind the threads still waiting
+            self.terminated = True
+            for task in tasks:
+                if not task.done:
+                    task.resume()
+                task.join()
+
+        if self.error:
+            (error_type, error, tb) = self.error
+            raise error_type, error, tb
+        return self.time
+
+    def _run(self):
+        while not self.terminated:
+            next_time = self._heap[0][0] if self._heap else None
+            if self.clocks and self._waiters and self._clock_waiters():
+                edge = self._next_clock_edge()
+                if next_time is None or edge < next_time:
+                    next_time = edge
+            if next_time is None:
+                # Nothing left to happen
+                return
+            if self.max_time is not None and next_time > self.max_time:
+                self.time = self.max_time
+                return
+
+            self.time = next_time
+            if self.clocks:
+                self._sync_clocks()
+            heap = self._heap
+            while heap and heap[0][0] <= next_time and not self.terminated:
+                self._resume(heapq.heappop(heap)[2])
+            if self.error:
+                return
+            self._settle()
+            if self.error:
+                return
+
+
+class _OutputLines(object):
+    """ File that collects what is written to it as lines """
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._partial = ''
+
+    def write(self, data):
+        data = self._partial + data
+        parts = data.split('\n')
+        self._partial = parts.pop()
+        self._lines.extend(parts)
+
+    def flush(self):
+        pass
+
+
+class _ClockedDut(SimThread):
+    """ Waits on the edges of a Clock like ClockedThread """
+
+    def __init__(self, clock):
+        self._clock = clock
+
+    def wait_rising_edge(self):
+        clock = self._clock
+        for high in (False, True):
+            while clock.is_high() != high:
+                edge_time = clock.next_edge_time()
+                if edge_time is None:
+                    self.wait(lambda x: clock.is_high() == high)
+                else:
+                    self.wait_until(edge_time)
+
+
+def loopback_response(data):
+    """ The packet back as the DUT sends it: the PHY presents the PID of a
+        received packet without its check nibble
+    """
+    if not data:
+        return None
+    response = bytearray(data)
+    response[0] = (data[0] & 0xf) | ((~data[0] & 0xf) << 4)
+    return response
+
+
+class LoopbackDut(_ClockedDut):
+    """ DUT that receives each packet from the host and, turnaround clocks
+        after its end, sends back respond_fn(bytes) if that isn't None (by
+        default loopback_response()). ports are names as in
+        usb_ports.USB_PORTS.
+    """
+
+    def __init__(self, ports, clock, turnaround=4, respond_fn=None):
+        super(LoopbackDut, self).__init__(clock)
+        self._ports = ports
+        self._turnaround = turnaround
+        self._respond_fn = respond_fn or loopback_response
+        self.received = []
+
+    def run(self):
+        xsi = self.xsi
+        rxa = self._ports['rxa']
+        rxdv = self._ports['rxdv']
+        rxd = self._ports['rxd']
+        txv = self._ports['txv']
+        txd = self._ports['txd']
+        txrdy = self._ports['txrdy']
+
+        while True:
+            self.wait_for_pin(rxa, 1)
+            data = bytearray()
+            while xsi.sample_port_pins(rxa) == 1:
+                self.wait_rising_edge()
+                if xsi.sample_port_pins(rxa) == 1 and xsi.sample_port_pins(rxdv) == 1:
+                    data.append(xsi.sample_port_pins(rxd) & 0xff)
+            self.received.append(data)
+
+            response = self._respond_fn(data)
+            if not response:
+                continue
+            for i in range(self._turnaround):
+                self.wait_rising_edge()
+
+            # A byte is taken on each rising edge TXRDY is high
+            xsi.drive_port_pins(txv, 1)
+            for byte in bytearray(response):
+                xsi.drive_port_pins(txd, byte)
+                self.wait_rising_edge()
+                while xsi.sample_port_pins(txrdy) != 1:
+                    self.wait_rising_edge()
+            xsi.drive_port_pins(txv, 0)
+
+
+class ScriptedDut(SimThread):
+    """ DUT that drives a list of (time in ns, port, value) """
+
+    def __init__(self, script):
+        self._script = sorted(script, key=lambda event: event[0])
+
+    def run(self):
+        for (t, port, value) in self._script:
+            self.wait_until(t)
+            self.xsi.drive_port_pins(port, value)
+
+
+def make_loopback_sim(packets, arch='xs2', turnaround=4, native_clock=True,
+                      edge_scheduled=True, **kwargs):
+    """ Returns (simulator, clock, phy, dut) running packets through a
+        UsbPhy against a LoopbackDut. The simulation ends when the PHY has
+        been through the packets. edge_scheduled is passed to the UsbPhy.
+    """
+    install()
+    from usb_clock import Clock
+    from usb_phy import UsbPhy
+
+    ports = USB_PORTS[arch]
+    clock = Clock(ports['clk'], Clock.CLK_60MHz)
+    phy = UsbPhy(ports['rxd'], ports['rxa'], ports['rxdv'], ports['rxer'], ports['vld'],
+                 ports['txd'], ports['txv'], ports['txrdy'], clock,
+                 verbose=False, do_timeout=False, expect_loopback=False,
+                 edge_scheduled=edge_scheduled,
+                 complete_fn=lambda phy: phy.xsi.terminate())
+    phy.set_packets(packets)
+    dut = LoopbackDut(ports, clock, turnaround)
+    return (Simulator([clock, phy, dut], native_clocks=native_clock, **kwargs), clock, phy, dut)
+
+def loopback_packets(num_packets, data_len, seed=1, gap=500):
+    """ DATA packets from the host, gap ns apart, each followed by the same
+        packet back
+    """
+    install()
+    from usb_packet import TxDataPacket, RxDataPacket
+
+    rand = random.Random()
+    rand.seed(seed)
+    packets = []
+    pid = 0x3 #DATA0
+    for i in range(num_packets):
+        packet = TxDataPacket(rand, length=data_len, pid=pid, data_random=True,
+                              inter_pkt_gap=gap)
+        packets.append(packet)
+        packets.append(RxDataPacket(rand, data=packet.data_bytes, pid=pid, timeout=20))
+        pid ^= 8
+    return packets
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Run UsbPhy against a loopback DUT without xsim")
+    argparser.add_argument('--packets', type=int, default=100, help='Number of packets to loop back')
+    argparser.add_argument('--data-len', type=int, default=64, help='Data bytes per packet')
+    argparser.add_argument('--gap', type=int, default=500, help='Idle time before each packet from the host in ns')
+    argparser.add_argument('--arch', choices=['xs1', 'xs2'], type=str, default='xs2', help='Port map')
+    argparser.add_argument('--threaded-clock', action='store_true', help='Run the clock as a thread rather than natively')
+    argparser.add_argument('--phy-polling', action='store_true', help='Drive the PHY by polling the clock every step rather than scheduling on clock edges')
+    argparser.add_argument('--no-greenlet', action='store_true', help='Use Python threads even if greenlet is installed')
+    args = argparser.parse_args()
+
+    packets = loopback_packets(args.packets, args.data_len, gap=args.gap)
+    (sim, clock, phy, dut) = make_loopback_sim(packets, args.arch,
+                                               native_clock=not args.threaded_clock,
+                                               edge_scheduled=not args.phy_polling,
+                                               capture_output=True,
+                                               use_greenlet=False if args.no_greenlet else None)
+    start = time.time()
+    sim_time = sim.run()
+    wall_time = time.time() - start
+
+    errors = [line for line in sim.output if line.startswith('ERROR')]
+    for line in errors[:10]:
+        print line
+    print "{} packets looped back, {} errors".format(len(dut.received), len(errors))
+    print "{:.0f}us simulated in {:.2f}s: {} events, {} conditions ({})".format(
+        sim_time / 1000, wall_time, sim.events, sim.conditions,
+        'greenlets' if sim.use_greenlet else 'threads')
+    sys.exit(1 if errors else 0)
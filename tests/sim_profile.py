@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Cycle profiler over xsim instruction traces
+#
+# Streams a trace written with --trace-to and --enable-fnop-tracing (as
+# runtests.py --trace does, plain or gzip compressed) and attributes the time
+# to the next issue of each logical core to the instruction issued, by core,
+# function and label. FNOPs are counted against the label they stall.
+#
+# Without a symbol table the function and label are both the symbol xsim
+# prints for the instruction. Given the output of 'nm' for the binary
+# (--symbols), global symbols are functions and every symbol is a label, so
+# the assembler labels of XUD_IoLoop.S, XUD_TokenJmp.S and so on show up
+# under the function they are in.
+#
+# Markers on port instructions measure the DUT turnaround: an interval opens
+# on an input from the RXD port (token receipt) and closes on the next output
+# to the TXD port on the same core (handshake). The worst intervals are
+# reported with the labels they went through.
+#
+# Writes <out>.folded (core;function;label weight, as taken by flamegraph.pl
+# and speedscope), <out>_turnaround.folded (the same for the instructions
+# inside turnaround intervals) and <out>.json.
+#
+#   python sim_profile.py logs/xsim_trace_test_bulk_rx_basic_60Mhz_xs2.txt --arch xs2
+
+import argparse
+import bisect
+import gzip
+import json
+import re
+import sys
+
+from sim_trace import INSTRUCTION_TIME, INSTRUCTION_TIME_UNIT
+from usb_ports import USB_PORTS
+
+DEFAULT_CORE_MHZ = 500
+DEFAULT_WORST = 10
+
+TRACE_CORE = re.compile(br'^\s*(tile\[\d+\])@(\d+)')
+TRACE_SYMBOL = re.compile(br'([0-9a-fA-F]{8})?\s*\(\s*([^\s+)]+)\s*\+\s*(?:0x)?[0-9a-fA-F]+\s*\)')
+TRACE_FNOP = re.compile(br'\bFNOP\b', re.IGNORECASE)
+TRACE_MNEMONIC = re.compile(br':\s*([a-z][a-z0-9_]*)')
+
+INPUT_MNEMONICS = (b'in', b'inpw', b'int', b'inct', b'inshr')
+OUTPUT_MNEMONICS = (b'out', b'outpw', b'outt', b'outct', b'outshr')
+
+UNKNOWN_SYMBOL = '??'
+
+# Resource IDs of the 1-bit ports, which are not in order (as in xs1.h)
+PORT_1_RESOURCE_IDS = {'A' : 0x10200, 'B' : 0x10000, 'C' : 0x10600, 'D' : 0x10400,
+                       'E' : 0x10a00, 'F' : 0x10800, 'G' : 0x10e00, 'H' : 0x10c00,
+                       'I' : 0x11200, 'J' : 0x11000, 'K' : 0x11600, 'L' : 0x11400,
+                       'M' : 0x11a00, 'N' : 0x11800, 'O' : 0x11e00, 'P' : 0x11c00}
+
+# Resource ID of the first of the wider ports of each width, and the number
+# of them. They follow on 0x100 apart.
+PORT_RESOURCE_BASES = {4 : (0x40000, 6), 8 : (0x80000, 4), 16 : (0x100000, 4), 32 : (0x200000, 2)}
+
+def port_resource_id(port):
+    """ Resource ID of a port such as 'tile[0]:XS1_PORT_8B' """
+    match = re.match(r'(?:.*:)?XS1_PORT_(\d+)([A-P])$', port)
+    if match:
+        (width, letter) = (int(match.group(1)), match.group(2))
+        if width == 1:
+            return PORT_1_RESOURCE_IDS[letter]
+        if width in PORT_RESOURCE_BASES:
+            (base, count) = PORT_RESOURCE_BASES[width]
+            index = ord(letter) - ord('A')
+            if index < count:
+                return base + index * 0x100
+    raise ValueError("Unknown port '{}'".format(port))
+
+
+class PortMarker(object):
+    """ Matches trace lines of one of the mnemonics on a port, which xsim
+        shows as the resource ID in the operand values
+    """
+
+    def __init__(self, mnemonics, port):
+        self.mnemonics = mnemonics
+        self.port = port
+        self._resource = re.compile(br'0x0*' + '{:x}'.format(port_resource_id(port)).encode('ascii') + br'\b',
+                                    re.IGNORECASE)
+
+    def matches(self, mnemonic, line):
+        return mnemonic in self.mnemonics and self._resource.search(line) is not None
+
+
+class SymbolTable(object):
+    """ Functions and labels by address, from the output of nm """
+
+    def __init__(self, lines=()):
+        self._functions = []
+        self._labels = []
+        for line in lines:
+            fields = line.split()
+            if len(fields) != 3 or fields[1].lower() not in ('t', 'w'):
+                continue
+            address = int(fields[0], 16)
+            self._labels.append((address, fields[2]))
+            if fields[1].isupper():
+                self._functions.append((address, fields[2]))
+        self._functions.sort()
+        self._labels.sort()
+        self._function_addresses = [address for (address, name) in self._functions]
+        self._label_addresses = [address for (address, name) in self._labels]
+
+    def __len__(self):
+        return len(self._labels)
+
+    @staticmethod
+    def _lookup(addresses, symbols, pc):
+        i = bisect.bisect_right(addresses, pc) - 1
+        return symbols[i][1] if i >= 0 else None
+
+    def lookup(self, pc, symbol):
+        """ (function, label) of pc, falling back to the traced symbol """
+        if pc is None or not self._labels:
+            return (symbol, symbol)
+        return (self._lookup(self._function_addresses, self._functions, pc) or symbol,
+                self._lookup(self._label_addresses, self._labels, pc) or symbol)
+
+
+class Interval(object):
+    """ An open turnaround interval on a core """
+
+    __slots__ = ('start', 'instructions', 'fnops', 'path')
+
+    def __init__(self, start):
+        self.start = start
+        self.instructions = 0
+        self.fnops = 0
+        # The labels passed through, with the instructions issued in each
+        self.path = []
+
+    def add(self, label, fnop):
+        if fnop:
+            self.fnops += 1
+            return
+        self.instructions += 1
+        if self.path and self.path[-1][0] == label:
+            self.path[-1][1] += 1
+        else:
+            self.path.append([label, 1])
+
+
+class Profile(object):
+    """ Per core, function and label: instructions, FNOPs and ns """
+
+    def __init__(self, symbols=None, start_marker=None, end_marker=None, worst=DEFAULT_WORST):
+        self.symbols = symbols or SymbolTable()
+        self.start_marker = start_marker
+        self.end_marker = end_marker
+        self.worst = worst
+        self.lines = 0
+        # (core, function, label) -> [instructions, fnops, ns]
+        self.counts = {}
+        # (core, function, label) -> instructions inside turnaround intervals
+        self.turnaround_counts = {}
+        # Completed intervals: (instructions, fnops, ns, core, start, path)
+        self.intervals = []
+        self.interval_count = 0
+        self._last = {}
+        self._open = {}
+
+    def add_line(self, line):
+        match = TRACE_CORE.match(line)
+        if not match:
+            return
+        time = INSTRUCTION_TIME.search(line)
+        if not time:
+            return
+        time = int(time.group(1)) * INSTRUCTION_TIME_UNIT
+        core = '{}.core{}'.format(match.group(1).decode('ascii'), int(match.group(2)))
+
+        fnop = TRACE_FNOP.search(line) is not None
+        symbol_match = TRACE_SYMBOL.search(line)
+        last = self._last.get(core)
+        if symbol_match:
+            pc = int(symbol_match.group(1), 16) if symbol_match.group(1) else None
+            symbol = symbol_match.group(2).decode('latin-1')
+            key = (core,) + self.symbols.lookup(pc, symbol)
+        elif fnop and last is not None:
+            # A FNOP stalls the code the core is running
+            key = last[0]
+        else:
+            key = (core, UNKNOWN_SYMBOL, UNKNOWN_SYMBOL)
+        label = key[2]
+
+        self.lines += 1
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0, 0, 0.0]
+        counts[1 if fnop else 0] += 1
+
+        # The time until this core's next issue goes to its last instruction
+        if last is not None:
+            self.counts[last[0]][2] += time - last[1]
+        self._last[core] = (key, time)
+
+        interval = self._open.get(core)
+        if interval is not None:
+            interval.add(label, fnop)
+            if not fnop:
+                self.turnaround_counts[key] = self.turnaround_counts.get(key, 0) + 1
+
+        if fnop or not (self.start_marker or self.end_marker):
+            return
+        mnemonic_match = TRACE_MNEMONIC.search(line, symbol_match.end() if symbol_match else 0)
+        mnemonic = mnemonic_match.group(1) if mnemonic_match else None
+        if interval is None and self.start_marker and self.start_marker.matches(mnemonic, line):
+            interval = self._open[core] = Interval(time)
+            interval.add(label, fnop)
+            self.turnaround_counts[key] = self.turnaround_counts.get(key, 0) + 1
+        elif interval is not None and self.end_marker and self.end_marker.matches(mnemonic, line):
+            del self._open[core]
+            self._close(core, interval, time)
+
+    def _close(self, core, interval, time):
+        self.interval_count += 1
+        record = (interval.instructions, interval.fnops, time - interval.start, core,
+                  interval.start, interval.path)
+        # Keep only the worst few
+        if len(self.intervals) < self.worst or record[:3] > self.intervals[-1][:3]:
+            self.intervals.append(record)
+            self.intervals.sort(key=lambda record: record[:3], reverse=True)
+            del self.intervals[self.worst:]
+
+    def folded(self, weight='cycles', core_mhz=DEFAULT_CORE_MHZ):
+        """ Lines of 'core;function;label weight' """
+        lines = []
+        for ((core, function, label), (instructions, fnops, ns)) in sorted(self.counts.items()):
+            if weight == 'instructions':
+                value = instructions
+            elif weight == 'fnops':
+                value = fnops
+            else:
+                value = int(round(ns * core_mhz / 1000.0))
+            if value:
+                lines.append('{};{};{} {}'.format(core, function, label, value))
+        return lines
+
+    def turnaround_folded(self):
+        return ['{};{};{} {}'.format(core, function, label, count)
+                for ((core, function, label), count) in sorted(self.turnaround_counts.items())]
+
+    def summary(self, core_mhz=DEFAULT_CORE_MHZ):
+        cores = {}
+        for ((core, function, label), (instructions, fnops, ns)) in self.counts.items():
+            functions = cores.setdefault(core, {})
+            entry = functions.setdefault(function, {'instructions' : 0, 'fnops' : 0,
+                                                    'ns' : 0.0, 'labels' : {}})
+            entry['instructions'] += instructions
+            entry['fnops'] += fnops
+            entry['ns'] += ns
+            entry['labels'][label] = {'instructions' : instructions, 'fnops' : fnops, 'ns' : ns,
+                                      'cycles' : int(round(ns * core_mhz / 1000.0))}
+        for functions in cores.values():
+            for entry in functions.values():
+                entry['cycles'] = int(round(entry['ns'] * core_mhz / 1000.0))
+        return {'lines' : self.lines,
+                'core_mhz' : core_mhz,
+                'cores' : cores,
+                'turnaround' : {
+                    'start' : self.start_marker.port if self.start_marker else None,
+                    'end' : self.end_marker.port if self.end_marker else None,
+                    'count' : self.interval_count,
+                    'worst' : [{'instructions' : instructions, 'fnops' : fnops, 'ns' : ns,
+                                'core' : core, 'start' : start, 'path' : path}
+                               for (instructions, fnops, ns, core, start, path) in self.intervals]}}
+
+def open_trace(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+def profile_trace(filename, symbols=None, start_marker=None, end_marker=None, worst=DEFAULT_WORST):
+    """ Profiles the trace in filename, returns the Profile """
+    profile = Profile(symbols, start_marker, end_marker, worst)
+    with open_trace(filename) as f:
+        try:
+            for line in f:
+                profile.add_line(line)
+        except (EOFError, IOError):
+            # A compressed trace cut short by its budget
+            pass
+    return profile
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Profile an xsim instruction trace by core, function and label")
+    argparser.add_argument('trace', type=str, help='Trace written by xsim --trace-to (may be .gz)')
+    argparser.add_argument('--symbols', type=str, help="Output of 'nm' for the binary, to group labels into functions")
+    argparser.add_argument('--arch', choices=['xs1', 'xs2'], type=str, default='xs2', help='Port map for the turnaround markers')
+    argparser.add_argument('--no-markers', action='store_true', help="Don't measure turnaround intervals")
+    argparser.add_argument('--weight', choices=['cycles', 'instructions', 'fnops'], type=str, default='cycles', help='Weight of the flame graph stacks')
+    argparser.add_argument('--core-mhz', type=float, default=DEFAULT_CORE_MHZ, help='Core clock to convert time to cycles')
+    argparser.add_argument('--worst', type=int, default=DEFAULT_WORST, help='Number of worst turnaround intervals to report')
+    argparser.add_argument('--out', type=str, help='Output file prefix (default the trace name)')
+    args = argparser.parse_args()
+
+    symbols = None
+    if args.symbols:
+        with open(args.symbols) as f:
+            symbols = SymbolTable(f)
+
+    start_marker = end_marker = None
+    if not args.no_markers:
+        start_marker = PortMarker(INPUT_MNEMONICS, USB_PORTS[args.arch]['rxd'])
+        end_marker = PortMarker(OUTPUT_MNEMONICS, USB_PORTS[args.arch]['txd'])
+
+    profile = profile_trace(args.trace, symbols, start_marker, end_marker, args.worst)
+
+    out = args.out or re.sub(r'(\.txt)?(\.gz)?$', '', args.trace)
+    with open(out + '.folded', 'w') as f:
+        f.write(''.join(line + '\n' for line in profile.folded(args.weight, args.core_mhz)))
+    with open(out + '_turnaround.folded', 'w') as f:
+        f.write(''.join(line + '\n' for line in profile.turnaround_folded()))
+    summary = profile.summary(args.core_mhz)
+    with open(out + '.json', 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+
+    print "{} trace lines on {} cores".format(profile.lines, len(summary['cores']))
+    for (core, functions) in sorted(summary['cores'].items()):
+        print core
+        for (function, entry) in sorted(functions.items(), key=lambda item: -item[1]['cycles'])[:10]:
+            print "  {:<40} {:>12} cycles {:>10} instructions {:>8} FNOPs".format(
+                function, entry['cycles'], entry['instructions'], entry['fnops'])
+    turnaround = summary['turnaround']
+    if turnaround['count']:
+        print "{} turnarounds ({} to {}), worst:".format(turnaround['count'],
+                                                        turnaround['start'], turnaround['end'])
+        for interval in turnaround['worst']:
+            print "  {instructions} instructions, {fnops} FNOPs, {ns:.0f}ns on {core} at {start:.0f}ns".format(**interval)
+            print "    " + " -> ".join("{}({})".format(label, count) for (label, count) in interval['path'])
+    sys.stdout.flush()
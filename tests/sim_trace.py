@@ -0,0 +1,400 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Windowed, compressed simulator traces
+#
+# xsim writes its instruction trace (--trace-to) and VCD (--vcd-tracing) to
+# named pipes instead of files. A reader thread per trace parses the time of
+# each line and keeps only:
+#
+#   window  the lines between a start and an end time. The times can be given
+#           up front (TraceWindow(start, end)) or set while the simulation
+#           runs, by UsbPhy at the start of the first and the end of the last
+#           packet of a range (TraceWindow(packets=(first, last))).
+#   ring    the last ring ns of lines before the first error UsbPhy reports.
+#           Nothing is written if there is no error.
+#
+# What is kept is written through gzip (or zstd, if the zstandard module is
+# installed) and the compressed file never grows past the byte budget; the
+# rest of the trace is read and dropped so the simulator never blocks.
+#
+# A VCD written from part of a run starts with the header and a $dumpvars of
+# every signal's value at the start of the kept part, so it opens as normal.
+#
+# Where named pipes aren't available the traces go to temporary files that
+# are filtered the same way after the run.
+
+import gzip
+import os
+import re
+import tempfile
+import threading
+import zlib
+from collections import deque
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Instruction trace lines end with @<time>, in ns as from xsi.get_time()
+INSTRUCTION_TIME = re.compile(br'@(\d+)\s*$')
+INSTRUCTION_TIME_UNIT = 1.0
+
+VCD_TIME_UNITS = {b's' : 1e9, b'ms' : 1e6, b'us' : 1e3, b'ns' : 1.0, b'ps' : 1e-3, b'fs' : 1e-6}
+
+COMPRESSORS = ('none', 'gzip', 'zstd')
+COMPRESSED_EXTENSIONS = {'none' : '', 'gzip' : '.gz', 'zstd' : '.zst'}
+
+DEFAULT_BUDGET = 64 << 20
+
+# Compressed output is synced every SYNC_BYTES of input (less for small
+# budgets), so the size of the file is known to within the data written
+# since. Deflate and zstd expand incompressible data by well under
+# SYNC_SLACK.
+SYNC_BYTES = 256 << 10
+SYNC_SLACK = 4096
+
+# While the start of a packet window isn't known yet, lines are held for up
+# to LAG_SPAN ns (the trace can run slightly ahead of the Python threads).
+# No ring or lag buffer holds more than MAX_BUFFER_BYTES.
+LAG_SPAN = 20000
+MAX_BUFFER_BYTES = 64 << 20
+
+def parse_range(spec, convert=float):
+    """ Parses 'start:end' where either may be empty, e.g. '100:' """
+    (start, sep, end) = spec.partition(':')
+    if not sep:
+        raise ValueError("Range '{}' must be start:end".format(spec))
+    return (convert(start) if start else None, convert(end) if end else None)
+
+
+class TraceWriter(object):
+    """ Writes bytes to filename, compressed with compressor, stopping before
+        the file would exceed budget bytes
+    """
+
+    def __init__(self, filename, compressor='gzip', budget=DEFAULT_BUDGET):
+        if compressor == 'zstd' and zstandard is None:
+            raise ValueError("zstd trace compression needs the zstandard module")
+        self.filename = filename
+        self.budget = budget
+        self.truncated = False
+        self.bytes_in = 0
+        self._file = open(filename, 'wb')
+        self._pending = 0
+        self._sync_bytes = max(SYNC_SLACK, min(SYNC_BYTES, budget // 16))
+        if compressor == 'gzip':
+            self._stream = gzip.GzipFile(fileobj=self._file, mode='wb')
+            self._sync = lambda: self._stream.flush(zlib.Z_SYNC_FLUSH)
+        elif compressor == 'zstd':
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._file)
+            self._sync = lambda: self._stream.flush(zstandard.FLUSH_BLOCK)
+        else:
+            self._stream = self._file
+            self._sync = lambda: None
+
+    def write(self, data):
+        """ Returns False (and writes nothing more) once the budget is used """
+        if self.truncated:
+            return False
+        if self._file.tell() + self._pending + len(data) + SYNC_SLACK > self.budget:
+            self.truncated = True
+            return False
+        self._stream.write(data)
+        self.bytes_in += len(data)
+        self._pending += len(data)
+        if self._pending >= self._sync_bytes:
+            self._sync()
+            self._pending = 0
+        return True
+
+    def close(self):
+        if self._stream is not self._file:
+            self._stream.close()
+        if not self._file.closed:
+            self._file.close()
+
+
+class TraceWindow(object):
+    """ What part of the trace to keep: a window (start/end ns, or a range of
+        packets whose times UsbPhy fills in) or, with ring, the last ring ns
+        before the first error
+    """
+
+    def __init__(self, start=None, end=None, packets=None, ring=None):
+        self.start = start
+        self.end = end
+        self.packets = packets
+        self.ring = ring
+        self.error_time = None
+        if packets is not None:
+            (self._first, self._last) = packets
+            self.start = None if self._first else 0
+            self.end = None
+
+    def waiting(self):
+        """ True while the start of a packet window isn't known yet """
+        return self.packets is not None and self.start is None
+
+    def packet_start(self, index, time):
+        if self.packets is not None and index == self._first:
+            self.start = time
+
+    def packet_end(self, index, time):
+        if self.packets is not None and index == self._last:
+            self.end = time
+
+    def error(self, time):
+        if self.error_time is None:
+            self.error_time = time
+
+
+class TraceFilter(object):
+    """ Takes timestamped records of a trace in time order and writes the
+        ones TraceWindow selects
+    """
+
+    def __init__(self, writer, window):
+        self.writer = writer
+        self.window = window
+        self._header = b''
+        self._buffer = deque()
+        self._buffer_bytes = 0
+        self._started = False
+        self._done = False
+
+    def write_header(self, data):
+        """ Written before the first record kept (or at the end in window
+            mode if there is none)
+        """
+        self._header = data
+
+    def feed(self, time, record):
+        if self._done:
+            return
+        window = self.window
+
+        if window.ring is not None:
+            if window.error_time is not None and time > window.error_time:
+                self._flush()
+                self._done = True
+                return
+            self._hold(time, record, window.ring)
+            return
+
+        if window.waiting():
+            self._hold(time, record, LAG_SPAN)
+            return
+
+        if window.start is not None and time < window.start:
+            self._hold(time, record, 0)
+            return
+
+        if window.end is not None and time > window.end:
+            self._done = True
+            return
+
+        if self._buffer:
+            self._flush()
+        self._emit(time, record)
+
+    def finish(self):
+        """ End of the trace """
+        window = self.window
+        if not self._done:
+            if window.ring is not None:
+                if window.error_time is not None:
+                    self._flush()
+            elif not window.waiting():
+                self._flush()
+        if not self._started and window.ring is None:
+            self._started = True
+            self.writer.write(self._header)
+        self._done = True
+
+    def _hold(self, time, record, span):
+        self._buffer.append((time, record))
+        self._buffer_bytes += len(record)
+        buffer = self._buffer
+        while buffer and (buffer[0][0] < time - span or self._buffer_bytes > MAX_BUFFER_BYTES):
+            (old_time, old_record) = buffer.popleft()
+            self._buffer_bytes -= len(old_record)
+            self.discard(old_time, old_record)
+
+    def _flush(self):
+        """ Writes the held records that are in the window """
+        start = self.window.start if self.window.ring is None else None
+        while self._buffer:
+            (time, record) = self._buffer.popleft()
+            if start is not None and time < start:
+                self.discard(time, record)
+            else:
+                self._emit(time, record)
+        self._buffer_bytes = 0
+
+    def _emit(self, time, record):
+        if not self._started:
+            self._started = True
+            self.writer.write(self._header)
+            record = self.first_record(record)
+        if not self.writer.write(record):
+            self._done = True
+
+    def discard(self, time, record):
+        """ Called for each record dropped before the output starts """
+        pass
+
+    def first_record(self, record):
+        """ Returns what to write for the first record kept """
+        return record
+
+
+class VcdFilter(TraceFilter):
+    """ Records are the value changes at one time. The value of every signal
+        is tracked through the dropped records so the output can start with
+        a snapshot.
+    """
+
+    def __init__(self, writer, window):
+        super(VcdFilter, self).__init__(writer, window)
+        self._values = {}
+
+    def discard(self, time, record):
+        values = self._values
+        for line in record.splitlines()[1:]:
+            line = line.strip()
+            if not line or line.startswith(b'$'):
+                continue
+            if line[:1] in b'bBrR':
+                values[line.split()[-1]] = line
+            else:
+                values[line[1:]] = line
+
+    def first_record(self, record):
+        if not self._values:
+            return record
+        # The values dropped so far, after the time line of the record
+        (time_line, sep, changes) = record.partition(b'\n')
+        return (time_line + b'\n$dumpvars\n' +
+                b''.join(line + b'\n' for line in self._values.values()) + b'$end\n' + changes)
+
+
+def filter_instruction_trace(lines, trace_filter):
+    """ Feeds the lines of an instruction trace to trace_filter. Lines with
+        no time take the time of the line before.
+    """
+    time = 0
+    for line in lines:
+        match = INSTRUCTION_TIME.search(line)
+        if match:
+            time = int(match.group(1)) * INSTRUCTION_TIME_UNIT
+        trace_filter.feed(time, line)
+    trace_filter.finish()
+
+def filter_vcd(lines, trace_filter):
+    """ Feeds a VCD to trace_filter: the header as is, then one record per
+        time. Record times are converted to ns, the records keep the
+        original time lines.
+    """
+    header = []
+    lines = iter(lines)
+    for line in lines:
+        header.append(line)
+        if line.strip().startswith(b'$enddefinitions'):
+            break
+    header = b''.join(header)
+    trace_filter.write_header(header)
+
+    unit = 1.0
+    match = re.search(br'\$timescale\s+(\d+)\s*(s|ms|us|ns|ps|fs)\s+\$end', header)
+    if match:
+        unit = int(match.group(1)) * VCD_TIME_UNITS[match.group(2)]
+
+    time = 0
+    record = []
+    for line in lines:
+        if line.startswith(b'#'):
+            if record:
+                trace_filter.feed(time * unit, b''.join(record))
+            time = int(line[1:])
+            record = [line]
+        else:
+            record.append(line)
+    if record:
+        trace_filter.feed(time * unit, b''.join(record))
+    trace_filter.finish()
+
+
+class TraceCapture(object):
+    """ Captures the instruction trace and VCD of one simulator run to
+        basename.txt and basename.vcd (plus the compressed extension)
+    """
+
+    def __init__(self, basename, window, compressor='gzip', budget=DEFAULT_BUDGET):
+        self.window = window
+        ext = COMPRESSED_EXTENSIONS[compressor]
+        # The budget is shared between the two traces
+        self._traces = [
+            ('{}.txt'.format(basename), TraceWriter('{}.txt{}'.format(basename, ext), compressor, budget // 2),
+             filter_instruction_trace, TraceFilter),
+            ('{}.vcd'.format(basename), TraceWriter('{}.vcd{}'.format(basename, ext), compressor, budget // 2),
+             filter_vcd, VcdFilter)]
+        self._tmpdir = tempfile.mkdtemp(prefix='xsim_trace_')
+        self._pipes = hasattr(os, 'mkfifo')
+        self._threads = []
+        self.paths = []
+        for (name, writer, filter_fn, filter_class) in self._traces:
+            path = os.path.join(self._tmpdir, os.path.basename(name))
+            if self._pipes:
+                os.mkfifo(path)
+                thread = threading.Thread(target=self._read, args=(path, writer, filter_fn, filter_class))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self.paths.append(path)
+
+    def _read(self, path, writer, filter_fn, filter_class):
+        try:
+            with open(path, 'rb') as f:
+                filter_fn(f, filter_class(writer, self.window))
+        finally:
+            writer.close()
+
+    def sim_args(self, vcd_args):
+        (trace_path, vcd_path) = self.paths
+        return ['--trace-to', trace_path, '--enable-fnop-tracing',
+                '--vcd-tracing', '-o {} {}'.format(vcd_path, vcd_args)]
+
+    def close(self, timeout=60):
+        """ Waits for the traces to be written. Returns the list of trace
+            files that hit the byte budget.
+        """
+        if self._pipes:
+            for (path, thread) in zip(self.paths, self._threads):
+                if thread.is_alive() and os.path.exists(path):
+                    # Unblock a reader whose pipe the simulator never opened
+                    try:
+                        fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+                        os.close(fd)
+                    except OSError:
+                        pass
+                thread.join(timeout)
+        else:
+            for (path, (name, writer, filter_fn, filter_class)) in zip(self.paths, self._traces):
+                if os.path.exists(path):
+                    self._read(path, writer, filter_fn, filter_class)
+                else:
+                    writer.close()
+
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(self._tmpdir)
+
+        truncated = [writer.filename for (name, writer, f, c) in self._traces if writer.truncated]
+        for (name, writer, f, c) in self._traces:
+            if self.window.ring is not None and not writer.bytes_in:
+                # Ring mode with no error, nothing to keep
+                os.remove(writer.filename)
+        return truncated
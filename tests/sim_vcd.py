@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Streaming reader for the VCDs written by xsim --vcd-tracing
+#
+# The file is read a line at a time, so memory use depends on the number of
+# signals and not on the length of the trace. Only the signals asked for are
+# decoded.
+#
+# A sidecar index (<vcd>.idx) holds a checkpoint every INDEX_STRIDE bytes:
+# the time, the byte offset of its '#time' line and the value of every
+# signal there. Reading from a time seeks to the checkpoint before it (a
+# bisect of the checkpoints) instead of reading from the start. The index is
+# built by the first pass over the file and rebuilt when the VCD changes.
+#
+# USB port signals are extracted into Timelines: the times (ns) at which a
+# signal changed and the values it changed to, as NumPy arrays when NumPy is
+# installed. usb_packets() finds the packets on the bus in the timelines.
+#
+#   python sim_vcd.py logs/xsim_trace_test_bulk_rx_basic_60Mhz_xs2.vcd --arch xs2
+#
+# prints the start, end and length of every packet in the trace as JSON lines.
+# Compressed (.gz) traces from sim_trace.py can be read too, but seeking in
+# them decompresses from the start.
+
+import argparse
+import bisect
+import gzip
+import json
+import os
+import re
+import sys
+from array import array
+
+from usb_ports import USB_PORTS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INDEX_VERSION = 1
+INDEX_EXTENSION = '.idx'
+INDEX_STRIDE = 16 << 20
+
+VCD_TIME_UNITS = {b's' : 1e9, b'ms' : 1e6, b'us' : 1e3, b'ns' : 1.0, b'ps' : 1e-3, b'fs' : 1e-6}
+
+# Value of a signal that is x or z (or has an x or z bit)
+UNKNOWN = -1
+
+def parse_value(value):
+    """ Integer value of a VCD value ('0', '1', '1010', 'x' ...), UNKNOWN if
+        any bit is x or z
+    """
+    try:
+        return int(value, 2)
+    except ValueError:
+        return UNKNOWN
+
+def _split_change(line):
+    """ Returns (id, value) of a value change line, None for anything else """
+    first = line[:1]
+    if first in (b'0', b'1', b'x', b'X', b'z', b'Z'):
+        return (line[1:], line[:1])
+    if first in (b'b', b'B', b'r', b'R'):
+        (value, sep, var_id) = line[1:].partition(b' ')
+        return (var_id.strip(), value)
+    return None
+
+
+class VcdVar(object):
+    """ A $var of the VCD. scope is the list of scopes it is in. """
+
+    __slots__ = ('id', 'name', 'width', 'scope')
+
+    def __init__(self, var_id, name, width, scope):
+        self.id = var_id
+        self.name = name
+        self.width = width
+        self.scope = scope
+
+    @property
+    def path(self):
+        return '.'.join(self.scope + [self.name])
+
+
+class VcdIndex(object):
+    """ Checkpoints of a VCD: a list of times (ns), the offsets of their time
+        lines and the values of all signals at each
+    """
+
+    def __init__(self, size=None, mtime=None, times=None, offsets=None, values=None):
+        self.size = size
+        self.mtime = mtime
+        self.times = times or []
+        self.offsets = offsets or []
+        self.values = values or []
+
+    def add(self, time, offset, values):
+        self.times.append(time)
+        self.offsets.append(offset)
+        self.values.append(dict(values))
+
+    def find(self, time):
+        """ The last checkpoint at or before time, or None """
+        i = bisect.bisect_right(self.times, time) - 1
+        if i < 0:
+            return None
+        return (self.times[i], self.offsets[i], self.values[i])
+
+    def save(self, filename):
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version' : INDEX_VERSION, 'size' : self.size, 'mtime' : self.mtime,
+                       'times' : self.times, 'offsets' : self.offsets,
+                       'values' : [dict((k.decode('latin-1'), v.decode('latin-1'))
+                                        for (k, v) in values.items())
+                                   for values in self.values]}, f)
+        os.rename(tmp, filename)
+
+    @classmethod
+    def load(cls, filename, size, mtime):
+        """ Reads an index, returns None if it is missing or was made from a
+            different version of the VCD
+        """
+        try:
+            with open(filename) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if (index.get('version') != INDEX_VERSION or index['size'] != size or
+                index['mtime'] != mtime):
+            return None
+        values = [dict((k.encode('latin-1'), v.encode('latin-1')) for (k, v) in values.items())
+                  for values in index['values']]
+        return cls(size, mtime, index['times'], index['offsets'], values)
+
+
+class VcdReader(object):
+    """ Reads the header of a VCD on creation. changes() streams the value
+        changes.
+    """
+
+    def __init__(self, filename, use_index=True):
+        self.filename = filename
+        self.vars = []
+        self.unit = 1.0
+        self._use_index = use_index and not filename.endswith('.gz')
+        self._index = None
+        with self._open() as f:
+            self._read_header(f)
+
+    def _open(self):
+        if self.filename.endswith('.gz'):
+            return gzip.open(self.filename, 'rb')
+        if self.filename.endswith('.zst'):
+            raise ValueError("{}: decompress zstd traces before reading them".format(self.filename))
+        return open(self.filename, 'rb')
+
+    def _read_header(self, f):
+        scope = []
+        header = []
+        self.header_size = 0
+        for line in f:
+            self.header_size += len(line)
+            header.append(line)
+            tokens = line.split()
+            if not tokens:
+                continue
+            if tokens[0] == b'$scope' and len(tokens) >= 3:
+                scope.append(tokens[2].decode('latin-1'))
+            elif tokens[0] == b'$upscope':
+                scope.pop()
+            elif tokens[0] == b'$var' and len(tokens) >= 5:
+                # $var <type> <width> <id> <name> [range] $end
+                self.vars.append(VcdVar(tokens[3], tokens[4].decode('latin-1'),
+                                        int(tokens[2]), list(scope)))
+            elif tokens[0] == b'$enddefinitions':
+                break
+
+        match = re.search(br'\$timescale\s+(\d+)\s*(s|ms|us|ns|ps|fs)\s+\$end', b''.join(header))
+        if match:
+            self.unit = int(match.group(1)) * VCD_TIME_UNITS[match.group(2)]
+
+    def find_var(self, port):
+        """ The var of an xsim port name such as 'tile[0]:XS1_PORT_1F' (or of
+            a plain signal name). Of the vars with that name, the one in a
+            scope named after the tile with the shortest path is taken.
+        """
+        (tile, sep, name) = port.rpartition(':')
+        matches = [var for var in self.vars if var.name == name and
+                   (not tile or any(tile in scope for scope in var.scope))]
+        if not matches:
+            raise ValueError("No signal for {} in {} (there are {} signals)".format(
+                port, self.filename, len(self.vars)))
+        return min(matches, key=lambda var: (len(var.scope), var.path))
+
+    def index(self):
+        """ The time index, loaded from the sidecar file or built by reading
+            the whole VCD. None for compressed VCDs.
+        """
+        if not self._use_index:
+            return None
+        if self._index is None:
+            stat = os.stat(self.filename)
+            filename = self.filename + INDEX_EXTENSION
+            self._index = VcdIndex.load(filename, stat.st_size, stat.st_mtime)
+            if self._index is None:
+                self._index = VcdIndex(stat.st_size, stat.st_mtime)
+                for change in self._changes(build_index=self._index):
+                    pass
+                try:
+                    self._index.save(filename)
+                except (IOError, OSError):
+                    # Read only folder, keep the index in memory
+                    pass
+        return self._index
+
+    def changes(self, start=None, end=None, ids=None):
+        """ Yields (time, id, value) for the changes of the signals ids (all
+            if None) from start to end ns. The value of each signal at start
+            is yielded first, at time start.
+        """
+        checkpoint = None
+        if start is not None and self._use_index:
+            checkpoint = self.index().find(start)
+        return self._changes(start, end, ids, checkpoint)
+
+    def _changes(self, start=None, end=None, ids=None, checkpoint=None, build_index=None):
+        ids = set(ids) if ids is not None else None
+        values = {}
+        with self._open() as f:
+            if checkpoint:
+                (time, offset, checkpoint_values) = checkpoint
+                f.seek(offset)
+                values.update(checkpoint_values)
+            else:
+                f.seek(self.header_size)
+                offset = self.header_size
+            time = 0.0
+            started = start is None
+            next_checkpoint = offset
+
+            try:
+                for line in f:
+                    line_offset = offset
+                    offset += len(line)
+                    if line[:1] == b'#':
+                        time = int(line[1:]) * self.unit
+                        if build_index is not None and line_offset >= next_checkpoint:
+                            build_index.add(time, line_offset, values)
+                            next_checkpoint = line_offset + INDEX_STRIDE
+                        if end is not None and time > end:
+                            break
+                        if not started and time >= start:
+                            # The values at start
+                            started = True
+                            for (var_id, value) in sorted(values.items()):
+                                if ids is None or var_id in ids:
+                                    yield (start, var_id, value)
+                        continue
+
+                    change = _split_change(line.strip())
+                    if change is None:
+                        # $dumpvars, $end, $comment ...
+                        continue
+                    (var_id, value) = change
+                    if ids is not None and var_id not in ids:
+                        if build_index is not None:
+                            values[var_id] = value
+                        continue
+                    values[var_id] = value
+                    if started:
+                        yield (time, var_id, value)
+            except (EOFError, IOError):
+                # A compressed trace cut short by its budget
+                pass
+
+
+class Timeline(object):
+    """ The times (ns) a signal changed and its values from then on """
+
+    def __init__(self, times, values):
+        self.times = times
+        self.values = values
+
+    def __len__(self):
+        return len(self.times)
+
+    def value_at(self, time):
+        """ The value at time, UNKNOWN before the first change """
+        if numpy is not None and isinstance(self.times, numpy.ndarray):
+            i = int(numpy.searchsorted(self.times, time, side='right')) - 1
+        else:
+            i = bisect.bisect_right(self.times, time) - 1
+        return self.values[i] if i >= 0 else UNKNOWN
+
+    def edges(self, value=1):
+        """ Times the signal changed to value """
+        return [t for (t, v) in zip(self.times, self.values) if v == value]
+
+    def intervals(self, value=1):
+        """ (start, end) of each period the signal had value. end is None if
+            it still had it at the end of the timeline.
+        """
+        intervals = []
+        start = None
+        for (t, v) in zip(self.times, self.values):
+            if v == value and start is None:
+                start = t
+            elif v != value and start is not None:
+                intervals.append((start, t))
+                start = None
+        if start is not None:
+            intervals.append((start, None))
+        return intervals
+
+def _make_timeline(times, values):
+    if numpy is not None:
+        return Timeline(numpy.array(times, dtype=numpy.float64),
+                        numpy.array(values, dtype=numpy.int64))
+    return Timeline(times, values)
+
+def read_timelines(reader, signals, start=None, end=None):
+    """ Returns a dict of Timelines for signals, a dict of names to port
+        names (see VcdReader.find_var()), from start to end ns
+    """
+    ids = dict((name, reader.find_var(port).id) for (name, port) in signals.items())
+    data = dict((var_id, (array('d'), array('l'))) for var_id in set(ids.values()))
+    for (time, var_id, value) in reader.changes(start, end, data.keys()):
+        (times, values) = data[var_id]
+        value = parse_value(value)
+        if times and times[-1] == time:
+            # Several changes at one time, the last one stands
+            values[-1] = value
+        elif not values or values[-1] != value:
+            times.append(time)
+            values.append(value)
+    return dict((name, _make_timeline(*data[var_id])) for (name, var_id) in ids.items())
+
+def usb_timelines(reader, arch='xs2', start=None, end=None):
+    """ Timelines of the USB port signals (USB_PORTS) of arch """
+    return read_timelines(reader, USB_PORTS[arch], start, end)
+
+def usb_packets(timelines):
+    """ Returns a dict for each packet on the bus, in time order: its
+        direction ('host' while RXA is high, 'device' while TXV is high), its
+        start and end time and, when the clock is in the timelines, its bytes
+        as sampled on the rising clock edges (RXDV/RXD or TXRDY/TXD)
+    """
+    packets = []
+    clock_edges = timelines['clk'].edges(1) if 'clk' in timelines else None
+    for (direction, active, valid, data) in (('host', 'rxa', 'rxdv', 'rxd'),
+                                             ('device', 'txv', 'txrdy', 'txd')):
+        for (start, end) in timelines[active].intervals():
+            packet = {'direction' : direction, 'start' : float(start),
+                      'end' : float(end) if end is not None else None}
+            if clock_edges is not None:
+                first = bisect.bisect_left(clock_edges, start)
+                last = bisect.bisect_left(clock_edges, end) if end is not None else len(clock_edges)
+                edges = clock_edges[first:last]
+                packet['data'] = [int(timelines[data].value_at(t)) & 0xff for t in edges
+                                  if timelines[valid].value_at(t) == 1]
+                packet['length'] = len(packet['data'])
+            packets.append(packet)
+    return sorted(packets, key=lambda packet: packet['start'])
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Print the USB packets in an xsim VCD")
+    argparser.add_argument('vcd', type=str, help='VCD written by xsim --vcd-tracing')
+    argparser.add_argument('--arch', choices=['xs1', 'xs2'], type=str, default='xs2', help='Port map of the trace')
+    argparser.add_argument('--start', type=float, help='Start time in us')
+    argparser.add_argument('--end', type=float, help='End time in us')
+    argparser.add_argument('--no-index', action='store_true', help="Don't read or write the sidecar time index")
+    args = argparser.parse_args()
+
+    reader = VcdReader(args.vcd, use_index=not args.no_index)
+    timelines = usb_timelines(reader, args.arch,
+                              args.start * 1000 if args.start is not None else None,
+                              args.end * 1000 if args.end is not None else None)
+    for packet in usb_packets(timelines):
+        sys.stdout.write(json.dumps(packet, sort_keys=True) + '\n')
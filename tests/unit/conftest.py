@@ -0,0 +1,18 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Unit tests of the Python side of the harness, run without xsim:
+#
+#   cd tests && python -m pytest unit
+#
+# They live in their own folder so that runner.py, which runs every
+# test_*.py next to the harness as a simulator test, doesn't pick them up.
+# sim_local provides xmostest.SimThread when the XMOS tools aren't installed.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sim_local
+sim_local.install()
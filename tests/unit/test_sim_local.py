@@ -0,0 +1,202 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# wait(), wait_until(), drive and sample as the harness threads use them
+# under xsim: a thread runs until it waits, pins driven are seen by every
+# thread at once, wait_until() resumes at the time asked for and wait()
+# resumes at the first time its condition holds once the other threads due
+# then have run.
+
+import pytest
+
+import sim_local
+from sim_local import SimThread, Simulator, ScriptedDut
+
+USE_GREENLET = [False] + ([True] if sim_local.greenlet else [])
+
+class Script(SimThread):
+    """ Runs steps(thread) and records (time, event) in log """
+
+    def __init__(self, log, name, steps):
+        self.log = log
+        self.name = name
+        self.steps = steps
+
+    def mark(self, event):
+        self.log.append((self.xsi.get_time(), self.name, event))
+
+    def run(self):
+        self.steps(self)
+
+
+def run(steps, max_time=None, use_greenlet=False, others=()):
+    log = []
+    threads = [Script(log, name, f) for (name, f) in steps] + list(others)
+    sim = Simulator(threads, max_time=max_time, use_greenlet=use_greenlet)
+    end = sim.run()
+    return (log, end, sim)
+
+@pytest.mark.parametrize('use_greenlet', USE_GREENLET)
+def test_wait_until(use_greenlet):
+    def steps(t):
+        t.wait_until(10)
+        t.mark('a')
+        t.wait_until(25.5)
+        t.mark('b')
+        # A time that has passed resumes now
+        t.wait_until(5)
+        t.mark('c')
+    (log, end, sim) = run([('t', steps)], use_greenlet=use_greenlet)
+    assert log == [(10, 't', 'a'), (25.5, 't', 'b'), (25.5, 't', 'c')]
+    assert end == 25.5
+
+@pytest.mark.parametrize('use_greenlet', USE_GREENLET)
+def test_wait_true_resumes_at_same_time(use_greenlet):
+    def waiter(t):
+        t.wait_until(10)
+        t.wait(lambda x: True)
+        t.mark('first')
+        t.wait(lambda x: True)
+        t.mark('second')
+
+    def other(t):
+        t.wait_until(50)
+        t.mark('other')
+    (log, end, sim) = run([('w', waiter), ('o', other)], use_greenlet=use_greenlet)
+    assert log == [(10, 'w', 'first'), (10, 'w', 'second'), (50, 'o', 'other')]
+
+def test_wait_yields_to_threads_due_at_the_same_time():
+    # The condition is evaluated after the driver has run at time 10, even
+    # though the waiter was resumed first
+    def waiter(t):
+        t.wait_until(10)
+        t.mark('sees {}'.format(t.xsi.sample_port_pins('p')))
+        t.wait(lambda x: x.sample_port_pins('p') == 1)
+        t.mark('resumed')
+
+    def driver(t):
+        t.wait_until(10)
+        t.xsi.drive_port_pins('p', 1)
+    (log, end, sim) = run([('w', waiter), ('d', driver)])
+    assert log == [(10, 'w', 'sees 0'), (10, 'w', 'resumed')]
+
+def test_wait_on_pin_driven_later():
+    def waiter(t):
+        t.wait(lambda x: x.sample_port_pins('p') == 3)
+        t.mark('resumed')
+    (log, end, sim) = run([('w', waiter)], others=[ScriptedDut([(5, 'p', 1), (40, 'p', 3)])])
+    assert log == [(40, 'w', 'resumed')]
+
+def test_drive_and_sample():
+    def steps(t):
+        xsi = t.xsi
+        # Pins no one has driven read as 0
+        t.mark(xsi.sample_port_pins('p'))
+        xsi.drive_port_pins('p', 0xa5)
+        t.mark(xsi.sample_port_pins('p'))
+        t.wait_until(1)
+        xsi.drive_port_pins('p', 0)
+        t.mark(xsi.sample_port_pins('p'))
+    (log, end, sim) = run([('t', steps)])
+    assert [event for (time, name, event) in log] == [0, 0xa5, 0]
+
+def test_delta_cycles():
+    # a drives p, b sees it and drives q, c sees q: all at time 20
+    def a(t):
+        t.wait_until(20)
+        t.xsi.drive_port_pins('p', 1)
+
+    def b(t):
+        t.wait(lambda x: x.sample_port_pins('p') == 1)
+        t.xsi.drive_port_pins('q', 1)
+        t.mark('b')
+
+    def c(t):
+        t.wait_for_pin('q', 1)
+        t.mark('c')
+    (log, end, sim) = run([('c', c), ('b', b), ('a', a)])
+    assert log == [(20, 'b', 'b'), (20, 'c', 'c')]
+
+def test_condition_not_met_until_end():
+    def waiter(t):
+        t.wait(lambda x: x.sample_port_pins('p') == 1)
+        t.mark('never')
+
+    def timer(t):
+        t.wait_until(100)
+    (log, end, sim) = run([('w', waiter), ('t', timer)])
+    assert log == []
+    assert end == 100
+
+def test_terminate():
+    def stopper(t):
+        t.wait_until(30)
+        t.xsi.terminate()
+        t.mark('after terminate')
+
+    def ticker(t):
+        while True:
+            t.wait_until(t.xsi.get_time() + 7)
+            t.mark('tick')
+    (log, end, sim) = run([('s', stopper), ('t', ticker)])
+    assert end == 30
+    assert ('s', 'after terminate') not in [(name, event) for (time, name, event) in log]
+    assert [time for (time, name, event) in log] == [7, 14, 21, 28]
+
+def test_max_time():
+    def ticker(t):
+        while True:
+            t.wait_until(t.xsi.get_time() + 10)
+    (log, end, sim) = run([('t', ticker)], max_time=55)
+    assert end == 55
+
+def test_exception_is_raised_by_run():
+    def broken(t):
+        t.wait_until(5)
+        raise RuntimeError("broken thread")
+    with pytest.raises(RuntimeError):
+        run([('b', broken)])
+
+def test_loopback():
+    packets = sim_local.loopback_packets(5, 16)
+    (sim, clock, phy, dut) = sim_local.make_loopback_sim(packets, capture_output=True)
+    sim.run()
+    assert [line for line in sim.output if line.startswith('ERROR')] == []
+    assert len(dut.received) == 5
+    assert [bytes(data[1:]) for data in dut.received] == \
+        [bytes(packet.data_bytes) + bytes(packet.get_wire_bytes()[-2:]) for packet in packets[::2]]
+
+@pytest.mark.parametrize('native_clock', [True, False])
+def test_loopback_clock_modes(native_clock):
+    packets = sim_local.loopback_packets(3, 8)
+    (sim, clock, phy, dut) = sim_local.make_loopback_sim(packets, native_clock=native_clock,
+                                                         capture_output=True)
+    sim.run()
+    assert [line for line in sim.output if line.startswith('ERROR')] == []
+    assert len(dut.received) == 3
+
+def test_profiler_attached_before_run():
+    from harness_profile import HarnessProfiler
+    packets = sim_local.loopback_packets(3, 8)
+    (sim, clock, phy, dut) = sim_local.make_loopback_sim(packets, native_clock=False,
+                                                         capture_output=True)
+    profiler = HarnessProfiler()
+    for thread in (clock, phy):
+        profiler.attach(thread)
+    sim.run()
+    profiler.stop()
+    threads = dict((profile.name, profile) for profile in profiler.threads)
+    assert threads['Clock'].wakeups['wait_until'] > 0
+    assert sum(threads['UsbPhy'].wakeups.values()) > 1
+    assert 'wait' not in clock.__dict__
+    assert 0 < profiler.wall_time
+
+def test_idle_clock_costs_no_events():
+    events = []
+    for gap in (500, 50000):
+        packets = sim_local.loopback_packets(3, 8, gap=gap)
+        (sim, clock, phy, dut) = sim_local.make_loopback_sim(packets, capture_output=True)
+        sim.run()
+        assert len(dut.received) == 3
+        events.append(sim.events)
+    assert events[0] == events[1]
@@ -0,0 +1,26 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Port resource IDs that PortMarker looks for in xsim instruction traces
+
+import pytest
+
+from sim_profile import port_resource_id
+
+@pytest.mark.parametrize('port, resource_id', [
+    ('XS1_PORT_1A', 0x10200),
+    ('XS1_PORT_1B', 0x10000),
+    ('XS1_PORT_1C', 0x10600),
+    ('XS1_PORT_1D', 0x10400),
+    ('tile[0]:XS1_PORT_1J', 0x11000),
+    ('XS1_PORT_1P', 0x11c00),
+    ('XS1_PORT_4A', 0x40000),
+    ('tile[0]:XS1_PORT_8B', 0x80100),
+    ('XS1_PORT_32B', 0x200100)])
+def test_port_resource_id(port, resource_id):
+    assert port_resource_id(port) == resource_id
+
+@pytest.mark.parametrize('port', ['XS1_PORT_8E', 'XS1_PORT_2A', 'XS1_PORT_1Q', 'PORT_1A'])
+def test_unknown_port(port):
+    with pytest.raises(ValueError):
+        port_resource_id(port)
@@ -0,0 +1,148 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Responses of the device model to host packets
+
+from usb_packet import TokenPacket, TxDataPacket, TxHandshakePacket, RxHandshakePacket
+from usb_device import (DeviceModel, Endpoint, loopback, full_pid, PID_OUT, PID_IN, PID_SETUP,
+                        PID_PING, PID_DATA0, PID_DATA1, PID_ACK, PID_NAK, PID_STALL)
+
+def token(pid, ep, **kwargs):
+    return TokenPacket(pid=full_pid(pid), endpoint=ep, **kwargs)
+
+def data(pid, payload, **kwargs):
+    return TxDataPacket(None, pid=full_pid(pid), data=bytearray(payload), **kwargs)
+
+def responses(model, *packets):
+    """ PIDs (and payloads of data packets) the model sends back to packets """
+    result = []
+    for packet in packets:
+        for response in model.host_packet(packet):
+            if hasattr(response, 'data_bytes'):
+                result.append((response.pid & 0xf, bytearray(response.data_bytes)))
+            else:
+                result.append(response.pid & 0xf)
+    return result
+
+def out(model, ep, pid, payload, **kwargs):
+    return responses(model, token(PID_OUT, ep), data(pid, payload, **kwargs))
+
+def ack():
+    return TxHandshakePacket(pid=full_pid(PID_ACK))
+
+def test_out_data_toggle():
+    model = DeviceModel([Endpoint(1)])
+    received = model.out_eps[1].received
+
+    assert out(model, 1, PID_DATA0, b'a') == [PID_ACK]
+    assert out(model, 1, PID_DATA1, b'b') == [PID_ACK]
+    # A retry after a lost ACK is ACKed again but not taken
+    assert out(model, 1, PID_DATA1, b'b') == [PID_ACK]
+    assert out(model, 1, PID_DATA0, b'c') == [PID_ACK]
+    assert received == [bytearray(b'a'), bytearray(b'b'), bytearray(b'c')]
+
+def test_in_data_toggle():
+    model = DeviceModel([Endpoint(1)])
+    assert responses(model, token(PID_IN, 1)) == [PID_NAK]
+
+    model.queue_in(1, b'xy')
+    model.queue_in(1, b'z')
+    assert responses(model, token(PID_IN, 1)) == [(PID_DATA0, bytearray(b'xy'))]
+    # Not ACKed: the same data is sent again
+    assert responses(model, token(PID_IN, 1)) == [(PID_DATA0, bytearray(b'xy'))]
+    assert responses(model, ack()) == []
+    assert responses(model, token(PID_IN, 1), ack()) == [(PID_DATA1, bytearray(b'z'))]
+    assert responses(model, token(PID_IN, 1)) == [PID_NAK]
+
+def test_nak_when_not_ready():
+    model = DeviceModel([Endpoint(1, ready=False)])
+    assert responses(model, token(PID_PING, 1)) == [PID_NAK]
+    assert out(model, 1, PID_DATA0, b'a') == [PID_NAK]
+    assert model.out_eps[1].received == []
+
+    model.set_ready(1)
+    assert responses(model, token(PID_PING, 1)) == [PID_ACK]
+    # The NAKed packet didn't move the toggle on
+    assert out(model, 1, PID_DATA0, b'a') == [PID_ACK]
+    assert model.out_eps[1].received == [bytearray(b'a')]
+
+def test_stall():
+    model = DeviceModel([Endpoint(1, halted=True)])
+    assert out(model, 1, PID_DATA0, b'a') == [PID_STALL]
+    assert responses(model, token(PID_PING, 1)) == [PID_STALL]
+    assert responses(model, token(PID_IN, 1)) == [PID_STALL]
+
+    model.halt(1, 'out', False)
+    assert out(model, 1, PID_DATA0, b'a') == [PID_ACK]
+    assert responses(model, token(PID_IN, 1)) == [PID_STALL]
+
+def test_setup_clears_halt_and_sets_toggles():
+    model = DeviceModel([Endpoint(1, 'control', halted=True)])
+    model.out_eps[1].toggle = 0
+    assert responses(model, token(PID_SETUP, 1), data(PID_DATA0, b'12345678')) == [PID_ACK]
+    assert not model.out_eps[1].halted and not model.in_eps[1].halted
+
+    # The data stage is DATA1 both ways
+    model.queue_in(1, b'r')
+    assert responses(model, token(PID_IN, 1)) == [(PID_DATA1, bytearray(b'r'))]
+    assert out(model, 1, PID_DATA1, b's') == [PID_ACK]
+    assert model.out_eps[1].received == [bytearray(b'12345678'), bytearray(b's')]
+
+def test_dropped_packets_get_no_response():
+    model = DeviceModel([Endpoint(1)])
+    assert out(model, 1, PID_DATA0, b'a', bad_crc=True) == []
+    assert out(model, 1, PID_DATA0, b'a', rxe_assert_time=5) == []
+    assert responses(model, token(PID_OUT, 1, bad_crc=True), data(PID_DATA0, b'a')) == []
+    # Not configured
+    assert out(model, 2, PID_DATA0, b'a') == []
+    assert responses(model, token(PID_IN, 2)) == []
+    assert model.out_eps[1].received == []
+
+def test_iso():
+    model = DeviceModel([Endpoint(1, 'iso')])
+    assert out(model, 1, PID_DATA0, b'a') == []
+    assert out(model, 1, PID_DATA0, b'b') == []
+    assert model.out_eps[1].received == [bytearray(b'a'), bytearray(b'b')]
+
+    assert responses(model, token(PID_IN, 1)) == [(PID_DATA0, bytearray())]
+    model.queue_in(1, b'c')
+    model.queue_in(1, b'd')
+    # Always DATA0 and done without an ACK
+    assert responses(model, token(PID_IN, 1)) == [(PID_DATA0, bytearray(b'c'))]
+    assert responses(model, token(PID_IN, 1)) == [(PID_DATA0, bytearray(b'd'))]
+
+def test_loopback_callbacks():
+    (on_out, on_in) = loopback([1])
+    model = DeviceModel([Endpoint(1), Endpoint(2)], on_out=on_out, on_in=on_in)
+
+    assert out(model, 1, PID_DATA0, b'abc') == [PID_ACK]
+    # Held until it has gone back IN
+    assert responses(model, token(PID_PING, 1)) == [PID_NAK]
+    assert out(model, 1, PID_DATA1, b'def') == [PID_NAK]
+    assert responses(model, token(PID_IN, 1), ack()) == [(PID_DATA0, bytearray(b'abc'))]
+    assert responses(model, token(PID_PING, 1)) == [PID_ACK]
+    assert out(model, 1, PID_DATA1, b'def') == [PID_ACK]
+    assert responses(model, token(PID_IN, 1), ack()) == [(PID_DATA1, bytearray(b'def'))]
+
+    # Not looped back
+    assert out(model, 2, PID_DATA0, b'g') == [PID_ACK]
+    assert responses(model, token(PID_IN, 2)) == [PID_NAK]
+
+def test_callbacks_are_called():
+    calls = []
+    model = DeviceModel([Endpoint(1)], on_out=lambda m, ep, d: calls.append(('out', ep, d)),
+                        on_in=lambda m, ep, d: calls.append(('in', ep, d)))
+    model.queue_in(1, b'i')
+    out(model, 1, PID_DATA0, b'o')
+    responses(model, token(PID_IN, 1), ack())
+    assert calls == [('out', 1, bytearray(b'o')), ('in', 1, bytearray(b'i'))]
+
+def test_complete():
+    model = DeviceModel([Endpoint(1)])
+    host_packets = [token(PID_OUT, 1), data(PID_DATA0, b'a'),
+                    # A hand written response is replaced
+                    RxHandshakePacket(),
+                    token(PID_IN, 1)]
+    packets = model.complete(host_packets)
+    assert [(p.is_rx, p.pid & 0xf) for p in packets] == [
+        (False, PID_OUT), (False, PID_DATA0), (True, PID_ACK), (False, PID_IN), (True, PID_NAK)]
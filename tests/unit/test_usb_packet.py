@@ -0,0 +1,213 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Packet encoding checked against bit-serial reference implementations
+
+import random
+
+import pytest
+
+import usb_packet
+from usb_packet import (GenCrc16, GenCrc16Batch, CRC16_TABLE, BAD_CRC16, reflect,
+                        TxDataPacket, RxDataPacket, GenCrc5, CRC5_TABLE, TOKEN_FIELD_TABLE,
+                        TokenPacket, TxHandshakePacket, RxHandshakePacket, PacketTrace,
+                        iter_packets, total_wire_bytes)
+
+def crc16_bitwise(data):
+    """ The bit-serial USB CRC16 the table replaced """
+    crc = 0xffff
+    for byte in data:
+        crc ^= reflect(int(byte) & 0xff, 8) << 8
+        for k in range(8):
+            if crc & 0x8000:
+                crc = (crc << 1) ^ 0x8005
+            else:
+                crc <<= 1
+    return ~reflect(crc, 16) & 0xffff
+
+def random_payloads(seed, count, max_len=1024):
+    rand = random.Random(seed)
+    return [bytearray(rand.getrandbits(8) for i in range(rand.randint(0, max_len)))
+            for j in range(count)]
+
+def test_crc16_table():
+    # Entry i is the CRC of byte i from a zero register, as the bitwise form
+    # computes it
+    for i in range(256):
+        crc = i
+        for k in range(8):
+            crc = (crc >> 1) ^ (0xa001 if crc & 1 else 0)
+        assert CRC16_TABLE[i] == crc
+
+def test_crc16_matches_bitwise():
+    for i in range(256):
+        assert GenCrc16([i]) == crc16_bitwise([i])
+    assert GenCrc16([]) == crc16_bitwise([])
+    for payload in random_payloads(1, 50):
+        assert GenCrc16(payload) == crc16_bitwise(payload)
+
+def test_crc16_buffer_types():
+    payload = random_payloads(2, 1, 100)[0]
+    crc = crc16_bitwise(payload)
+    assert GenCrc16(bytes(payload)) == crc
+    assert GenCrc16(memoryview(payload)) == crc
+    assert GenCrc16(list(payload)) == crc
+    # Ints are masked to 8 bits, as the bitwise form did
+    assert GenCrc16([byte | 0x100 for byte in payload]) == crc
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+def test_crc16_batch(use_numpy):
+    if use_numpy and usb_packet.numpy is None:
+        pytest.skip("NumPy is not installed")
+    payloads = random_payloads(3, 200) + [bytearray()]
+    assert GenCrc16Batch(payloads, use_numpy=use_numpy) == [crc16_bitwise(p) for p in payloads]
+
+@pytest.mark.parametrize('cls', [TxDataPacket, RxDataPacket])
+def test_data_packet_crc(cls):
+    payload = random_payloads(4, 1, 64)[0]
+    crc = crc16_bitwise(payload)
+    wire_bytes = bytearray(cls(None, data=payload).get_wire_bytes())
+    assert wire_bytes[-2:] == bytearray([crc & 0xff, crc >> 8])
+
+    wire_bytes = bytearray(cls(None, data=payload, bad_crc=True).get_wire_bytes())
+    assert wire_bytes[-2:] == bytearray([BAD_CRC16 & 0xff, BAD_CRC16 >> 8])
+
+def crc5_bitwise(address, endpoint):
+    """ USB CRC5 of a token, shifting ADDR then EP through the register LSB
+        first as they are sent. Returns the CRC in the bit order it is sent
+        in, which is how CRC5_TABLE holds it.
+    """
+    field = (address & 0x7f) | ((endpoint & 0xf) << 7)
+    crc = 0x1f
+    for k in range(11):
+        if ((field >> k) ^ (crc >> 4)) & 1:
+            crc = ((crc << 1) ^ 0x05) & 0x1f
+        else:
+            crc = (crc << 1) & 0x1f
+    return reflect(~crc & 0x1f, 5)
+
+def test_crc5_table():
+    assert len(CRC5_TABLE) == 2048
+    for address in range(128):
+        for endpoint in range(16):
+            crc5 = crc5_bitwise(address, endpoint)
+            assert CRC5_TABLE[address | (endpoint << 7)] == crc5
+            assert GenCrc5(address, endpoint) == crc5
+
+@pytest.mark.parametrize('address, endpoint, crc5', [
+    # Examples from the USB 2.0 CRC paper, CRC5 written MSB first
+    (0x15, 0xe, 0x17),
+    (0x3a, 0xa, 0x1c),
+    (0x70, 0x4, 0x0e)])
+def test_crc5_examples(address, endpoint, crc5):
+    assert reflect(GenCrc5(address, endpoint), 5) == crc5
+
+def test_token_bytes():
+    for (address, endpoint) in [(0, 0), (0x15, 0xe), (0x7f, 0xf), (0x40, 0x1)]:
+        token = TokenPacket(pid=0x69, address=address, endpoint=endpoint)
+        field = address | (endpoint << 7) | (crc5_bitwise(address, endpoint) << 11)
+        assert token.get_token_bytes() == bytearray([0x69, field & 0xff, field >> 8])
+        assert TOKEN_FIELD_TABLE[address | (endpoint << 7)] == (field & 0xff, field >> 8)
+        assert token.crc5_ok() and token.get_token_valid()
+        # What the IFM passes on to the xCORE
+        assert token.get_bytes() == bytearray([0x9, endpoint])
+
+def test_token_bad_crc5():
+    good = crc5_bitwise(0x15, 0xe)
+
+    token = TokenPacket(pid=0xe1, address=0x15, endpoint=0xe, bad_crc=True)
+    assert token.crc5 == good ^ 0x1f
+    assert not token.crc5_ok() and not token.get_token_valid()
+    assert token.get_token_bytes()[2] >> 3 == good ^ 0x1f
+
+    token = TokenPacket(pid=0xe1, address=0x15, endpoint=0xe, crc5=good ^ 0x1)
+    assert token.crc5 == good ^ 0x1
+    assert not token.get_token_valid()
+
+def mixed_packets():
+    """ Packets of every kind, with each field away from its default in
+        some of them
+    """
+    rand = random.Random(5)
+    packets = []
+    for i in range(8):
+        packets.append(TokenPacket(pid=0x2d, address=i * 9, endpoint=i, inter_pkt_gap=100 + i,
+                                   rxa_start_delay=i, rxa_end_delay=i + 1, rxe_assert_time=i * 3,
+                                   rxe_assert_length=i + 2, valid=i != 2, bad_crc=i == 4))
+        packets.append(TxDataPacket(rand, length=8 * i, data_random=True, pid=0xb,
+                                    data_valid_count=i, bad_crc=i == 1, rxe_assert_time=i,
+                                    inter_pkt_gap=i))
+        packets.append(RxHandshakePacket(timeout=9 + i))
+        packets.append(TokenPacket(pid=0x69, address=3, endpoint=i, crc5=i))
+        packets.append(RxDataPacket(rand, length=i, data_start_val=i, pid=0x3, timeout=20 + i,
+                                    bad_crc=i == 6))
+        packets.append(TxHandshakePacket(pid=0x5a if i == 7 else 0xd2, inter_pkt_gap=i))
+    return packets
+
+def packet_fields(packet):
+    fields = {'kind' : packet.kind, 'pid' : packet.pid, 'bad_crc' : packet.bad_crc,
+              'wire_bytes' : bytearray(packet.get_wire_bytes()),
+              'data_valid_count' : packet.data_valid_count}
+    if packet.is_rx:
+        fields['timeout'] = packet.timeout
+    else:
+        fields.update(inter_pkt_gap=packet.inter_pkt_gap, rxa_start_delay=packet.rxa_start_delay,
+                      rxa_end_delay=packet.rxa_end_delay, rxe_assert_time=packet.rxe_assert_time,
+                      rxe_assert_length=packet.rxe_assert_length)
+    if packet.is_token:
+        fields.update(endpoint=packet.endpoint, address=packet.address, crc5=packet.crc5,
+                      valid=packet.valid, token_bytes=packet.get_token_bytes())
+    return fields
+
+def test_packet_trace_round_trip():
+    packets = mixed_packets()
+    trace = PacketTrace(packets)
+    assert len(trace) == len(packets)
+
+    copy = trace.to_packets()
+    assert [type(p) for p in copy] == [type(p) for p in packets]
+    assert [packet_fields(p) for p in copy] == [packet_fields(p) for p in packets]
+    assert trace[-1].get_wire_bytes() == packets[-1].get_wire_bytes()
+
+    # And back again
+    again = PacketTrace(copy)
+    for (name, typecode) in PacketTrace.COLUMNS:
+        assert getattr(again, name) == getattr(trace, name)
+    assert again.payload == trace.payload
+
+def test_packet_trace_payloads():
+    packets = mixed_packets()
+    trace = PacketTrace(packets)
+    for (i, packet) in enumerate(packets):
+        if hasattr(packet, 'data_bytes'):
+            assert bytearray(trace.get_payload(i)) == bytearray(packet.data_bytes)
+        assert trace.get_wire_bytes(i) == packet.get_wire_bytes()
+    assert trace.total_wire_bytes() == total_wire_bytes(packets)
+    assert total_wire_bytes(trace) == total_wire_bytes(packets)
+
+def test_packet_trace_cursor():
+    packets = mixed_packets()
+    # The same cursor is moved on to each packet, so it can't be zipped
+    for (i, cursor) in enumerate(iter_packets(PacketTrace(packets))):
+        packet = packets[i]
+        assert (cursor.kind, cursor.is_rx, cursor.is_token, cursor.pid) == \
+            (packet.kind, packet.is_rx, packet.is_token, packet.pid & 0xff)
+        assert cursor.get_wire_bytes() == packet.get_wire_bytes()
+        assert cursor.get_bytes() == packet.get_bytes()
+        assert cursor.get_data_valid_count() == packet.get_data_valid_count()
+        if packet.is_rx:
+            assert cursor.get_timeout() == packet.get_timeout()
+        else:
+            assert cursor.get_inter_pkt_gap() == packet.get_inter_pkt_gap()
+            assert (cursor.rxa_start_delay, cursor.rxa_end_delay, cursor.rxe_assert_time,
+                    cursor.rxe_assert_length) == \
+                (packet.rxa_start_delay, packet.rxa_end_delay, packet.rxe_assert_time,
+                 packet.rxe_assert_length)
+        if packet.is_token:
+            assert cursor.endpoint == packet.endpoint
+            assert bool(cursor.get_token_valid()) == bool(packet.get_token_valid())
+        assert packet_fields(cursor.get_packet()) == packet_fields(packet)
+
+def test_packet_trace_rejects_base_packets():
+    with pytest.raises(ValueError):
+        PacketTrace().append(usb_packet.UsbPacket())
@@ -0,0 +1,123 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Writing packets to .usbstim files, reading them back through StimulusFile
+# and regenerating them with load_stimulus() when they are stale
+
+import random
+
+import pytest
+
+from usb_packet import (TokenPacket, TxDataPacket, RxDataPacket, TxHandshakePacket,
+                        RxHandshakePacket, PacketTrace)
+from usb_stimulus import (StimulusFile, write_stimulus_file, load_stimulus, stimulus_hash,
+                          STIMULUS_MAGIC)
+
+def make_packets(seed=1):
+    rand = random.Random(seed)
+    packets = []
+    for i in range(20):
+        packets.append(TokenPacket(pid=0xe1, address=i & 0x7f, endpoint=i & 0xf,
+                                   inter_pkt_gap=500 + i))
+        packets.append(TxDataPacket(rand, length=rand.randint(0, 64), data_random=True,
+                                    pid=0x3 if i % 2 else 0xb))
+        packets.append(RxHandshakePacket())
+        packets.append(TokenPacket(pid=0x69, endpoint=1, bad_crc=(i == 3)))
+        packets.append(RxDataPacket(rand, length=i, pid=0xb if i % 2 else 0x3,
+                                    bad_crc=(i == 5)))
+        packets.append(TxHandshakePacket())
+    return packets
+
+def payloads(packets):
+    data = bytearray()
+    for packet in packets:
+        if hasattr(packet, 'data_bytes'):
+            data += packet.data_bytes
+    return data
+
+class Generate(object):
+    """ generate_fn for load_stimulus() that counts its calls """
+
+    def __init__(self, packets):
+        self.packets = packets
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.packets
+
+def test_round_trip(tmpdir):
+    packets = make_packets()
+    filename = str(tmpdir.join('test.usbstim'))
+    digest = write_stimulus_file(filename, packets, seed=1, generator='test',
+                                 params={'num_packets' : 120}, version='v1')
+
+    with StimulusFile(filename) as stimulus:
+        assert stimulus.verify()
+        assert (stimulus.seed, stimulus.generator, stimulus.params, stimulus.version) == \
+            (1, 'test', {'num_packets' : 120}, 'v1')
+        assert len(stimulus) == len(packets)
+        assert stimulus.total_wire_bytes() == sum(len(p.get_wire_bytes()) for p in packets)
+        for (i, packet) in enumerate(packets):
+            assert stimulus.get_wire_bytes(i) == packet.get_wire_bytes()
+            assert stimulus[i].get_wire_bytes() == packet.get_wire_bytes()
+            assert stimulus[i].kind == packet.kind
+        assert bytearray(stimulus.payload) == payloads(packets)
+        assert stimulus.content_hex == digest
+        assert stimulus_hash(stimulus) == digest
+
+    assert stimulus_hash(packets) == digest
+    assert stimulus_hash(PacketTrace(packets)) == digest
+
+def test_corrupt_file_is_detected(tmpdir):
+    filename = str(tmpdir.join('test.usbstim'))
+    write_stimulus_file(filename, make_packets())
+    with open(filename, 'r+b') as f:
+        f.seek(-1, 2)
+        last = bytearray(f.read(1))[0]
+        f.seek(-1, 2)
+        f.write(bytearray([last ^ 0xff]))
+
+    with StimulusFile(filename) as stimulus:
+        assert not stimulus.verify()
+
+@pytest.mark.parametrize('change', [
+    {'seed' : 2},
+    {'generator' : 'other'},
+    {'params' : {'num_packets' : 121}},
+    # The generating code changed (helpers.stimulus_version())
+    {'version' : 'v2'}])
+def test_stale_file_is_regenerated(tmpdir, change):
+    filename = str(tmpdir.join('stimulus', 'test.usbstim'))
+    settings = {'seed' : 1, 'generator' : 'test', 'params' : {'num_packets' : 120},
+                'version' : 'v1'}
+
+    first = Generate(make_packets(1))
+    with load_stimulus(filename, first, **settings) as stimulus:
+        assert len(stimulus) == len(first.packets)
+    assert first.calls == 1
+
+    # Same settings: the file is reused
+    with load_stimulus(filename, first, **settings) as stimulus:
+        assert stimulus_hash(stimulus) == stimulus_hash(first.packets)
+    assert first.calls == 1
+
+    settings.update(change)
+    second = Generate(make_packets(2))
+    with load_stimulus(filename, second, **settings) as stimulus:
+        assert stimulus_hash(stimulus) == stimulus_hash(second.packets)
+        assert stimulus.verify()
+    assert second.calls == 1
+
+def test_invalid_file_is_regenerated(tmpdir):
+    filename = str(tmpdir.join('test.usbstim'))
+    with open(filename, 'wb') as f:
+        f.write(b'not a stimulus file' + b'\0' * 100)
+
+    generate = Generate(make_packets())
+    with load_stimulus(filename, generate) as stimulus:
+        assert stimulus.verify()
+        assert stimulus_hash(stimulus) == stimulus_hash(generate.packets)
+    assert generate.calls == 1
+    with open(filename, 'rb') as f:
+        assert f.read(len(STIMULUS_MAGIC)) == STIMULUS_MAGIC
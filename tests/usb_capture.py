@@ -0,0 +1,227 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Capture of packets transmitted by the DUT
+#
+# UsbPhy stores the bytes of every packet it receives in a preallocated
+# bytearray ring, with the packet index and the times TXV rose and fell.
+# Received packets are checked against the expected packets in-process, and
+# the capture can be written out as JSON lines or as a binary log.
+
+import binascii
+import json
+import struct
+from array import array
+
+CAPTURE_MAGIC = b'USBCAP\0\0'
+CAPTURE_VERSION = 1
+
+# Binary log: header then, per record, RECORD followed by the packet bytes
+CAPTURE_HEADER = struct.Struct('<8sHHI')
+CAPTURE_RECORD = struct.Struct('<IQQI')
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+DEFAULT_MAX_RECORDS = 1 << 16
+
+def first_mismatch(expected, received):
+    """ Returns the offset of the first byte that differs between expected
+        and received (the length of the shorter one if it is a prefix of the
+        other), or None if they are equal
+    """
+    expected = bytearray(expected)
+    received = bytearray(received)
+    if expected == received:
+        return None
+    for (offset, (e, r)) in enumerate(zip(expected, received)):
+        if e != r:
+            return offset
+    return min(len(expected), len(received))
+
+def mismatch_report(index, expected, received):
+    """ Returns the error lines describing how a received packet differs from
+        the expected one, or an empty list if they match
+    """
+    expected = bytearray(expected)
+    received = bytearray(received)
+    offset = first_mismatch(expected, received)
+    if offset is None:
+        return []
+
+    report = []
+    if len(expected) != len(received):
+        report.append("ERROR: Rx packet length bad. Expecting: {} actual: {}".format(
+            len(expected), len(received)))
+
+    expected_byte = "{0:#x}".format(expected[offset]) if offset < len(expected) else "none"
+    received_byte = "{0:#x}".format(received[offset]) if offset < len(received) else "none"
+    report.append("ERROR: Rx Packet Error. Packet {} first mismatch at byte {}: "
+                  "expected {} received {}".format(index, offset, expected_byte, received_byte))
+    return report
+
+
+class CaptureRecord(object):
+    """ A captured packet: its index in the packet list, the times TXV rose
+        and fell and the bytes received
+    """
+
+    __slots__ = ('index', 'start_time', 'end_time', 'data')
+
+    def __init__(self, index, start_time, end_time, data):
+        self.index = index
+        self.start_time = start_time
+        self.end_time = end_time
+        self.data = data
+
+    def as_dict(self):
+        return {'index' : self.index,
+                'start_time' : self.start_time,
+                'end_time' : self.end_time,
+                'length' : len(self.data),
+                'data' : binascii.hexlify(bytes(self.data)).decode('ascii')}
+
+
+class PacketCapture(object):
+    """ Ring of received packets.
+
+        Packet bytes go into a bytearray of buffer_size bytes allocated up
+        front and the per-packet records into fixed size arrays. When either
+        fills, the oldest packets are dropped.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, max_records=DEFAULT_MAX_RECORDS):
+        self._buffer = bytearray(buffer_size)
+        self._bytes_written = 0
+
+        self._max_records = max_records
+        self._index = array('L', [0]) * max_records
+        self._start_time = array('d', [0]) * max_records
+        self._end_time = array('d', [0]) * max_records
+        self._offset = array('d', [0]) * max_records
+        self._length = array('L', [0]) * max_records
+        self._records_written = 0
+
+        self._packet_start = None
+
+    def __len__(self):
+        """ Number of packets still held """
+        held = 0
+        for n in range(min(self._records_written, self._max_records)):
+            if self._is_held(self._records_written - 1 - n):
+                held += 1
+            else:
+                break
+        return held
+
+    @property
+    def packets_captured(self):
+        return self._records_written
+
+    @property
+    def bytes_captured(self):
+        return self._bytes_written
+
+    def begin(self, index, time):
+        """ Starts capturing packet index, TXV having risen at time """
+        slot = self._records_written % self._max_records
+        self._index[slot] = index
+        self._start_time[slot] = time
+        self._offset[slot] = self._bytes_written
+        self._packet_start = slot
+
+    def append_byte(self, byte):
+        self._buffer[self._bytes_written % len(self._buffer)] = byte
+        self._bytes_written += 1
+
+    def end(self, time):
+        """ Ends the current packet, TXV having fallen at time """
+        slot = self._packet_start
+        self._end_time[slot] = time
+        self._length[slot] = self._bytes_written - int(self._offset[slot])
+        self._records_written += 1
+        self._packet_start = None
+
+    def _is_held(self, record):
+        """ Record is held if it hasn't been overwritten in the record arrays
+            or had its bytes overwritten in the ring
+        """
+        if record < self._records_written - self._max_records:
+            return False
+        return int(self._offset[record % self._max_records]) >= \
+            self._bytes_written - len(self._buffer)
+
+    def _data(self, slot):
+        offset = int(self._offset[slot])
+        length = self._length[slot]
+        size = len(self._buffer)
+        start = offset % size
+        if start + length <= size:
+            return self._buffer[start:start + length]
+        return self._buffer[start:] + self._buffer[:start + length - size]
+
+    def last_data(self):
+        """ Bytes of the most recently completed packet """
+        if not self._records_written:
+            return bytearray()
+        return self._data((self._records_written - 1) % self._max_records)
+
+    def records(self):
+        """ Yields a CaptureRecord for each packet held, oldest first """
+        first = self._records_written - len(self)
+        for record in range(first, self._records_written):
+            slot = record % self._max_records
+            yield CaptureRecord(int(self._index[slot]), self._start_time[slot],
+                                self._end_time[slot], self._data(slot))
+
+    def write_jsonl(self, filename):
+        with open(filename, 'w') as f:
+            for record in self.records():
+                f.write(json.dumps(record.as_dict(), sort_keys=True) + '\n')
+
+    def write_binary(self, filename):
+        records = list(self.records())
+        with open(filename, 'wb') as f:
+            f.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, 0, len(records)))
+            for record in records:
+                f.write(CAPTURE_RECORD.pack(record.index, int(record.start_time),
+                                            int(record.end_time), len(record.data)))
+                f.write(bytes(record.data))
+
+    def write(self, filename):
+        """ Writes the capture as JSON lines if filename ends in .jsonl,
+            otherwise as a binary log
+        """
+        if filename.endswith('.jsonl'):
+            self.write_jsonl(filename)
+        else:
+            self.write_binary(filename)
+
+def read_capture(filename):
+    """ Reads a capture written by PacketCapture.write(), returning a list
+        of CaptureRecords
+    """
+    records = []
+    if filename.endswith('.jsonl'):
+        with open(filename) as f:
+            for line in f:
+                record = json.loads(line)
+                records.append(CaptureRecord(record['index'], record['start_time'],
+                                             record['end_time'],
+                                             bytearray(binascii.unhexlify(record['data']))))
+        return records
+
+    with open(filename, 'rb') as f:
+        content = f.read()
+    (magic, version, flags, count) = CAPTURE_HEADER.unpack_from(content, 0)
+    if magic != CAPTURE_MAGIC:
+        raise ValueError("{} is not a capture file".format(filename))
+    if version != CAPTURE_VERSION:
+        raise ValueError("{}: unsupported capture file version {}".format(filename, version))
+
+    offset = CAPTURE_HEADER.size
+    for _ in range(count):
+        (index, start_time, end_time, length) = CAPTURE_RECORD.unpack_from(content, offset)
+        offset += CAPTURE_RECORD.size
+        records.append(CaptureRecord(index, start_time, end_time,
+                                     bytearray(content[offset:offset + length])))
+        offset += length
+    return records
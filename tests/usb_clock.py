@@ -4,38 +4,157 @@ import xmostest
 import sys
 import zlib
 
+# Times in the analytic clock API are integer picoseconds, xsim times are ns
+PS_PER_NS = 1000
+PS_PER_S = 10**12
+PPB = 10**9
+
+def _mix64(x):
+    """ splitmix64 finaliser, gives the jitter of an edge from its number """
+    x &= 0xffffffffffffffff
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & 0xffffffffffffffff
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & 0xffffffffffffffff
+    return x ^ (x >> 31)
+
 class Clock(xmostest.SimThread):
+    """ Clock driven onto a 1-bit port.
+
+        Edges are numbered from the start of the clock (edge 0, pin low):
+        odd edges rise and even edges fall. Edge n is at
+
+            start + floor(n * 10^12 / (2 * frequency)) + jitter(n) ps
+
+        where frequency includes the ppm offset and jitter(n) is a
+        reproducible value in [-jitter, jitter] ps derived from the seed.
+        edge_time(), next_rising() and next_falling() answer edge queries
+        exactly without the clock having run.
+
+        run() is begin() followed by toggle() at each next_edge_time(). A
+        simulator that keeps the clock itself (sim_local) calls these rather
+        than running the clock as a thread, and can move it on by any number
+        of edges at once with toggle(edge_index(t)).
+
+        Under xsim the clock is always this thread, woken at every edge, so
+        the time it takes still grows with the simulated time. There is no
+        native xsim source for it: the LoopbackPort plugin only connects
+        ports together and can't generate edges.
+    """
 
     (CLK_125MHz, CLK_60MHz, CLK_2_5MHz) = (0x4, 0x2, 0x0)
 
-    def __init__(self, port, clk):
+    FREQUENCIES = {CLK_125MHz : 125000000, CLK_60MHz : 60000000, CLK_2_5MHz : 2500000}
+
+    def __init__(self, port, clk, ppm=0, jitter=0, seed=0):
         self._running = True
         self._clk = clk
         if clk == self.CLK_125MHz:
-            self._period = float(1000000000) / 125000000
             self._name = '125Mhz'
             self._min_ifg = 96
             self._bit_time = 1
         elif clk == self.CLK_60MHz:
-            self._period = float(1000000000) / 60000000
             self._name = '60Mhz'
             self._bit_time = 5 # TODO
         elif clk == self.CLK_2_5MHz:
-            self._period = float(1000000000) / 2500000
             self._name = '2.5Mhz'
             self._bit_time = 100
         self._min_ifg = 96 * self._bit_time
         self._val = 0
         self._port = port
+        self._edge_time = None
+
+        # Edge n is at start + floor(n * _edge_num / _edge_den) ps
+        self._frequency = self.FREQUENCIES[clk]
+        self._ppb = int(round(ppm * 1000))
+        self._edge_num = PS_PER_S * PPB
+        self._edge_den = 2 * self._frequency * (PPB + self._ppb)
+        self._period = 2.0 * self._edge_num / self._edge_den / PS_PER_NS
+        self._half_period = self._period / 2
+
+        if 4 * jitter >= self._edge_num // self._edge_den:
+            raise ValueError("Clock jitter must be less than a quarter of the half period")
+        self._jitter = int(jitter)
+        self._seed = seed
+
+        self._start = 0
+        self._edge = 0
 
     def run(self):
+        self.begin()
         while True:
-            self.wait_until(self.xsi.get_time() + self._period/2)
-            self._val = 1 - self._val
+            self.wait_until(self.next_edge_time())
+            self.toggle()
+
+    def begin(self):
+        """ Starts the clock (edge 0) at the current time """
+        self._start = self._now()
+        self._edge = 0
+        self._edge_time = self.xsi.get_time()
+
+    def toggle(self, edge=None):
+        """ Moves on to the next edge, or on to edge if given, due now """
+        if edge is None:
+            edge = self._edge + 1
+        elif edge == self._edge:
+            return
+        self._edge = edge
+        self._val = self._edge & 1
+        self._edge_time = self.xsi.get_time()
+
+        if self._running:
+            #print "{}".format(self._val)
+            self.xsi.drive_port_pins(self._port, self._val)
+
+    def get_config(self):
+        """ Settings that affect the simulator output, for the result cache """
+        return {'port' : self._port,
+                'frequency' : self._frequency,
+                'ppb' : self._ppb,
+                'jitter' : self._jitter,
+                'seed' : self._seed if self._jitter else None}
+
+    def _now(self):
+        return int(round(self.xsi.get_time() * PS_PER_NS))
+
+    def _jitter_at(self, n):
+        if not self._jitter:
+            return 0
+        return _mix64(self._seed * 0x9e3779b97f4a7c15 + n) % (2 * self._jitter + 1) - self._jitter
+
+    def edge_time(self, n):
+        """ Time of edge n in ps """
+        if n <= 0:
+            return self._start
+        return self._start + (n * self._edge_num) // self._edge_den + self._jitter_at(n)
 
-            if self._running:
-                #print "{}".format(self._val)
-                self.xsi.drive_port_pins(self._port, self._val)
+    def edge_index(self, t):
+        """ Number of the last edge at or before time t (ps) """
+        if t <= self._start:
+            return 0
+        n = ((t - self._start) * self._edge_den) // self._edge_num
+        # Jitter can move an edge either side of its nominal time
+        while self.edge_time(n + 1) <= t:
+            n += 1
+        while n > 0 and self.edge_time(n) > t:
+            n -= 1
+        return n
+
+    def next_rising(self, t):
+        """ Time (ps) of the first rising edge after time t (ps) """
+        n = self.edge_index(t) + 1
+        if not n & 1:
+            n += 1
+        return self.edge_time(n)
+
+    def next_falling(self, t):
+        """ Time (ps) of the first falling edge after time t (ps) """
+        n = self.edge_index(t) + 1
+        if n & 1:
+            n += 1
+        return self.edge_time(n)
+
+    def value_at(self, t):
+        """ Pin value at time t (ps) """
+        return self.edge_index(t) & 1
 
     def is_high(self):
         return (self._val == 1)
@@ -43,6 +162,18 @@ class Clock(xmostest.SimThread):
     def is_low(self):
         return (self._val == 0)
 
+    def next_edge_time(self):
+        """ Returns the time (ns) at which the clock will next toggle, or
+            None if the clock thread hasn't started yet
+        """
+        if self._edge_time is None:
+            return None
+        return float(self.edge_time(self._edge + 1)) / PS_PER_NS
+
+    def get_period(self):
+        """ Nominal period in ns (including the ppm offset) """
+        return self._period
+
     def get_rate(self):
         return self._clk
 
@@ -61,3 +192,53 @@ class Clock(xmostest.SimThread):
 
     def start(self):
         self._running = True
+
+
+class ClockedThread(xmostest.SimThread):
+    """ SimThread that waits on the edges of a Clock (self._clock).
+
+        Subclasses set self._edge_scheduled to choose between jumping to
+        the computed edge times and waiting on a condition every step.
+    """
+
+    _edge_scheduled = True
+    _edge_waits = 0
+    _poll_waits = 0
+
+    def _wait_clock(self, high):
+        """ Equivalent to self.wait(lambda x: self._clock.is_high() == high).
+
+            When edge scheduled, jump straight to the time the clock is due
+            to toggle instead of having the simulator evaluate a condition
+            every step. If the clock thread hasn't toggled yet when this
+            thread wakes (both are scheduled for the same time) fall back to
+            waiting on the condition, so pin timing is unchanged.
+        """
+        clock = self._clock
+        if clock.is_high() == high:
+            return
+
+        if self._edge_scheduled:
+            edge_time = clock.next_edge_time()
+            if edge_time is not None:
+                self._edge_waits += 1
+                self.wait_until(edge_time)
+                if clock.is_high() == high:
+                    return
+
+        self._poll_waits += 1
+        self.wait(lambda x: clock.is_high() == high)
+
+    def wait_clock_high(self):
+        self._wait_clock(True)
+
+    def wait_clock_low(self):
+        self._wait_clock(False)
+
+    def wait_falling_edge(self):
+        self._wait_clock(True)
+        self._wait_clock(False)
+
+    def wait_rising_edge(self):
+        self._wait_clock(False)
+        self._wait_clock(True)
@@ -0,0 +1,259 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Reference model of how an XUD device responds to the host
+#
+# DeviceModel is given the packets from the host (tokens, TxDataPackets and
+# TxHandshakePackets) and returns the packets the DUT should send back, so a
+# test only writes the host side:
+#
+#   model = DeviceModel([Endpoint(1), Endpoint(2, ready=False)])
+#   packets = model.complete(host_packets)
+#   do_rx_test(arch, clk, phy, packets, __file__, seed)
+#
+# and the expect file is written from the completed packets as usual. Long
+# randomised streams can query the state of the model (see campaign.py)
+# while they are generated, through host_packet().
+#
+# For each endpoint and direction it keeps the data toggle, whether an OUT
+# buffer is ready (or the data queued to go IN) and whether it is halted:
+#
+#   OUT/SETUP + DATA  bad CRC or RXERROR: ignored, no handshake
+#                     iso: no handshake
+#                     halted: STALL, not ready: NAK
+#                     expected toggle: ACK, data taken, toggle flips
+#                     other toggle (a retry after a lost ACK): ACK, dropped
+#   SETUP             always ACKed, clears the halt and sets both toggles of
+#                     the endpoint to DATA1 for the data stage
+#   PING              halted: STALL, ready: ACK, otherwise NAK
+#   IN                halted: STALL, nothing queued: NAK (iso: zero length
+#                     DATA0), otherwise the data with the toggle. The host ACK
+#                     flips the toggle and takes the data; without it the
+#                     same data is sent again. Iso is always DATA0 and
+#                     needs no ACK.
+#
+# Tokens that aren't valid (bad CRC5) and tokens to endpoints that aren't
+# configured get no response. SOFs are ignored.
+#
+# What the application does with the data is up to the on_out and on_in
+# callbacks, called with the model, the endpoint number and the data when an
+# OUT is taken and when an IN completes. By default an OUT endpoint is ready
+# again as soon as it has taken data (rearm); loopback() gives the
+# behaviour of the loopback binaries.
+
+from usb_packet import RxDataPacket, RxHandshakePacket, KIND_TX_DATA, KIND_TX_HANDSHAKE
+
+(PID_OUT, PID_IN, PID_SOF, PID_SETUP, PID_PING) = (0x1, 0x9, 0x5, 0xd, 0x4)
+(PID_DATA0, PID_DATA1) = (0x3, 0xb)
+(PID_ACK, PID_NAK, PID_STALL) = (0x2, 0xa, 0xe)
+
+EP_TYPES = ('control', 'bulk', 'interrupt', 'iso')
+
+def full_pid(pid):
+    """ PID byte with its check nibble, as the DUT sends it """
+    return (pid & 0xf) | ((~pid & 0xf) << 4)
+
+
+class Endpoint(object):
+    """ Configuration and state of one direction of an endpoint """
+
+    def __init__(self, number, ep_type='bulk', ready=True, rearm=True, halted=False):
+        if ep_type not in EP_TYPES:
+            raise ValueError("Unknown endpoint type '{}' (one of {})".format(
+                ep_type, ", ".join(EP_TYPES)))
+        self.number = number
+        self.type = ep_type
+        self.ready = ready
+        self.rearm = rearm
+        self.halted = halted
+        self.toggle = 0
+        self.queue = []
+        self.received = []
+
+    @property
+    def is_iso(self):
+        return self.type == 'iso'
+
+    def data_pid(self):
+        return PID_DATA1 if self.toggle and not self.is_iso else PID_DATA0
+
+
+class DeviceModel(object):
+    """ endpoints is a list of Endpoints used for both directions, or a
+        dict with 'out' and 'in' lists. Endpoint 0 is a control endpoint by
+        default.
+    """
+
+    def __init__(self, endpoints=(), on_out=None, on_in=None,
+                 handshake_timeout=None, data_timeout=None):
+        self.out_eps = {}
+        self.in_eps = {}
+        if isinstance(endpoints, dict):
+            (out_eps, in_eps) = (endpoints.get('out', []), endpoints.get('in', []))
+        else:
+            out_eps = endpoints
+            in_eps = [Endpoint(ep.number, ep.type, ready=False, halted=ep.halted)
+                      for ep in endpoints]
+        for ep in out_eps:
+            self.out_eps[ep.number] = ep
+        for ep in in_eps:
+            self.in_eps[ep.number] = ep
+        for eps in (self.out_eps, self.in_eps):
+            if 0 not in eps:
+                eps[0] = Endpoint(0, 'control', ready=eps is self.out_eps)
+
+        self.on_out = on_out
+        self.on_in = on_in
+        self._rx_kwargs = {}
+        if handshake_timeout is not None:
+            self._rx_kwargs['handshake'] = {'timeout' : handshake_timeout}
+        if data_timeout is not None:
+            self._rx_kwargs['data'] = {'timeout' : data_timeout}
+
+        # Token waiting for its DATA packet (OUT/SETUP) or host handshake (IN)
+        self._pending = None
+
+    def set_ready(self, ep, ready=True):
+        """ Marks the buffer of OUT endpoint ep as ready (or not) """
+        self.out_eps[ep].ready = ready
+
+    def queue_in(self, ep, data):
+        """ Queues data to be sent on IN endpoint ep """
+        self.in_eps[ep].queue.append(bytearray(data))
+
+    def halt(self, ep, direction='out', halted=True):
+        eps = self.out_eps if direction == 'out' else self.in_eps
+        eps[ep].halted = halted
+
+    def _handshake(self, pid):
+        return RxHandshakePacket(pid=full_pid(pid), **self._rx_kwargs.get('handshake', {}))
+
+    def _data(self, pid, data):
+        return RxDataPacket(None, pid=pid, data=data, **self._rx_kwargs.get('data', {}))
+
+    def host_packet(self, packet):
+        """ Returns the list of packets the DUT sends in response to packet """
+        pending = self._pending
+        self._pending = None
+
+        if packet.is_token:
+            return self._token(packet)
+        if packet.kind == KIND_TX_DATA and pending and pending[0] in (PID_OUT, PID_SETUP):
+            return self._out_data(pending, packet)
+        if packet.kind == KIND_TX_HANDSHAKE and pending and pending[0] == PID_IN:
+            if packet.pid & 0xf == PID_ACK:
+                self._in_complete(pending[1])
+        # Anything else (data without a token, an IN not ACKed ...) is
+        # dropped
+        return []
+
+    def _token(self, token):
+        pid = token.pid & 0xf
+        if not token.get_token_valid() or pid == PID_SOF:
+            return []
+        ep = token.endpoint
+
+        if pid in (PID_OUT, PID_SETUP, PID_PING):
+            endpoint = self.out_eps.get(ep)
+            if endpoint is None:
+                return []
+            if pid == PID_PING:
+                if endpoint.halted:
+                    return [self._handshake(PID_STALL)]
+                return [self._handshake(PID_ACK if endpoint.ready else PID_NAK)]
+            self._pending = (pid, endpoint)
+            return []
+
+        if pid == PID_IN:
+            endpoint = self.in_eps.get(ep)
+            if endpoint is None:
+                return []
+            if endpoint.halted:
+                return [self._handshake(PID_STALL)]
+            if not endpoint.queue:
+                if endpoint.is_iso:
+                    return [self._data(PID_DATA0, b'')]
+                return [self._handshake(PID_NAK)]
+            response = self._data(endpoint.data_pid(), endpoint.queue[0])
+            if endpoint.is_iso:
+                self._in_complete(endpoint)
+            else:
+                self._pending = (pid, endpoint)
+            return [response]
+
+        return []
+
+    def _out_data(self, pending, packet):
+        (token_pid, endpoint) = pending
+        if packet.bad_crc or packet.rxe_assert_time:
+            # The IFM drops the packet
+            return []
+
+        if token_pid == PID_SETUP:
+            endpoint.halted = False
+            self.in_eps[endpoint.number].halted = False
+            endpoint.toggle = 1
+            self.in_eps[endpoint.number].toggle = 1
+            self._take(endpoint, packet)
+            return [self._handshake(PID_ACK)]
+
+        if endpoint.is_iso:
+            if endpoint.ready:
+                self._take(endpoint, packet)
+            return []
+        if endpoint.halted:
+            return [self._handshake(PID_STALL)]
+        if not endpoint.ready:
+            return [self._handshake(PID_NAK)]
+        if (packet.pid & 0xf) == endpoint.data_pid():
+            endpoint.toggle ^= 1
+            self._take(endpoint, packet)
+        return [self._handshake(PID_ACK)]
+
+    def _take(self, endpoint, packet):
+        data = bytearray(packet.data_bytes)
+        endpoint.received.append(data)
+        endpoint.ready = endpoint.rearm
+        if self.on_out:
+            self.on_out(self, endpoint.number, data)
+
+    def _in_complete(self, endpoint):
+        data = endpoint.queue.pop(0)
+        if not endpoint.is_iso:
+            endpoint.toggle ^= 1
+        if self.on_in:
+            self.on_in(self, endpoint.number, data)
+
+    def complete(self, host_packets, packets=None):
+        """ Appends the host packets, each followed by the DUT's response, to
+            packets (a new list by default) and returns it. host_packets is a
+            list or a PacketTrace; expected packets already in it are
+            replaced.
+        """
+        if packets is None:
+            packets = []
+        for packet in host_packets:
+            if packet.is_rx:
+                continue
+            packets.append(packet)
+            for response in self.host_packet(packet):
+                packets.append(response)
+        return packets
+
+def loopback(eps):
+    """ on_out/on_in callbacks of the loopback binaries for endpoints eps: an
+        OUT is queued to go back IN on the same endpoint and the OUT buffer
+        isn't ready again until it has gone
+    """
+    eps = set(eps)
+
+    def on_out(model, ep, data):
+        if ep in eps:
+            model.queue_in(ep, data)
+            model.set_ready(ep, False)
+
+    def on_in(model, ep, data):
+        if ep in eps:
+            model.set_ready(ep, True)
+
+    return (on_out, on_in)
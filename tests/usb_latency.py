@@ -0,0 +1,207 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Bus turnaround latency
+#
+# UsbPhy timestamps the end of every packet it sends (RXA falling) and every
+# rise of TXV. Each DUT response is paired with the host packet before it,
+# giving the turnaround for token->data, token->handshake and
+# data->handshake, keyed by host PID, endpoint and endpoint type. The kind
+# of response is taken from the PID the DUT sent, so a NAK where data was
+# expected counts as a handshake. A USB 2.0
+# high speed device has to respond within 192 bit times of the end of the
+# host packet.
+
+import json
+
+# Times are in ns, as from xsi.get_time()
+HS_BIT_TIME = 1000.0 / 480
+HS_TURNAROUND_LIMIT_BITS = 192
+HS_TURNAROUND_LIMIT = HS_TURNAROUND_LIMIT_BITS * HS_BIT_TIME
+
+(TURNAROUND_TOKEN_DATA, TURNAROUND_TOKEN_HANDSHAKE, TURNAROUND_DATA_HANDSHAKE) = (
+    'token_to_data', 'token_to_handshake', 'data_to_handshake')
+
+PID_NAMES = {0x1 : 'OUT', 0x9 : 'IN', 0x5 : 'SOF', 0xd : 'SETUP',
+             0x3 : 'DATA0', 0xb : 'DATA1', 0x7 : 'DATA2', 0xf : 'MDATA',
+             0x2 : 'ACK', 0xa : 'NAK', 0xe : 'STALL', 0x6 : 'NYET',
+             0x4 : 'PING'}
+
+DATA_PIDS = (0x3, 0xb, 0x7, 0xf)
+
+PERCENTILES = (50, 90, 99)
+
+def pid_name(pid):
+    return PID_NAMES.get(pid & 0xf, '{0:#x}'.format(pid))
+
+def endpoint_type_from_testname(testname):
+    """ Endpoint type for the endpoints of a test, from the test name """
+    for ep_type in ('bulk', 'iso', 'control', 'int'):
+        if '_{}_'.format(ep_type) in '_{}_'.format(testname):
+            return ep_type
+    return None
+
+def percentile(sorted_values, percent):
+    """ Nearest rank percentile of a sorted list """
+    if not sorted_values:
+        return None
+    rank = int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+class TurnaroundSample(object):
+
+    __slots__ = ('index', 'kind', 'host_pid', 'response_pid', 'endpoint', 'ep_type',
+                 'host_end_time', 'txv_rise_time', 'turnaround', 'clocks')
+
+    def __init__(self, index, kind, host_pid, response_pid, endpoint, ep_type,
+                 host_end_time, txv_rise_time, clock_period):
+        self.index = index
+        self.kind = kind
+        self.host_pid = host_pid
+        self.response_pid = response_pid
+        self.endpoint = endpoint
+        self.ep_type = ep_type
+        self.host_end_time = host_end_time
+        self.txv_rise_time = txv_rise_time
+        self.turnaround = txv_rise_time - host_end_time
+        self.clocks = int(round(self.turnaround / clock_period))
+
+    def group(self):
+        return (self.kind, pid_name(self.host_pid), self.endpoint, self.ep_type)
+
+    def as_dict(self):
+        return {'index' : self.index,
+                'kind' : self.kind,
+                'host_pid' : pid_name(self.host_pid),
+                'response_pid' : pid_name(self.response_pid),
+                'endpoint' : self.endpoint,
+                'ep_type' : self.ep_type,
+                'host_end_time' : self.host_end_time,
+                'txv_rise_time' : self.txv_rise_time,
+                'turnaround_ns' : self.turnaround,
+                'turnaround_clocks' : self.clocks,
+                'turnaround_bit_times' : self.turnaround / HS_BIT_TIME}
+
+
+class LatencyRecorder(object):
+    """ Pairs the end of each host packet with the next rise of TXV. The
+        sample is made once the response has been received (response_end()).
+
+        ep_types maps endpoint numbers to endpoint types. Endpoints not in
+        it are default_ep_type, except endpoint 0 which is control.
+    """
+
+    def __init__(self, clock_period, ep_types=None, default_ep_type=None,
+                 limit=HS_TURNAROUND_LIMIT):
+        self.clock_period = clock_period
+        self.ep_types = ep_types or {}
+        self.default_ep_type = default_ep_type
+        self.limit = limit
+        self.samples = []
+
+        self._host_packet = None
+        self._endpoint = None
+        self._response = None
+
+    def reset(self):
+        self.samples = []
+        self._host_packet = None
+        self._endpoint = None
+        self._response = None
+
+    def get_ep_type(self, endpoint):
+        if endpoint in self.ep_types:
+            return self.ep_types[endpoint]
+        if endpoint == 0:
+            return 'control'
+        return self.default_ep_type
+
+    def host_packet_end(self, packet, time):
+        """ Called when the host (UsbPhy) finishes sending a packet """
+        if packet.is_token:
+            self._endpoint = packet.endpoint
+        self._host_packet = (packet.is_token, packet.pid, time)
+
+    def txv_rise(self, index, expected_packet, time):
+        """ Called when TXV rises for the packet expected_packet """
+        if self._host_packet is None:
+            self._response = None
+            return
+        self._response = (index, expected_packet.pid, self._host_packet, time)
+        self._host_packet = None
+
+    def response_end(self, data):
+        """ Called with the bytes received once TXV falls. Returns the
+            sample, classified by the PID byte sent (the expected PID if no
+            byte was received), or None if there was no host packet before.
+        """
+        if self._response is None:
+            return None
+        (index, expected_pid, (is_token, host_pid, end_time), time) = self._response
+        self._response = None
+
+        response_pid = data[0] & 0xf if len(data) else expected_pid
+        if is_token:
+            if response_pid & 0xf in DATA_PIDS:
+                kind = TURNAROUND_TOKEN_DATA
+            else:
+                kind = TURNAROUND_TOKEN_HANDSHAKE
+        else:
+            kind = TURNAROUND_DATA_HANDSHAKE
+
+        sample = TurnaroundSample(index, kind, host_pid, response_pid, self._endpoint,
+                                  self.get_ep_type(self._endpoint), end_time, time,
+                                  self.clock_period)
+        self.samples.append(sample)
+        return sample
+
+    def summary(self):
+        """ Returns a list of per group summaries: count, min/max, percentiles
+            and a histogram in clocks, and the number over the limit
+        """
+        groups = {}
+        for sample in self.samples:
+            groups.setdefault(sample.group(), []).append(sample)
+
+        summary = []
+        for (group, samples) in sorted(groups.items(), key=lambda item: str(item[0])):
+            (kind, host_pid, endpoint, ep_type) = group
+            clocks = sorted(sample.clocks for sample in samples)
+            histogram = {}
+            for value in clocks:
+                histogram[value] = histogram.get(value, 0) + 1
+
+            entry = {'kind' : kind, 'host_pid' : host_pid, 'endpoint' : endpoint,
+                     'ep_type' : ep_type, 'count' : len(clocks),
+                     'min_clocks' : clocks[0], 'max_clocks' : clocks[-1],
+                     'histogram_clocks' : sorted(histogram.items()),
+                     'over_limit' : len([s for s in samples if s.turnaround > self.limit])}
+            for percent in PERCENTILES:
+                entry['p{}_clocks'.format(percent)] = percentile(clocks, percent)
+            summary.append(entry)
+        return summary
+
+    def format_summary(self):
+        """ Returns the summary as lines of text """
+        lines = ["Turnaround (clocks of {:.3f}ns, limit {:.0f}ns = {} bit times = {:.1f} clocks)".format(
+            self.clock_period, self.limit, HS_TURNAROUND_LIMIT_BITS, self.limit / self.clock_period)]
+        for entry in self.summary():
+            lines.append("  {kind} {host_pid} ep{endpoint} ({ep_type}): n={count} "
+                         "min={min_clocks} p50={p50_clocks} p90={p90_clocks} "
+                         "p99={p99_clocks} max={max_clocks} over_limit={over_limit}".format(**entry))
+            for (value, count) in entry['histogram_clocks']:
+                lines.append("    {:4d} | {}".format(value, '#' * min(count, 60)))
+        return lines
+
+    def write_samples(self, filename):
+        """ Writes the raw samples as JSON lines """
+        with open(filename, 'w') as f:
+            for sample in self.samples:
+                f.write(json.dumps(sample.as_dict(), sort_keys=True) + '\n')
+
+    def write_summary(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'clock_period_ns' : self.clock_period,
+                       'limit_ns' : self.limit,
+                       'groups' : self.summary()}, f, indent=2, sort_keys=True)
@@ -0,0 +1,265 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Passive USB bus monitor
+#
+# UsbMonitor samples the PHY side of the link on each rising clock edge
+# without driving anything: RXA/RXDV/RXD for packets from the host and
+# TXV/TXRDY/TXD for packets from the DUT. Packets are decoded into tokens,
+# data and handshakes, grouped into transactions (a token and the packets
+# after it) and written with their start and end times to a log, as JSON
+# lines or a compact binary log.
+#
+# In the idle state only RXA and TXV are sampled each clock, the rest of the
+# work is done once per packet.
+
+import binascii
+import json
+import struct
+
+from usb_clock import ClockedThread
+from usb_packet import GenCrc16
+
+(DIR_HOST, DIR_DEVICE) = (0, 1)
+DIRECTION_NAMES = ('host', 'device')
+
+(TYPE_TOKEN, TYPE_DATA, TYPE_HANDSHAKE, TYPE_SPECIAL) = range(4)
+TYPE_NAMES = ('token', 'data', 'handshake', 'special')
+
+# PID nibble to (name, type)
+PIDS = {0x1 : ('OUT', TYPE_TOKEN), 0x9 : ('IN', TYPE_TOKEN),
+        0x5 : ('SOF', TYPE_TOKEN), 0xd : ('SETUP', TYPE_TOKEN),
+        0x3 : ('DATA0', TYPE_DATA), 0xb : ('DATA1', TYPE_DATA),
+        0x7 : ('DATA2', TYPE_DATA), 0xf : ('MDATA', TYPE_DATA),
+        0x2 : ('ACK', TYPE_HANDSHAKE), 0xa : ('NAK', TYPE_HANDSHAKE),
+        0xe : ('STALL', TYPE_HANDSHAKE), 0x6 : ('NYET', TYPE_HANDSHAKE),
+        0xc : ('PRE/ERR', TYPE_SPECIAL), 0x8 : ('SPLIT', TYPE_SPECIAL),
+        0x4 : ('PING', TYPE_TOKEN), 0x0 : ('RESERVED', TYPE_SPECIAL)}
+
+MONITOR_MAGIC = b'USBMON\0\0'
+MONITOR_VERSION = 1
+
+# Binary log: header then, per packet, RECORD followed by the packet bytes.
+# RECORD is transaction, start and end time (ns), direction, PID, type,
+# flags (MONITOR_FLAG_*) and the number of bytes.
+MONITOR_HEADER = struct.Struct('<8sHH')
+MONITOR_RECORD = struct.Struct('<IddBBBBH')
+
+MONITOR_FLAG_CRC_OK = 0x1
+MONITOR_FLAG_RX_ERROR = 0x2
+
+class MonitorPacket(object):
+
+    __slots__ = ('transaction', 'start_time', 'end_time', 'direction', 'data', 'flags')
+
+    def __init__(self, transaction, start_time, end_time, direction, data, flags):
+        self.transaction = transaction
+        self.start_time = start_time
+        self.end_time = end_time
+        self.direction = direction
+        self.data = data
+        self.flags = flags
+
+    @property
+    def pid(self):
+        return self.data[0] & 0xf if self.data else None
+
+    @property
+    def pid_name(self):
+        return PIDS[self.pid][0] if self.data else None
+
+    @property
+    def type(self):
+        return PIDS[self.pid][1] if self.data else TYPE_SPECIAL
+
+    @property
+    def endpoint(self):
+        """ Endpoint of a token, as presented by the IFM (PID then EP) """
+        if self.type == TYPE_TOKEN and len(self.data) > 1:
+            return self.data[1]
+        return None
+
+    def as_dict(self):
+        return {'transaction' : self.transaction,
+                'start_time' : self.start_time,
+                'end_time' : self.end_time,
+                'direction' : DIRECTION_NAMES[self.direction],
+                'pid' : self.pid_name,
+                'type' : TYPE_NAMES[self.type],
+                'endpoint' : self.endpoint,
+                'crc_ok' : bool(self.flags & MONITOR_FLAG_CRC_OK) if self.type == TYPE_DATA else None,
+                'rx_error' : bool(self.flags & MONITOR_FLAG_RX_ERROR),
+                'length' : len(self.data),
+                'data' : binascii.hexlify(bytes(self.data)).decode('ascii')}
+
+def data_crc_ok(data):
+    """ Checks the CRC16 of a data packet (PID, payload, CRC16) """
+    if len(data) < 3:
+        return False
+    crc = GenCrc16(data[1:-2])
+    return data[-2] == (crc & 0xff) and data[-1] == (crc >> 8)
+
+
+class MonitorLog(object):
+    """ Writes MonitorPackets to a JSON lines file if filename ends in .jsonl,
+        otherwise to a binary log
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._jsonl = filename.endswith('.jsonl')
+        self._file = open(filename, 'w' if self._jsonl else 'wb')
+        if not self._jsonl:
+            self._file.write(MONITOR_HEADER.pack(MONITOR_MAGIC, MONITOR_VERSION, 0))
+
+    def write(self, packet):
+        if self._jsonl:
+            self._file.write(json.dumps(packet.as_dict(), sort_keys=True) + '\n')
+        else:
+            self._file.write(MONITOR_RECORD.pack(packet.transaction, packet.start_time,
+                                                 packet.end_time, packet.direction,
+                                                 packet.pid or 0, packet.type,
+                                                 packet.flags, len(packet.data)))
+            self._file.write(bytes(packet.data))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+def read_monitor_log(filename):
+    """ Reads a log written by MonitorLog, returning a list of MonitorPackets """
+    packets = []
+    if filename.endswith('.jsonl'):
+        with open(filename) as f:
+            for line in f:
+                record = json.loads(line)
+                flags = 0
+                if record['crc_ok']:
+                    flags |= MONITOR_FLAG_CRC_OK
+                if record['rx_error']:
+                    flags |= MONITOR_FLAG_RX_ERROR
+                packets.append(MonitorPacket(record['transaction'], record['start_time'],
+                                             record['end_time'],
+                                             DIRECTION_NAMES.index(record['direction']),
+                                             bytearray(binascii.unhexlify(record['data'])),
+                                             flags))
+        return packets
+
+    with open(filename, 'rb') as f:
+        content = f.read()
+    (magic, version, flags) = MONITOR_HEADER.unpack_from(content, 0)
+    if magic != MONITOR_MAGIC:
+        raise ValueError("{} is not a monitor log".format(filename))
+    if version != MONITOR_VERSION:
+        raise ValueError("{}: unsupported monitor log version {}".format(filename, version))
+
+    offset = MONITOR_HEADER.size
+    while offset < len(content):
+        (transaction, start_time, end_time, direction, pid, packet_type, flags,
+            length) = MONITOR_RECORD.unpack_from(content, offset)
+        offset += MONITOR_RECORD.size
+        packets.append(MonitorPacket(transaction, start_time, end_time, direction,
+                                     bytearray(content[offset:offset + length]), flags))
+        offset += length
+    return packets
+
+def group_transactions(packets):
+    """ Returns a list of lists of packets, one per transaction """
+    transactions = []
+    for packet in packets:
+        if not transactions or transactions[-1][0].transaction != packet.transaction:
+            transactions.append([])
+        transactions[-1].append(packet)
+    return transactions
+
+
+class UsbMonitor(ClockedThread):
+    """ Passive monitor of the PHY side of the link. Give it the same port
+        names as the UsbPhy (see from_phy()).
+    """
+
+    def __init__(self, rxd, rxa, rxdv, rxer, txd, txv, txrdy, clock, filename=None,
+                 edge_scheduled=True, packet_fn=None):
+        self._rxd = rxd
+        self._rxa = rxa
+        self._rxdv = rxdv
+        self._rxer = rxer
+        self._txd = txd
+        self._txv = txv
+        self._txrdy = txrdy
+        self._clock = clock
+        self._edge_scheduled = edge_scheduled
+        self._packet_fn = packet_fn
+        self._log = MonitorLog(filename) if filename else None
+        self.transaction = 0
+        self.packets = 0
+
+    @classmethod
+    def from_phy(cls, phy, filename=None, **kwargs):
+        return cls(phy._rxd, phy._rxa, phy._rxdv, phy._rxer, phy._txd, phy._txv,
+                   phy._txrdy, phy.get_clock(), filename,
+                   edge_scheduled=phy._edge_scheduled, **kwargs)
+
+    def get_name(self):
+        return 'monitor'
+
+    def _packet(self, start_time, direction, data, rx_error):
+        flags = MONITOR_FLAG_RX_ERROR if rx_error else 0
+        packet = MonitorPacket(self.transaction, start_time, self.xsi.get_time(),
+                               direction, data, flags)
+        packet_type = packet.type
+        if packet_type == TYPE_TOKEN:
+            # A token starts a new transaction
+            self.transaction += 1
+            packet.transaction = self.transaction
+        elif packet_type == TYPE_DATA and data_crc_ok(data):
+            packet.flags |= MONITOR_FLAG_CRC_OK
+
+        self.packets += 1
+        if self._log:
+            self._log.write(packet)
+            if packet_type == TYPE_HANDSHAKE:
+                # End of a transaction
+                self._log.flush()
+        if self._packet_fn:
+            self._packet_fn(packet, self)
+
+    def close(self):
+        if self._log:
+            self._log.close()
+
+    def run(self):
+        xsi = self.xsi
+        rxa = self._rxa
+        txv = self._txv
+
+        while True:
+            self.wait_rising_edge()
+
+            if xsi.sample_port_pins(rxa) == 1:
+                # Packet from the host: a byte on each clock RXDV is high
+                start_time = xsi.get_time()
+                data = bytearray()
+                rx_error = False
+                while xsi.sample_port_pins(rxa) == 1:
+                    if xsi.sample_port_pins(self._rxdv) == 1:
+                        data.append(xsi.sample_port_pins(self._rxd) & 0xff)
+                    if xsi.sample_port_pins(self._rxer) == 1:
+                        rx_error = True
+                    self.wait_rising_edge()
+                if data:
+                    self._packet(start_time, DIR_HOST, data, rx_error)
+
+            elif xsi.sample_port_pins(txv) == 1:
+                # Packet from the DUT: a byte on each clock TXRDY accepts
+                start_time = xsi.get_time()
+                data = bytearray()
+                while xsi.sample_port_pins(txv) == 1:
+                    if xsi.sample_port_pins(self._txrdy) == 1:
+                        data.append(xsi.sample_port_pins(self._txd) & 0xff)
+                    self.wait_rising_edge()
+                if data:
+                    self._packet(start_time, DIR_DEVICE, data, False)
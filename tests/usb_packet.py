@@ -4,6 +4,8 @@
 import sys
 import zlib
 import random
+from array import array
+from usb_payload import get_payload_generator, random_bytes, StepPayload
 
 def AppendSetupToken(packets, ep, **kwargs):
     ipg = kwargs.pop('inter_pkt_gap', 500) 
@@ -46,79 +48,271 @@ def reflect(val, numBits):
     
     return valRef;
 
+# CRC16 used for USB data packets (poly 0x8005, init 0xffff, inverted output).
+# The bit-serial form reflects every input byte and the final CRC, so the
+# equivalent table is built from the reflected polynomial and processes
+# bytes LSB first without any reflection in the inner loop.
+CRC16_POLY_REFLECTED = 0xa001
+
+# CRC value used in place of the real CRC when a packet is built with bad_crc
+BAD_CRC16 = 0xbeef
+
+def _make_crc16_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for k in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ CRC16_POLY_REFLECTED
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _make_crc16_table()
+
+try:
+    import numpy
+    _CRC16_TABLE_NP = numpy.array(CRC16_TABLE, dtype=numpy.uint32)
+except ImportError:
+    numpy = None
+
+def _as_byte_buffer(data):
+    # bytearray iterates as ints on all supported Pythons (str/bytes and
+    # memoryview do not on Python 2). Lists of ints are masked to 8 bits to
+    # match the bit-serial implementation.
+    if isinstance(data, bytearray):
+        return data
+    if isinstance(data, (bytes, memoryview)):
+        return bytearray(data)
+    return bytearray([int(byte) & 0xff for byte in data])
+
 def GenCrc16(args):
+    """ Returns the USB CRC16 of a payload. Accepts bytes, bytearray,
+        memoryview or any iterable of ints.
+    """
+    table = CRC16_TABLE
+    crc = 0xffff
+
+    for byte in _as_byte_buffer(args):
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xff]
+
+    return ~crc & 0xffff
+
+def GenCrc16Batch(payloads, use_numpy=None):
+    """ Returns a list of CRC16 values, one per payload.
+
+        When NumPy is available (and use_numpy is not False) all payloads are
+        processed together, one byte column at a time, so the Python overhead
+        is proportional to the longest payload rather than the total number
+        of bytes.
+    """
+    buffers = [_as_byte_buffer(payload) for payload in payloads]
+
+    if use_numpy is None:
+        use_numpy = numpy is not None and len(buffers) > 1
+    elif use_numpy and numpy is None:
+        raise ImportError("NumPy is required for use_numpy=True")
+
+    if not use_numpy:
+        return [GenCrc16(buf) for buf in buffers]
+
+    # Sort longest first so the rows still active at column j are always a
+    # prefix of the matrix
+    order = sorted(range(len(buffers)), key=lambda i: len(buffers[i]), reverse=True)
+    lengths = numpy.array([len(buffers[i]) for i in order], dtype=numpy.int64)
+    max_len = int(lengths[0]) if len(lengths) else 0
+
+    matrix = numpy.zeros((len(buffers), max_len), dtype=numpy.uint32)
+    for row, i in enumerate(order):
+        if lengths[row]:
+            matrix[row, :lengths[row]] = numpy.frombuffer(buffers[i], dtype=numpy.uint8)
+
+    crcs = numpy.full(len(buffers), 0xffff, dtype=numpy.uint32)
+    active = len(buffers)
+    for col in range(max_len):
+        while active and lengths[active-1] <= col:
+            active -= 1
+        crc = crcs[:active]
+        crcs[:active] = (crc >> 8) ^ _CRC16_TABLE_NP[(crc ^ matrix[:active, col]) & 0xff]
+
+    crcs = ~crcs & 0xffff
+    result = [0] * len(buffers)
+    for row, i in enumerate(order):
+        result[i] = int(crcs[row])
+    return result
+
+# CRC5 used for USB tokens (poly 0x05, init 0x1f, inverted output), covering
+# the 11-bit field ADDR[6:0] | EP[3:0] << 7. Indexing matches crc5Table in
+# lib_xud/src/core/XUD_CRC5_Table.S
+CRC5_POLY_REFLECTED = 0x14
+
+def _make_crc5_table():
+    table = []
+    for field in range(2048):
+        crc = 0x1f
+        for k in range(11):
+            if (crc ^ (field >> k)) & 1:
+                crc = (crc >> 1) ^ CRC5_POLY_REFLECTED
+            else:
+                crc >>= 1
+        table.append(crc ^ 0x1f)
+    return tuple(table)
 
-    data = args
-  
-    crc = 0xffff;
-    poly = 0x8005;
+CRC5_TABLE = _make_crc5_table()
 
-    for byte in  data:
-        topBit = 1 << 15;
-        crc ^= reflect(int(byte) & int(0xFF), 8) << 8; 
+# The two bytes following the PID of a token, i.e. ADDR/EP/CRC5 packed LSB
+# first, for every address/endpoint combination
+TOKEN_FIELD_TABLE = tuple(
+    ((field & 0xff), ((field >> 8) | (CRC5_TABLE[field] << 3)) & 0xff)
+    for field in range(2048))
 
-        for k in range(0,8):
-            if crc & topBit:
-                crc = (crc << 1) ^ poly;
-            else:
-                crc <<= 1;
+def token_field(address, endpoint):
+    return (address & 0x7f) | ((endpoint & 0xf) << 7)
 
-    #//crc = crc ^0xffff;
-    crc = reflect(crc,16);
-    crc = ~crc;
-    crc = crc & 0xffff;
-    #print "CRC: : {0:#x}".format(crc)
-    return crc;
+def GenCrc5(address, endpoint):
+    return CRC5_TABLE[token_field(address, endpoint)]
 
-# Functions for creating the data contents of packets
+# Functions for creating the data contents of packets. args is
+# (generator name, generator args) where the last generator arg is the number
+# of data bytes, e.g. ('step', (1, 10))
 def create_data(args):
     f_name,f_args = args
-    func = 'create_data_{}'.format(f_name)
-    return globals()[func](f_args)
+    generator = get_payload_generator(f_name, *f_args[:-1])
+    return list(bytearray(generator.payload(f_args[-1])))
 
 def create_data_step(args):
-    step,num_data_bytes = args
-    return [(step * i) & 0xff for i in range(num_data_bytes)]
+    return create_data(('step', args))
 
 def create_data_same(args):
-    value,num_data_bytes = args
-    return [value & 0xff for i in range(num_data_bytes)]
+    return create_data(('same', args))
 
 
 # Functions for creating the expected output that the DUT will print given
 # this packet
 def create_data_expect(args):
     f_name,f_args = args
-    func = 'create_data_expect_{}'.format(f_name)
-    return globals()[func](f_args)
+    return get_payload_generator(f_name, *f_args[:-1]).expect()
 
 def create_data_expect_step(args):
-    step,num_data_bytes = args
-    return "Step = {0}\n".format(step)
+    return create_data_expect(('step', args))
 
 def create_data_expect_same(args):
-    value,num_data_bytes = args
-    return "Value = {0}\n".format(value)
+    return create_data_expect(('same', args))
+
+# Shared source of the default incrementing payload (data_start_val)
+_INCREMENTING_PAYLOAD = StepPayload(1)
+
+def _to_bytes(values):
+    return bytes(bytearray(values))
+
+# Packets are stored in __slots__ and their wire encoding (PID, payload and
+# CRC) is built once and cached as an immutable bytes object. All slots live
+# on UsbPacket so that the Rx/Tx and Data/Token/Handshake classes can still
+# be combined through multiple inheritance.
+#
+# Token and handshake packets can't be modified once encoded. Assigning the
+# pid or bad_crc of a data packet encodes it again.
+
+class _SharedPacketType(type):
+    """ Metaclass for packets with no payload (tokens and handshakes). These
+        are immutable, so constructing one with the same arguments as an
+        existing instance returns that instance.
+    """
+
+    MAX_SHARED_INSTANCES = 65536
+
+    _instances = {}
+
+    def __call__(cls, **kwargs):
+        key = (cls,) + tuple(sorted(kwargs.items()))
+        instances = _SharedPacketType._instances
+        try:
+            return instances[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable argument, don't share
+            return super(_SharedPacketType, cls).__call__(**kwargs)
+
+        if len(instances) >= cls.MAX_SHARED_INSTANCES:
+            instances.clear()
+        instance = super(_SharedPacketType, cls).__call__(**kwargs)
+        instances[key] = instance
+        return instance
+
+_SharedPacketBase = _SharedPacketType('_SharedPacketBase', (object,), {'__slots__': ()})
+
+class SharedPacket(_SharedPacketBase):
+    """ Mixin making a packet immutable once its wire encoding is cached.
+    """
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        try:
+            frozen = self._wire_bytes is not None
+        except AttributeError:
+            frozen = False
+
+        if frozen:
+            raise AttributeError("{} is immutable".format(type(self).__name__))
+
+        super(SharedPacket, self).__setattr__(name, value)
+
+# Packet kinds, as stored in a PacketTrace
+(KIND_TOKEN, KIND_TX_DATA, KIND_RX_DATA, KIND_TX_HANDSHAKE, KIND_RX_HANDSHAKE) = range(1, 6)
 
 # Lowest base class for all packets. All USB packets have:
 # - a PID
 # - some (or none) data bytes
 class UsbPacket(object):
 
+    __slots__ = ('pid', 'num_data_bytes', 'data_valid_count', 'bad_crc',
+                 # RxPacket
+                 'timeout',
+                 # TxPacket
+                 'inter_pkt_gap', 'rxa_start_delay', 'rxa_end_delay',
+                 'rxe_assert_time', 'rxe_assert_length',
+                 # TokenPacket
+                 'endpoint', 'address', 'valid', 'crc5', 'field_low', 'field_high',
+                 # Cached encoding of the packet as sent on the bus
+                 '_wire_bytes')
+
+    kind = None
+    is_rx = False
+    is_token = False
+
     def __init__(self, **kwargs):
+        self._wire_bytes = None
         self.pid = kwargs.pop('pid', 0xc3) 
         self.num_data_bytes = kwargs.pop('length', 0)
-        self.data_bytes = None
         self.data_valid_count = kwargs.pop('data_valid_count', 0)
         self.bad_crc = kwargs.pop('bad_crc', False)
 
     def get_data_valid_count(self):
         return self.data_valid_count
 
+    # Bytes of the packet as sent on the bus. DataPacket encodes them when
+    # it is created, tokens and handshakes with their encode() on first use
+    def get_wire_bytes(self):
+        wire_bytes = self._wire_bytes
+        if wire_bytes is None:
+            wire_bytes = self._wire_bytes = self.encode()
+        return wire_bytes
+
+    def get_bytes(self):
+        # bytearray rather than the cached bytes: it iterates as ints on all
+        # Python versions and callers are free to modify it
+        return bytearray(self.get_wire_bytes())
+
 
 #Rx to host i.e. xCORE Tx
 class RxPacket(UsbPacket):
 
+    __slots__ = ()
+
+    is_rx = True
+
     def __init__(self, **kwargs):
         self.timeout = kwargs.pop('timeout', 8)
         super(RxPacket, self).__init__(**kwargs)
@@ -130,6 +324,8 @@ class RxPacket(UsbPacket):
 #Tx from host i.e. xCORE Rx
 class TxPacket(UsbPacket):
 
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         self.inter_pkt_gap = kwargs.pop('inter_pkt_gap', 13) #13 lowest working for single issue loopback
         self.rxa_start_delay = kwargs.pop('rxa_start_delay', 2)
@@ -141,106 +337,456 @@ class TxPacket(UsbPacket):
     def get_inter_pkt_gap(self):
         return self.inter_pkt_gap
 
+def _encoded_slot(slot):
+    """ Property over a slot of UsbPacket that encodes a data packet again
+        when set, as the payload is only held in the encoding
+    """
+    def set_encoded(self, value):
+        slot.__set__(self, value)
+        wire_bytes = self._wire_bytes
+        if wire_bytes is not None:
+            self._wire_bytes = self.encode_payload(wire_bytes[1:-2])
+    return property(slot.__get__, set_encoded)
+
 # DataPacket class, inherits from Usb Packet
+#
+# The payload is, in order of precedence:
+# - data: explicit bytes (or any buffer/list of ints)
+# - data_gen: the next 'length' bytes from a usb_payload.PayloadGenerator
+# - data_random: 'length' bytes from the rand passed to the Rx/TxDataPacket
+# - otherwise bytes incrementing from data_start_val (default 0)
 class DataPacket(UsbPacket):
 
+    __slots__ = ()
+
+    pid = _encoded_slot(UsbPacket.pid)
+    bad_crc = _encoded_slot(UsbPacket.bad_crc)
+
     def __init__(self, **kwargs):
         super(DataPacket, self).__init__(**kwargs)
         self.pid = kwargs.pop('pid', 0x3) #DATA0
         data_start_val = kwargs.pop('data_start_val', None)
-
-        if data_start_val != None:
-            self.data_bytes = [x+data_start_val for x in range(self.num_data_bytes)]
+        data = kwargs.pop('data', None)
+        data_gen = kwargs.pop('data_gen', None)
+        data_random = kwargs.pop('data_random', False)
+        rand = kwargs.pop('rand', None)
+
+        if data is not None:
+            payload = data
+        elif data_gen is not None:
+            payload = data_gen.payload(self.num_data_bytes)
+        elif data_random:
+            payload = random_bytes(rand or random, self.num_data_bytes)
         else:
-            self.data_bytes = [x for x in range(self.num_data_bytes)]
+            if data_start_val == None:
+                data_start_val = 0
+            payload = _INCREMENTING_PAYLOAD.get(data_start_val, self.num_data_bytes)
 
+        self._wire_bytes = self.encode_payload(payload)
+
+    def encode_payload(self, payload):
+        # PID, payload then the 2 bytes of CRC
+        wire_bytes = bytearray([self.pid & 0xff])
+        wire_bytes += bytearray(payload)
+        self.num_data_bytes = len(wire_bytes) - 1
+
+        if self.bad_crc == True:
+            crc = BAD_CRC16
+        else:    
+            crc = self.get_crc(wire_bytes[1:])
+
+        wire_bytes.append(crc & 0xff)
+        wire_bytes.append(crc >> 8)
+        return bytes(wire_bytes)
+
+    # Payload without the PID and CRC
+    @property
+    def data_bytes(self):
+        return self.get_wire_bytes()[1:-2]
 
     def get_packet_bytes(self):
-        packet_bytes = []
-        packet_bytes = self.data_bytes
-        return packet_bytes
+        return bytearray(self.data_bytes)
     
     def get_crc(self, packet_bytes):
         crc = GenCrc16(packet_bytes)   
         return crc
 
-    def get_bytes(self):
-        bytes = []
-
-        bytes.append(self.pid)
 
-        packet_bytes = self.get_packet_bytes()
-        for byte in packet_bytes:
-            bytes.append(byte)
-
-        if self.bad_crc == True:
-            crc = 0xbeef
-        else:    
-            crc = self.get_crc(packet_bytes)
-
-        # Append the 2 bytes of CRC onto the packet
-        for i in range(0, 2):
-            bytes.append((crc >> (8*i)) & 0xff)
-
-        return bytes
+class RxDataPacket(RxPacket, DataPacket):
 
+    __slots__ = ()
 
-class RxDataPacket(RxPacket, DataPacket):
+    kind = KIND_RX_DATA
     
     def __init__(self, rand, **kwargs):
-        _pid = self.pid = kwargs.pop('pid', 0x3) #DATA0
+        _pid = kwargs.pop('pid', 0x3) #DATA0
 
         #Re-construct full PID - xCORE sends out full PIDn | PID on Tx
-        super(RxDataPacket, self).__init__(pid = (_pid & 0xf) | (((~_pid)&0xf) << 4), **kwargs)
+        super(RxDataPacket, self).__init__(pid = (_pid & 0xf) | (((~_pid)&0xf) << 4), rand=rand, **kwargs)
 
 class TxDataPacket(TxPacket, DataPacket):
 
+    __slots__ = ()
+
+    kind = KIND_TX_DATA
+
     def __init__(self, rand, **kwargs):
-        super(TxDataPacket, self).__init__(**kwargs)
+        super(TxDataPacket, self).__init__(rand=rand, **kwargs)
         #self.inter_pkt_gap = kwargs.pop('inter_pkt_gap', 13) #13 lowest working for single issue loopback
 
 
 #Always TX
-class TokenPacket(TxPacket):
+class TokenPacket(SharedPacket, TxPacket):
+    """ Token from the host. get_token_bytes() returns the full token as
+        seen on the bus (PID, ADDR/EP and CRC5). get_bytes() returns what
+        the IFM presents to the xCORE after it has checked the address and
+        CRC5: the PID nibble followed by the endpoint. A token with a bad
+        CRC5 is reported as not valid.
+
+        The CRC5 can be corrupted with bad_crc=True or overridden with an
+        explicit crc5 value.
+    """
+
+    __slots__ = ()
+
+    kind = KIND_TOKEN
+    is_token = True
 
     def __init__(self, **kwargs):
         super(TokenPacket, self).__init__(**kwargs)
         self.endpoint = kwargs.pop('endpoint', 0)
+        self.address = kwargs.pop('address', 0)
         self.valid = kwargs.pop('valid', 1)
+
+        field = token_field(self.address, self.endpoint)
+        (self.field_low, field_high) = TOKEN_FIELD_TABLE[field]
+
+        crc5 = kwargs.pop('crc5', None)
+        if crc5 is None:
+            crc5 = CRC5_TABLE[field]
+            if self.bad_crc:
+                crc5 ^= 0x1f
+        self.crc5 = crc5 & 0x1f
+        self.field_high = (field_high & 0x7) | (self.crc5 << 3)
  
         # Always override to match IFM
         self.data_valid_count = 4 #todo
 
-    def get_bytes(self):
-        bytes = []
-        bytes.append(self.pid & 0xf)
-        bytes.append(self.endpoint)
-        return bytes
+        self.get_wire_bytes()
+
+    def encode(self):
+        return _to_bytes([self.pid & 0xf, self.endpoint])
+
+    def get_token_bytes(self):
+        return bytearray([self.pid, self.field_low, self.field_high])
+
+    def crc5_ok(self):
+        return self.crc5 == CRC5_TABLE[token_field(self.address, self.endpoint)]
 
     # Token valid
     def get_token_valid(self):
-        return self.valid
+        return self.valid and self.crc5_ok()
+
+class HandshakePacket(SharedPacket, UsbPacket):
 
-class HandshakePacket(UsbPacket):
+    __slots__ = ()
     
     def __init__(self, **kwargs):
         super(HandshakePacket, self).__init__(**kwargs)
         self.pid = kwargs.pop('pid', 0x2) #Default to ACK
 
-    def get_bytes(self):
-        bytes = []
-        bytes.append(self.pid)
-        return bytes
+    def encode(self):
+        return _to_bytes([self.pid])
 
 class RxHandshakePacket(HandshakePacket, RxPacket):
 
+    __slots__ = ()
+
+    kind = KIND_RX_HANDSHAKE
+
     def __init__(self, **kwargs):
         super(RxHandshakePacket, self).__init__(**kwargs)
         self.pid = kwargs.pop('pid', 0xd2) #Default to ACK (not expect inverted bits on Rx)
         self.timeout = kwargs.pop('timeout', 9) 
+        self.get_wire_bytes()
 
 class TxHandshakePacket(HandshakePacket, TxPacket):
+
+    __slots__ = ()
+
+    kind = KIND_TX_HANDSHAKE
     
     def __init__(self, **kwargs):
         super(TxHandshakePacket, self).__init__(**kwargs)
+        self.get_wire_bytes()
+
+
+# Bits of the PacketTrace flags column
+(TRACE_FLAG_BAD_CRC, TRACE_FLAG_VALID) = (0x1, 0x2)
+
+DATA_KINDS = (KIND_TX_DATA, KIND_RX_DATA)
+RX_KINDS = (KIND_RX_DATA, KIND_RX_HANDSHAKE)
+
+class PacketTrace(object):
+    """ Packet sequence held as columns of compact arrays, with the payloads
+        of all data packets in one contiguous buffer.
+
+        Packets can be appended as objects (so the Append*Token helpers work
+        on a trace as they do on a list) and indexing a trace builds the
+        equivalent packet object. iter_packets() walks the trace through a
+        single reusable cursor instead of creating an object per packet.
+    """
+
+    # (column name, array typecode)
+    COLUMNS = (
+        ('kind',              'B'),
+        ('pid',               'B'),
+        ('flags',             'B'),
+        ('data_valid_count',  'B'),
+        ('endpoint',          'B'),
+        ('address',           'B'),
+        ('crc5',              'B'),
+        ('crc16',             'H'),
+        ('inter_pkt_gap',     'I'),
+        ('timeout',           'I'),
+        ('rxa_start_delay',   'H'),
+        ('rxa_end_delay',     'H'),
+        ('rxe_assert_time',   'I'),
+        ('rxe_assert_length', 'H'),
+        ('payload_offset',    'L'),
+        ('payload_length',    'I'),
+    )
+
+    def __init__(self, packets=None):
+        for (name, typecode) in self.COLUMNS:
+            setattr(self, name, array(typecode))
+        self.payload = bytearray()
+
+        if packets is not None:
+            self.extend(packets)
+
+    @classmethod
+    def from_packets(cls, packets):
+        return cls(packets)
+
+    def __len__(self):
+        return len(self.kind)
+
+    def append(self, packet):
+        kind = packet.kind
+        if kind is None:
+            raise ValueError("Cannot add a {} to a PacketTrace".format(type(packet).__name__))
+
+        flags = TRACE_FLAG_BAD_CRC if packet.bad_crc else 0
+        endpoint = address = crc5 = crc16 = 0
+        payload_offset = len(self.payload)
+        payload_length = 0
+        timeout = 0
+        tx = (0, 0, 0, 0, 0)
+
+        if kind == KIND_TOKEN:
+            endpoint = packet.endpoint
+            address = packet.address
+            crc5 = packet.crc5
+            if packet.valid:
+                flags |= TRACE_FLAG_VALID
+        elif kind in DATA_KINDS:
+            wire_bytes = packet.get_wire_bytes()
+            self.payload += wire_bytes[1:-2]
+            payload_length = len(wire_bytes) - 3
+            crc16 = bytearray(wire_bytes[-2:])
+            crc16 = crc16[0] | (crc16[1] << 8)
+
+        if packet.is_rx:
+            timeout = packet.timeout
+        else:
+            tx = (packet.inter_pkt_gap, packet.rxa_start_delay, packet.rxa_end_delay,
+                  packet.rxe_assert_time, packet.rxe_assert_length)
+
+        self.kind.append(kind)
+        self.pid.append(packet.pid & 0xff)
+        self.flags.append(flags)
+        self.data_valid_count.append(packet.data_valid_count)
+        self.endpoint.append(endpoint)
+        self.address.append(address)
+        self.crc5.append(crc5)
+        self.crc16.append(crc16)
+        self.timeout.append(timeout)
+        self.inter_pkt_gap.append(tx[0])
+        self.rxa_start_delay.append(tx[1])
+        self.rxa_end_delay.append(tx[2])
+        self.rxe_assert_time.append(tx[3])
+        self.rxe_assert_length.append(tx[4])
+        self.payload_offset.append(payload_offset)
+        self.payload_length.append(payload_length)
+
+    def extend(self, packets):
+        for packet in packets:
+            self.append(packet)
+
+    def get_payload(self, i):
+        """ Returns a zero-copy view of the payload of packet i """
+        offset = self.payload_offset[i]
+        return memoryview(self.payload)[offset:offset + self.payload_length[i]]
+
+    def get_wire_bytes(self, i):
+        kind = self.kind[i]
+        if kind == KIND_TOKEN:
+            return _to_bytes([self.pid[i] & 0xf, self.endpoint[i]])
+        elif kind in DATA_KINDS:
+            crc = self.crc16[i]
+            return (_to_bytes([self.pid[i]]) + _to_bytes(self.get_payload(i))
+                    + _to_bytes([crc & 0xff, crc >> 8]))
+        return _to_bytes([self.pid[i]])
+
+    def total_wire_bytes(self):
+        # PID plus either the endpoint (tokens) or payload and CRC16 (data)
+        total = len(self) + sum(self.payload_length)
+        for kind in self.kind:
+            if kind == KIND_TOKEN:
+                total += 1
+            elif kind in DATA_KINDS:
+                total += 2
+        return total
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("PacketTrace index out of range")
+
+        kind = self.kind[i]
+        flags = self.flags[i]
+        kwargs = {'pid' : self.pid[i]}
+        if flags & TRACE_FLAG_BAD_CRC:
+            kwargs['bad_crc'] = True
+        if self.data_valid_count[i]:
+            kwargs['data_valid_count'] = self.data_valid_count[i]
+
+        if kind in RX_KINDS:
+            kwargs['timeout'] = self.timeout[i]
+        else:
+            kwargs.update(inter_pkt_gap=self.inter_pkt_gap[i],
+                          rxa_start_delay=self.rxa_start_delay[i],
+                          rxa_end_delay=self.rxa_end_delay[i],
+                          rxe_assert_time=self.rxe_assert_time[i],
+                          rxe_assert_length=self.rxe_assert_length[i])
+
+        if kind == KIND_TOKEN:
+            # Token always uses a data valid count of 4
+            kwargs.pop('data_valid_count', None)
+            kwargs.update(endpoint=self.endpoint[i], address=self.address[i],
+                          valid=1 if flags & TRACE_FLAG_VALID else 0)
+            if self.crc5[i] != GenCrc5(self.address[i], self.endpoint[i]):
+                kwargs['crc5'] = self.crc5[i]
+            return TokenPacket(**kwargs)
+        elif kind == KIND_TX_DATA:
+            return TxDataPacket(None, data=self.get_payload(i), **kwargs)
+        elif kind == KIND_RX_DATA:
+            return RxDataPacket(None, data=self.get_payload(i), **kwargs)
+        elif kind == KIND_TX_HANDSHAKE:
+            return TxHandshakePacket(**kwargs)
+        return RxHandshakePacket(**kwargs)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_packets(self):
+        return list(self)
+
+    def iter_packets(self):
+        """ Yields the same PacketTraceCursor for every packet, positioned on
+            that packet. Do not keep references to it between iterations.
+        """
+        cursor = PacketTraceCursor(self)
+        for i in range(len(self)):
+            cursor.index = i
+            yield cursor
+
+class PacketTraceCursor(object):
+    """ Read-only view of one packet in a PacketTrace, providing the parts of
+        the packet interface used by the PHY and expect file generation.
+    """
+
+    __slots__ = ('trace', 'index')
+
+    def __init__(self, trace, index=0):
+        self.trace = trace
+        self.index = index
+
+    @property
+    def kind(self):
+        return self.trace.kind[self.index]
+
+    @property
+    def is_rx(self):
+        return self.trace.kind[self.index] in RX_KINDS
+
+    @property
+    def is_token(self):
+        return self.trace.kind[self.index] == KIND_TOKEN
+
+    @property
+    def pid(self):
+        return self.trace.pid[self.index]
+
+    @property
+    def endpoint(self):
+        return self.trace.endpoint[self.index]
+
+    @property
+    def inter_pkt_gap(self):
+        return self.trace.inter_pkt_gap[self.index]
+
+    @property
+    def rxa_start_delay(self):
+        return self.trace.rxa_start_delay[self.index]
+
+    @property
+    def rxa_end_delay(self):
+        return self.trace.rxa_end_delay[self.index]
+
+    @property
+    def rxe_assert_time(self):
+        return self.trace.rxe_assert_time[self.index]
+
+    @property
+    def rxe_assert_length(self):
+        return self.trace.rxe_assert_length[self.index]
+
+    def get_timeout(self):
+        return self.trace.timeout[self.index]
+
+    def get_inter_pkt_gap(self):
+        return self.trace.inter_pkt_gap[self.index]
+
+    def get_data_valid_count(self):
+        return self.trace.data_valid_count[self.index]
 
+    def get_token_valid(self):
+        trace = self.trace
+        i = self.index
+        return (trace.flags[i] & TRACE_FLAG_VALID and
+                trace.crc5[i] == GenCrc5(trace.address[i], trace.endpoint[i]))
+
+    def get_wire_bytes(self):
+        return self.trace.get_wire_bytes(self.index)
+
+    def get_bytes(self):
+        return bytearray(self.trace.get_wire_bytes(self.index))
+
+    def get_packet(self):
+        return self.trace[self.index]
+
+def iter_packets(packets):
+    """ Iterates over either a list of packets or a PacketTrace """
+    if isinstance(packets, PacketTrace):
+        return packets.iter_packets()
+    return iter(packets)
+
+def total_wire_bytes(packets):
+    """ Total number of bytes on the bus for a list of packets or a PacketTrace """
+    if isinstance(packets, PacketTrace):
+        return packets.total_wire_bytes()
+    return sum([len(packet.get_wire_bytes()) for packet in packets])
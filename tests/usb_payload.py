@@ -0,0 +1,197 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Payload generators for data packets.
+#
+# Each generator keeps one precomputed pattern buffer and hands out payloads
+# as memoryview slices of it, so building a packet does not allocate a list
+# per payload. Generators are registered by name so tests (and create_data)
+# can select a pattern from a string.
+
+import binascii
+import os
+import random
+
+PAYLOAD_GENERATORS = {}
+
+def register_payload_generator(name):
+    """ Class decorator adding a PayloadGenerator to the registry """
+    def register(cls):
+        cls.name = name
+        PAYLOAD_GENERATORS[name] = cls
+        return cls
+    return register
+
+def get_payload_generator(name, *args, **kwargs):
+    try:
+        cls = PAYLOAD_GENERATORS[name]
+    except KeyError:
+        raise ValueError("Unknown payload generator '{}'. Available: {}".format(
+            name, ", ".join(sorted(PAYLOAD_GENERATORS))))
+    return cls(*args, **kwargs)
+
+def random_bytes(rand, num_bytes):
+    """ Returns num_bytes random bytes using a single getrandbits() call on
+        rand, or os.urandom() if rand is None
+    """
+    if num_bytes == 0:
+        return b''
+    if rand is None:
+        return os.urandom(num_bytes)
+    return binascii.unhexlify('%0*x' % (2 * num_bytes, rand.getrandbits(8 * num_bytes)))
+
+
+class PayloadGenerator(object):
+    """ Base class for payload generators.
+
+        payload(length) returns the next length bytes of the pattern as a
+        memoryview and advances the stream position. Passing start reads
+        from that position instead (the stream position is then continued
+        from the end of the returned payload).
+
+        Subclasses provide get(start, length), which returns the bytes of
+        the pattern from start without moving the stream position.
+    """
+
+    name = None
+
+    def __init__(self):
+        self._position = 0
+
+    def payload(self, length, start=None):
+        if start is None:
+            start = self._position
+        view = self.get(start, length)
+        self._position = start + length
+        return view
+
+    def expect(self):
+        """ Returns what the DUT is expected to print for this pattern """
+        return "Pattern = {0}\n".format(self.name)
+
+
+class _PeriodicPayload(PayloadGenerator):
+    """ Pattern repeating every PERIOD bytes. The buffer holds one period plus
+        enough extra bytes that any payload is a single contiguous slice.
+        Subclasses provide pattern(num_bytes), which returns the first
+        num_bytes bytes of the pattern as a bytearray.
+    """
+
+    PERIOD = 256
+
+    def __init__(self):
+        super(_PeriodicPayload, self).__init__()
+        self._buffer = bytearray()
+        self._view = memoryview(self._buffer)
+
+    def get(self, start, length):
+        start %= self.PERIOD
+        if start + length > len(self._buffer):
+            # Grow by replacing the buffer: slices already handed out keep
+            # the old one alive
+            size = self.PERIOD * 2
+            while size < self.PERIOD + length:
+                size *= 2
+            self._buffer = self.pattern(size)
+            self._view = memoryview(self._buffer)
+        return self._view[start:start + length]
+
+
+@register_payload_generator('step')
+class StepPayload(_PeriodicPayload):
+    """ Byte i of the stream is (step * i) & 0xff """
+
+    def __init__(self, step=1):
+        self.step = step
+        super(StepPayload, self).__init__()
+
+    def pattern(self, num_bytes):
+        return bytearray([(self.step * i) & 0xff for i in range(num_bytes)])
+
+    def expect(self):
+        return "Step = {0}\n".format(self.step)
+
+
+@register_payload_generator('same')
+class ConstantPayload(_PeriodicPayload):
+    """ Every byte is value """
+
+    PERIOD = 1
+
+    def __init__(self, value=0):
+        self.value = value
+        super(ConstantPayload, self).__init__()
+
+    def pattern(self, num_bytes):
+        return bytearray([self.value & 0xff]) * num_bytes
+
+    def expect(self):
+        return "Value = {0}\n".format(self.value)
+
+
+@register_payload_generator('random')
+class RandomPayload(PayloadGenerator):
+    """ Stream of random bytes, reproducible from seed. Bytes are generated
+        CHUNK_SIZE at a time with one getrandbits() call per chunk (or
+        os.urandom() when seed is None). Only sequential reads are supported.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, seed=None):
+        super(RandomPayload, self).__init__()
+        self.seed = seed
+        self._rand = None if seed is None else random.Random(seed)
+        self._buffer = bytearray()
+        self._view = memoryview(self._buffer)
+        self._buffer_start = 0
+
+    def get(self, start, length):
+        if start != self._position:
+            raise ValueError("RandomPayload only supports sequential reads")
+
+        offset = start - self._buffer_start
+        if offset + length > len(self._buffer):
+            # Carry the unread tail over into a new buffer. Bytes are always
+            # generated in whole chunks so the stream does not depend on the
+            # payload lengths requested.
+            buffer = bytearray(self._view[offset:])
+            while len(buffer) < length:
+                buffer += random_bytes(self._rand, self.CHUNK_SIZE)
+            self._buffer = buffer
+            self._view = memoryview(self._buffer)
+            self._buffer_start = start
+            offset = 0
+
+        return self._view[offset:offset + length]
+
+    def expect(self):
+        return "Seed = {0}\n".format(self.seed)
+
+
+@register_payload_generator('file')
+class FilePayload(PayloadGenerator):
+    """ Contents of a file, repeated end to end """
+
+    def __init__(self, filename):
+        super(FilePayload, self).__init__()
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._buffer = bytearray(f.read())
+        if not self._buffer:
+            raise ValueError("Payload file '{}' is empty".format(filename))
+        self._view = memoryview(self._buffer)
+
+    def get(self, start, length):
+        start %= len(self._buffer)
+        if start + length <= len(self._buffer):
+            return self._view[start:start + length]
+
+        # Wraps around the end of the file, so has to be copied
+        data = bytearray(self._view[start:])
+        while len(data) < length:
+            data += self._view[:length - len(data)]
+        return memoryview(data)
+
+    def expect(self):
+        return "File = {0}\n".format(self.filename)
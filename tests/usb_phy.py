@@ -1,19 +1,26 @@
 # Copyright 2016-2021 XMOS LIMITED.
 # This Software is subject to the terms of the XMOS Public Licence: Version 1.
 import random
-import xmostest
 import sys
 import zlib
-from usb_packet import RxPacket, TokenPacket
+import json
+from array import array
+from usb_clock import ClockedThread
+from usb_packet import iter_packets, total_wire_bytes
+from usb_waveform import compile_tx_waveform, WAVE_CHECK_TXV
+from usb_capture import PacketCapture, mismatch_report
+from usb_txrdy import AlwaysReady, TxThroughput
+from usb_latency import LatencyRecorder
 
-class TxPhy(xmostest.SimThread):
+class TxPhy(ClockedThread):
 
    
     # Time in ns from the last packet being sent until the end of test is signalled to the DUT
     END_OF_TEST_TIME = 5000
 
     def __init__(self, name, rxd, rxa, rxdv, rxer, vld, txd, txv, txrdy, clock, initial_delay, verbose,
-                 test_ctrl, do_timeout, complete_fn, expect_loopback, dut_exit_time):
+                 test_ctrl, do_timeout, complete_fn, expect_loopback, dut_exit_time,
+                 edge_scheduled=True, print_rx_bytes=False, txrdy_pattern=None):
         self._name = name
         self._test_ctrl = test_ctrl
         self._rxd = rxd    #Rx data
@@ -32,6 +39,27 @@ class TxPhy(xmostest.SimThread):
         self._complete_fn = complete_fn
         self._expect_loopback = expect_loopback
         self._dut_exit_time = dut_exit_time
+        self._edge_scheduled = edge_scheduled
+        self._edge_waits = 0
+        self._poll_waits = 0
+        self._print_rx_bytes = print_rx_bytes
+        self.capture = PacketCapture()
+        self._capture_filename = None
+        self._txrdy_pattern = txrdy_pattern or AlwaysReady()
+        self.tx_throughput = TxThroughput()
+        self._throughput_filename = None
+        self.latency = LatencyRecorder(clock.get_period())
+        self._latency_filename = None
+
+        # Time each packet started and ended on the bus. For a packet from
+        # the DUT that never came, both are the time the wait timed out.
+        self.packet_start_times = array('d')
+        self.packet_end_times = array('d')
+
+        # Windowed trace capture (see sim_trace.py), told where the packets
+        # are and when the first error happens
+        self.trace_capture = None
+        self.trace = None
 
     def get_name(self):
         return self._name
@@ -41,12 +69,34 @@ class TxPhy(xmostest.SimThread):
 
     def start_test(self):
         self.wait_until(self.xsi.get_time() + self._initial_delay)
-        self.wait(lambda x: self._clock.is_high())
-        self.wait(lambda x: self._clock.is_low())
+        self.wait_falling_edge()
 
     def end_test(self):
         if self._verbose:
             print "All packets sent"
+            print "Clock waits: {} edge scheduled, {} polled".format(
+                self._edge_waits, self._poll_waits)
+            throughput = self.tx_throughput
+            print "DUT transmit with TXRDY {}: {:.3f} bytes/clock, {} underruns".format(
+                self._txrdy_pattern.describe(), throughput.bytes_per_clock(),
+                len(throughput.underruns))
+
+        if self._verbose:
+            for line in self.latency.format_summary():
+                print line
+
+        if self._latency_filename:
+            self.latency.write_samples(self._latency_filename + '.jsonl')
+            self.latency.write_summary(self._latency_filename + '.json')
+
+        if self._throughput_filename:
+            with open(self._throughput_filename, 'w') as f:
+                result = self.tx_throughput.as_dict()
+                result['txrdy_pattern'] = self._txrdy_pattern.describe()
+                json.dump(result, f, indent=2, sort_keys=True)
+
+        if self._capture_filename:
+            self.capture.write(self._capture_filename)
 
         if self._complete_fn:
             self._complete_fn(self)
@@ -60,7 +110,7 @@ class TxPhy(xmostest.SimThread):
 
             if self._expect_loopback:
                 # If looping back then take into account all the data
-                total_packet_bytes = sum([len(packet.get_bytes()) for packet in self._packets])
+                total_packet_bytes = total_wire_bytes(self._packets)
                 total_data_bits = total_packet_bytes * 8
 
                 # Allow 2 cycles per bit
@@ -81,77 +131,186 @@ class TxPhy(xmostest.SimThread):
             # Allow time for the DUT to exit
             self.wait_until(self.xsi.get_time() + self._dut_exit_time)
 
-            print "ERROR: Test timed out"
+            self.error("ERROR: Test timed out")
             self.xsi.terminate()
 
     def set_clock(self, clock):
         self._clock = clock
+        self.latency.clock_period = clock.get_period()
 
     def set_packets(self, packets):
+        """ packets can be a list of packets, a PacketTrace or a StimulusFile
+        """
         self._packets = packets
 
+    def get_print_rx_bytes(self):
+        return self._print_rx_bytes
+
+    def get_config(self):
+        """ Settings that affect the simulator output, for the result cache.
+            None if the output can't be predicted from them (a complete_fn
+            is set).
+        """
+        if self._complete_fn:
+            return None
+        return {'name' : self._name,
+                'test_ctrl' : self._test_ctrl,
+                'initial_delay' : self._initial_delay,
+                'verbose' : self._verbose,
+                'do_timeout' : self._do_timeout,
+                'expect_loopback' : self._expect_loopback,
+                'dut_exit_time' : self._dut_exit_time,
+                'print_rx_bytes' : self._print_rx_bytes,
+                'txrdy_pattern' : self._txrdy_pattern.describe()}
+
+    def set_capture_file(self, filename):
+        """ Write the packets received from the DUT to filename at the end
+            of the test, as JSON lines if it ends in .jsonl otherwise as a
+            binary log
+        """
+        self._capture_filename = filename
+
+    def get_txrdy_pattern(self):
+        return self._txrdy_pattern
+
+    def set_txrdy_pattern(self, pattern):
+        self._txrdy_pattern = pattern
+
+    def set_throughput_file(self, filename):
+        """ Write the DUT transmit throughput as JSON to filename at the end
+            of the test
+        """
+        self._throughput_filename = filename
+
+    def set_latency_file(self, filename):
+        """ Write the turnaround samples to filename.jsonl and their summary
+            to filename.json at the end of the test
+        """
+        self._latency_filename = filename
+
+    def set_trace_capture(self, capture):
+        """ Mark packets and errors in a sim_trace.TraceCapture (or None) """
+        self.trace_capture = capture
+        self.trace = capture.window if capture else None
+
+    def error(self, message):
+        print message
+        if self.trace:
+            self.trace.error(self.xsi.get_time())
+
+    def check_rx_packet(self, index, expected):
+        """ Checks the last captured packet against the expected bytes """
+        received = self.capture.last_data()
+        report = mismatch_report(index, expected, received)
+        for line in report:
+            print line
+        if report and self.trace:
+            self.trace.error(self.xsi.get_time())
+
     def drive_error(self, value):
         self.xsi.drive_port_pins(self._rxer, value)
 
+    def replay_waveform(self, waveform):
+        """ Drives a waveform from compile_tx_waveform(), starting now """
+        xsi = self.xsi
+        ports = (self._rxa, self._rxdv, self._rxd, self._rxer, self._vld)
+        edge = 0
+        for (event_edge, port, value) in waveform:
+            while edge < event_edge:
+                self.wait_falling_edge()
+                edge += 1
+
+            if port == WAVE_CHECK_TXV:
+                # xCore should not be trying to send if we are trying to send..
+                if xsi.sample_port_pins(self._txv) == 1:
+                    self.error("ERROR: Unexpected packet from xCORE")
+            else:
+                xsi.drive_port_pins(ports[port], value)
+
 
 class UsbPhy(TxPhy):
 
     def __init__(self, rxd, rxa, rxdv, rxer, vld, txd, txv, txrdy, clock,
                  initial_delay=85000, verbose=False, test_ctrl=None,
                  do_timeout=True, complete_fn=None, expect_loopback=True,
-                 dut_exit_time=25000):
+                 dut_exit_time=25000, edge_scheduled=True, print_rx_bytes=False,
+                 txrdy_pattern=None):
         super(UsbPhy, self).__init__('mii', rxd, rxa, rxdv, rxer, vld, txd, txv, txrdy, clock,
                                              initial_delay, verbose, test_ctrl,
                                              do_timeout, complete_fn, expect_loopback,
-                                             dut_exit_time)
+                                             dut_exit_time, edge_scheduled, print_rx_bytes,
+                                             txrdy_pattern)
 
     def run(self):
         xsi = self.xsi
 
         self.start_test()
 
-        for i,packet in enumerate(self._packets):
+        start_times = self.packet_start_times = array('d')
+        end_times = self.packet_end_times = array('d')
+        trace = self.trace
+
+        for i,packet in enumerate(iter_packets(self._packets)):
             #error_nibbles = packet.get_error_nibbles()
             
-            if isinstance(packet, RxPacket):
+            if packet.is_rx:
  
                 timeout = packet.get_timeout()
                
                 #print "Expecting pkt. Timeout in: {i}".format(i=timeout)
 
                 in_rx_packet = False
-                rx_packet = []
+                capture = self.capture
+                txrdy_pattern = self._txrdy_pattern
 
                 while timeout != 0:
 
-                    self.wait(lambda x: self._clock.is_high())
-                    self.wait(lambda x: self._clock.is_low())
+                    self.wait_falling_edge()
 
                     timeout = timeout - 1
                     #print "{i}".format(i=timeout)
 
                     #sample TXV for new packet
                     if xsi.sample_port_pins(self._txv) == 1:
+                        self.latency.txv_rise(i, packet, xsi.get_time())
                         print "Receiving packet {}".format(i)
                         in_rx_packet = True
                         break
             
                 if in_rx_packet == False:
-                    print "ERROR: Timed out waiting for packet"
+                    self.error("ERROR: Timed out waiting for packet")
+                    start_times.append(xsi.get_time())
+                    end_times.append(xsi.get_time())
+                    if trace:
+                        trace.packet_start(i, xsi.get_time())
+                        trace.packet_end(i, xsi.get_time())
 
                 else:
                     #print "in packet"
+                    capture.begin(i, xsi.get_time())
+                    start_times.append(xsi.get_time())
+                    if trace:
+                        trace.packet_start(i, xsi.get_time())
+                    txrdy_pattern.start_packet()
+                    cycles = 0
+                    stall_cycles = 0
+
                     while in_rx_packet == True:
                         
-                        # TODO txrdy pulsing
-                        xsi.drive_port_pins(self._txrdy, 1)
-                        data = xsi.sample_port_pins(self._txd)
+                        # TXD is only sampled on clocks the byte is accepted
+                        cycles += 1
+                        if txrdy_pattern.ready():
+                            xsi.drive_port_pins(self._txrdy, 1)
+                            data = xsi.sample_port_pins(self._txd)
                        
-                        print "Received byte: {0:#x}".format(data)
-                        rx_packet.append(data)
+                            if self._print_rx_bytes:
+                                print "Received byte: {0:#x}".format(data)
+                            capture.append_byte(data)
+                        else:
+                            xsi.drive_port_pins(self._txrdy, 0)
+                            stall_cycles += 1
 
-                        self.wait(lambda x: self._clock.is_high())
-                        self.wait(lambda x: self._clock.is_low())
+                        self.wait_falling_edge()
 
                         if xsi.sample_port_pins(self._txv) == 0:
                             #print "TXV low, breaking out of loop"
@@ -161,215 +320,44 @@ class UsbPhy(TxPhy):
 
                     # End of packet
                     xsi.drive_port_pins(self._txrdy, 0)
+                    capture.end(xsi.get_time())
+                    self.latency.response_end(capture.last_data())
+                    end_times.append(xsi.get_time())
+                    if trace:
+                        trace.packet_end(i, xsi.get_time())
 
-                    # Check packet agaist expected
+                    # Check packet against expected
                     expected = packet.get_bytes()
-                    if len(expected) != len(rx_packet):
-                        print "ERROR: Rx packet length bad. Expecting: {} actual: {}".format(len(expected), len(rx_packet))
-                
-                    # Check packet data against expected
-                    if cmp(expected, rx_packet):
-                        print "ERROR: Rx Packet Error. Expected:"
-                        for item in expected:
-                            print "{0:#x}".format(item)
-
-                        print "Received:" 
-                        for item in rx_packet:
-                            print "{0:#x}".format(item)
+                    self.check_rx_packet(i, expected)
+                    self.tx_throughput.add_packet(i, len(expected), len(capture.last_data()),
+                                                  cycles, stall_cycles)
             else:
 
                 
                 # xCore should not be trying to send if we are trying to send..
                 if xsi.sample_port_pins(self._txv) == 1:
-                    print "ERROR: Unexpected packet from xCORE"
+                    self.error("ERROR: Unexpected packet from xCORE")
 
-                rxv_count = packet.get_data_valid_count();
+                waveform = compile_tx_waveform(packet)
 
                 #print "Waiting for inter_pkt_gap: {i}".format(i=packet.inter_frame_gap)
                 self.wait_until(xsi.get_time() + packet.inter_pkt_gap)
 
                 print "Sending packet {}".format(i)
+                start_times.append(xsi.get_time())
+                if trace:
+                    trace.packet_start(i, xsi.get_time())
                 if self._verbose:
                     sys.stdout.write(packet.dump())
 
-                # Set RXA high
-                xsi.drive_port_pins(self._rxa, 1)
-
-                # Wait for RXA rise delay TODO, this should be configurable 
-                self.wait(lambda x: self._clock.is_high())
-                self.wait(lambda x: self._clock.is_low())
-
-                #if isinstance(packet, TokenPacket):
-                 #   print "Token packet, clear valid token"
-                xsi.drive_port_pins(self._vld, 0)
-
-                for (i, byte) in enumerate(packet.get_bytes()):
-
-                    # xCore should not be trying to send if we are trying to send..
-                    if xsi.sample_port_pins(self._txv) == 1:
-                        print "ERROR: Unexpected packet from xCORE"
-
-                    self.wait(lambda x: self._clock.is_low())
-
-                    self.wait(lambda x: self._clock.is_high())
-                    self.wait(lambda x: self._clock.is_low())
-                    xsi.drive_port_pins(self._rxdv, 1)
-                    xsi.drive_port_pins(self._rxd, byte)
- 
-                    if (packet.rxe_assert_time != 0) and (packet.rxe_assert_time == i):
-                        xsi.drive_port_pins(self._rxer, 1)
-
-                    while rxv_count != 0:
-                        self.wait(lambda x: self._clock.is_high())
-                        self.wait(lambda x: self._clock.is_low())
-                        xsi.drive_port_pins(self._rxdv, 0)
-                        rxv_count = rxv_count - 1
-
-                        # xCore should not be trying to send if we are trying to send..
-                        if xsi.sample_port_pins(self._txv) == 1:
-                            print "ERROR: Unexpected packet from xCORE"
-
-                    #print "Sending byte {0:#x}".format(byte)
-
-                    rxv_count = packet.get_data_valid_count();
-
-                    if isinstance(packet, TokenPacket):
-                        #print "Token packet, driving valid"
-                        if packet.get_token_valid():
-                            xsi.drive_port_pins(self._vld, 1)
-                        else:
-                            xsi.drive_port_pins(self._vld, 0)
-
-                # Wait for last byte
-                self.wait(lambda x: self._clock.is_high())
-                self.wait(lambda x: self._clock.is_low())
-
-                xsi.drive_port_pins(self._rxdv, 0)
-                xsi.drive_port_pins(self._rxer, 0)
-
-                rxa_end_delay = packet.rxa_end_delay
-                while rxa_end_delay != 0:
-                    # Wait for RXA fall delay TODO, this should be configurable 
-                    self.wait(lambda x: self._clock.is_high())
-                    self.wait(lambda x: self._clock.is_low())
-                    rxa_end_delay = rxa_end_delay - 1
-               
-                    # xCore should not be trying to send if we are trying to send..
-                    if xsi.sample_port_pins(self._txv) == 1:
-                        print "ERROR: Unexpected packet from xCORE"
-
-                xsi.drive_port_pins(self._rxa, 0)
+                self.replay_waveform(waveform)
+                self.latency.host_packet_end(packet, xsi.get_time())
+                end_times.append(xsi.get_time())
+                if trace:
+                    trace.packet_end(i, xsi.get_time())
 
                 #if self._verbose:
                     #print "Sent"
 
         print "Test done"
         self.end_test()
-
-
-class RxPhy(xmostest.SimThread):
-
-    def __init__(self, name, txd, txen, clock, print_packets, packet_fn, verbose, test_ctrl):
-        self._name = name
-        self._txd = txd
-        self._txen = txen
-        self._clock = clock
-        self._print_packets = print_packets
-        self._verbose = verbose
-        self._test_ctrl = test_ctrl
-        self._packet_fn = packet_fn
-
-        self.expected_packets = None
-        self.expect_packet_index = 0
-        self.num_expected_packets = 0
-
-        self.expected_packets = None
-        self.expect_packet_index = 0
-        self.num_expected_packets = 0
-
-    def get_name(self):
-        return self._name
-
-    def get_clock(self):
-        return self._clock
-
-    def set_expected_packets(self, packets):
-        self.expect_packet_index = 0;
-        self.expected_packets = packets
-        if self.expected_packets is None:
-            self.num_expected_packets = 0
-        else:
-            self.num_expected_packets = len(self.expected_packets)
-
-class MiiReceiver(RxPhy):
-
-    def __init__(self, txd, txen, clock, print_packets=False,
-                 packet_fn=None, verbose=False, test_ctrl=None):
-        super(MiiReceiver, self).__init__('mii', txd, txen, clock, print_packets,
-                                          packet_fn, verbose, test_ctrl)
-
-    def run(self):
-        xsi = self.xsi
-        self.wait(lambda x: xsi.sample_port_pins(self._txen) == 0)
-
-        # Need a random number generator for the MiiPacket constructor but it shouldn't
-        # have any affect as only blank packets are being created
-        rand = random.Random()
-
-        packet_count = 0
-        last_frame_end_time = None
-        while True:
-            # Wait for TXEN to go high
-            if self._test_ctrl is None:
-                self.wait(lambda x: xsi.sample_port_pins(self._txen) == 1)
-            else:
-                self.wait(lambda x: xsi.sample_port_pins(self._txen) == 1 or \
-                                    xsi.sample_port_pins(self._test_ctrl) == 1)
-
-                if (xsi.sample_port_pins(self._txen) == 0 and
-                      xsi.sample_port_pins(self._test_ctrl) == 1):
-                    xsi.terminate()
-
-            # Start with a blank packet to ensure they are filled in by the receiver
-            packet = MiiPacket(rand, blank=True)
-
-            frame_start_time = self.xsi.get_time()
-            in_preamble = True
-
-            if last_frame_end_time:
-                ifgap = frame_start_time - last_frame_end_time
-                packet.inter_frame_gap = ifgap
-
-            while True:
-                # Wait for a falling clock edge or enable low
-                self.wait(lambda x: self._clock.is_low() or \
-                                   xsi.sample_port_pins(self._txen) == 0)
-
-                if xsi.sample_port_pins(self._txen) == 0:
-                    last_frame_end_time = self.xsi.get_time()
-                    break
-
-                nibble = xsi.sample_port_pins(self._txd)
-                if in_preamble:
-                    if nibble == 0xd:
-                        packet.set_sfd_nibble(nibble)
-                        in_preamble = False
-                    else:
-                        packet.append_preamble_nibble(nibble)
-                else:
-                    packet.append_data_nibble(nibble)
-
-                self.wait(lambda x: self._clock.is_high())
-
-            packet.complete()
-
-            if self._print_packets:
-                sys.stdout.write(packet.dump())
-
-            if self._packet_fn:
-                self._packet_fn(packet, self)
-
-            # Perform packet checks
-            packet.check(self._clock)
-
-
@@ -0,0 +1,27 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# The PHY side ports of the USB link of the test binaries, by architecture.
+# get_usb_clk_phy() builds the Clock and UsbPhy from these, and the tools
+# that read traces or run without xsim (sim_vcd, sim_profile, sim_local) use
+# the same names.
+
+USB_PORTS = {
+    'xs2' : {'clk' : 'tile[0]:XS1_PORT_1J',
+             'rxd' : 'tile[0]:XS1_PORT_8B',
+             'rxa' : 'tile[0]:XS1_PORT_1F',
+             'rxdv' : 'tile[0]:XS1_PORT_1I',
+             'rxer' : 'tile[0]:XS1_PORT_1G',
+             'vld' : 'tile[0]:XS1_PORT_1E',
+             'txd' : 'tile[0]:XS1_PORT_8A',
+             'txv' : 'tile[0]:XS1_PORT_1K',
+             'txrdy' : 'tile[0]:XS1_PORT_1H'},
+    'xs1' : {'clk' : 'tile[0]:XS1_PORT_1J',
+             'rxd' : 'tile[0]:XS1_PORT_8C',
+             'rxa' : 'tile[0]:XS1_PORT_1O',
+             'rxdv' : 'tile[0]:XS1_PORT_1M',
+             'rxer' : 'tile[0]:XS1_PORT_1P',
+             'vld' : 'tile[0]:XS1_PORT_1N',
+             'txd' : 'tile[0]:XS1_PORT_8A',
+             'txv' : 'tile[0]:XS1_PORT_1K',
+             'txrdy' : 'tile[0]:XS1_PORT_1H'}}
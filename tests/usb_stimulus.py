@@ -0,0 +1,291 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Binary stimulus files (.usbstim)
+#
+# A packet sequence is generated once, written to a stimulus file and then
+# replayed by UsbPhy straight from an mmap of the file, so long sequences do
+# not have to be rebuilt (or held in memory) for every run and architecture.
+#
+# File layout (all values little-endian):
+#
+#   header   HEADER struct: magic, version, metadata length, number of
+#            packets, total wire bytes, payload length and the SHA-256 of
+#            everything following the metadata
+#   metadata JSON object: seed, generator name, generator parameters and
+#            the version of the generating code
+#   columns  one array per PacketTrace column, in PacketTrace.COLUMNS order
+#   payload  all data packet payloads, back to back
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from usb_packet import PacketTrace
+
+STIMULUS_MAGIC = b'USBSTIM\0'
+STIMULUS_VERSION = 1
+STIMULUS_EXTENSION = '.usbstim'
+
+HEADER = struct.Struct('<8sHHIQQQ32s')
+
+# Fixed on-disk format of each PacketTrace column
+COLUMN_FORMATS = {'B' : 'B', 'H' : 'H', 'I' : 'I', 'L' : 'Q'}
+
+def _array_typecodes():
+    typecodes = {}
+    for typecode in ('B', 'H', 'I', 'L', 'Q'):
+        try:
+            typecodes.setdefault(array(typecode).itemsize, typecode)
+        except ValueError:
+            # No 'Q' on Python 2
+            pass
+    return typecodes
+
+# Array typecode to use for each on-disk item size
+_ARRAY_TYPECODES = _array_typecodes()
+
+def _array_to_bytes(values, fmt):
+    column = array(_ARRAY_TYPECODES[struct.calcsize('<' + fmt)], values)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    if hasattr(column, 'tobytes'):
+        return column.tobytes()
+    return column.tostring()
+
+def _to_trace(packets):
+    if isinstance(packets, PacketTrace):
+        return packets
+    return PacketTrace(packets)
+
+def _content_chunks(trace):
+    """ The columns and payload of a trace as written to a stimulus file """
+    chunks = []
+    for (name, typecode) in PacketTrace.COLUMNS:
+        chunks.append(_array_to_bytes(getattr(trace, name), COLUMN_FORMATS[typecode]))
+    chunks.append(bytes(trace.payload))
+    return chunks
+
+def stimulus_hash(packets):
+    """ Content hash (hex SHA-256) of a list of packets or a PacketTrace, the
+        same as that of a stimulus file written from them
+    """
+    if isinstance(packets, StimulusFile):
+        return packets.content_hex
+    digest = hashlib.sha256()
+    for chunk in _content_chunks(_to_trace(packets)):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def write_stimulus_file(filename, packets, seed=None, generator=None, params=None,
+                        version=None):
+    """ Writes a list of packets or a PacketTrace to a stimulus file and
+        returns the content hash (hex SHA-256 of the columns and payload)
+    """
+    trace = _to_trace(packets)
+
+    metadata = json.dumps({'seed' : seed, 'generator' : generator,
+                           'params' : params or {}, 'version' : version},
+                          sort_keys=True).encode('utf-8')
+
+    digest = hashlib.sha256()
+    chunks = _content_chunks(trace)
+    for chunk in chunks:
+        digest.update(chunk)
+    payload = chunks[-1]
+
+    header = HEADER.pack(STIMULUS_MAGIC, STIMULUS_VERSION, 0, len(metadata),
+                         len(trace), trace.total_wire_bytes(), len(payload),
+                         digest.digest())
+
+    # Unique per process, as parallel jobs can write the same stimulus
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        f.write(header)
+        f.write(metadata)
+        for chunk in chunks:
+            f.write(chunk)
+    os.rename(tmp_filename, filename)
+
+    return digest.hexdigest()
+
+
+class _StructColumn(object):
+    """ Column of a stimulus file read in place with struct. Used where
+        memoryview.cast() is not available (Python 2, big-endian hosts).
+    """
+
+    __slots__ = ('_buf', '_offset', '_struct', '_len')
+
+    def __init__(self, buf, offset, fmt, length):
+        self._buf = buf
+        self._offset = offset
+        self._struct = struct.Struct('<' + fmt)
+        self._len = length
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._len:
+            raise IndexError("column index out of range")
+        return self._struct.unpack_from(self._buf, self._offset + i * self._struct.size)[0]
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self[i]
+
+
+class StimulusFile(PacketTrace):
+    """ Read-only PacketTrace backed by an mmap of a stimulus file. Columns
+        and payloads are read from the mapping in place, so it can be given
+        to UsbPhy.set_packets() and create_expect() like any other trace.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, flags, metadata_len, num_packets, wire_bytes, payload_len,
+            digest) = HEADER.unpack_from(self._mmap, 0)
+
+        if magic != STIMULUS_MAGIC:
+            raise ValueError("{} is not a stimulus file".format(filename))
+        if version != STIMULUS_VERSION:
+            raise ValueError("{}: unsupported stimulus file version {}".format(filename, version))
+
+        offset = HEADER.size
+        self.metadata = json.loads(self._mmap[offset:offset + metadata_len].decode('utf-8'))
+        offset += metadata_len
+
+        self.content_hash = digest
+        self._content_offset = offset
+        self._num_packets = num_packets
+        self._wire_bytes = wire_bytes
+
+        try:
+            self._view = memoryview(self._mmap)
+        except TypeError:
+            # Python 2 mmap objects only support the old buffer interface
+            self._view = None
+
+        for (name, typecode) in self.COLUMNS:
+            fmt = COLUMN_FORMATS[typecode]
+            size = struct.calcsize('<' + fmt) * num_packets
+            if self._view is not None and sys.byteorder == 'little':
+                column = self._view[offset:offset + size].cast(fmt)
+            else:
+                column = _StructColumn(self._mmap, offset, fmt, num_packets)
+            setattr(self, name, column)
+            offset += size
+
+        self._payload_offset = offset
+        if offset + payload_len != len(self._mmap):
+            raise ValueError("{}: file is truncated or corrupt".format(filename))
+
+    @property
+    def seed(self):
+        return self.metadata.get('seed')
+
+    @property
+    def generator(self):
+        return self.metadata.get('generator')
+
+    @property
+    def params(self):
+        return self.metadata.get('params')
+
+    @property
+    def version(self):
+        return self.metadata.get('version')
+
+    @property
+    def content_hex(self):
+        return ''.join('{0:02x}'.format(b) for b in bytearray(self.content_hash))
+
+    @property
+    def payload(self):
+        """ All data packet payloads, back to back, without copying them out
+            of the mapping
+        """
+        offset = self._payload_offset
+        if self._view is not None:
+            return self._view[offset:]
+        return buffer(self._mmap, offset) # noqa: F821 (Python 2 only)
+
+    def __len__(self):
+        return self._num_packets
+
+    def append(self, packet):
+        raise TypeError("StimulusFile is read-only")
+
+    def get_payload(self, i):
+        """ Returns the payload of packet i without copying it out of the
+            mapping
+        """
+        offset = self._payload_offset + self.payload_offset[i]
+        length = self.payload_length[i]
+        if self._view is not None:
+            return self._view[offset:offset + length]
+        return buffer(self._mmap, offset, length) # noqa: F821 (Python 2 only)
+
+    def total_wire_bytes(self):
+        return self._wire_bytes
+
+    def verify(self):
+        """ Returns True if the content matches the hash in the header """
+        digest = hashlib.sha256()
+        chunk_size = 1 << 20
+        for offset in range(self._content_offset, len(self._mmap), chunk_size):
+            digest.update(self._mmap[offset:offset + chunk_size])
+        return digest.digest() == self.content_hash
+
+    def close(self):
+        for (name, typecode) in self.COLUMNS:
+            column = getattr(self, name)
+            if hasattr(column, 'release'):
+                column.release()
+        if self._view is not None:
+            self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_stimulus(filename, generate_fn, seed=None, generator=None, params=None,
+                  version=None):
+    """ Opens the stimulus file if it exists and was written with the same
+        seed, generator, params and version (of the generating code).
+        Otherwise calls generate_fn() to build the packets, writes them to
+        filename and opens the result.
+    """
+    if os.path.exists(filename):
+        try:
+            stimulus = StimulusFile(filename)
+        except ValueError:
+            stimulus = None
+
+        if stimulus is not None:
+            if (stimulus.seed == seed and stimulus.generator == generator and
+                    stimulus.params == json.loads(json.dumps(params or {})) and
+                    stimulus.version == version):
+                return stimulus
+            stimulus.close()
+
+    folder = os.path.dirname(filename)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    write_stimulus_file(filename, generate_fn(), seed=seed, generator=generator, params=params,
+                        version=version)
+    return StimulusFile(filename)
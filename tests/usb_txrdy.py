@@ -0,0 +1,212 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# TXRDY back-pressure patterns
+#
+# While the DUT is transmitting, UsbPhy asks its pattern once per clock
+# whether to accept a byte (drive TXRDY high and sample TXD) or stall. A real
+# UTMI/ULPI PHY can hold off the link this way, which the DUT's transmit
+# loop has to cope with.
+#
+# Patterns are registered by name and can be given on the command line as
+# name[:arg[:arg...]], e.g. "duty:0.75", "periodic:16:4", "random:0.1" or
+# "first:3".
+
+import random
+
+TXRDY_PATTERNS = {}
+
+def register_txrdy_pattern(name):
+    """ Class decorator adding a TxReadyPattern to the registry """
+    def register(cls):
+        cls.name = name
+        TXRDY_PATTERNS[name] = cls
+        return cls
+    return register
+
+def get_txrdy_pattern(name, *args, **kwargs):
+    try:
+        cls = TXRDY_PATTERNS[name]
+    except KeyError:
+        raise ValueError("Unknown TXRDY pattern '{}'. Available: {}".format(
+            name, ", ".join(sorted(TXRDY_PATTERNS))))
+    return cls(*args, **kwargs)
+
+def _parse_arg(arg):
+    try:
+        return int(arg)
+    except ValueError:
+        return float(arg)
+
+def parse_txrdy_pattern(spec):
+    """ Creates a pattern from a name[:arg[:arg...]] string """
+    fields = spec.split(':')
+    return get_txrdy_pattern(fields[0], *[_parse_arg(arg) for arg in fields[1:]])
+
+
+class TxReadyPattern(object):
+    """ Base class for TXRDY patterns.
+
+        start_packet() is called when TXV rises and ready() once per clock
+        after that until TXV falls.
+    """
+
+    name = None
+
+    # Whether the pattern depends on the seed given to reset()
+    uses_seed = False
+
+    def reset(self, seed=None):
+        """ Called at the start of a test, with the test seed """
+        pass
+
+    def start_packet(self):
+        pass
+
+    def ready(self):
+        """ Whether TXRDY is high this clock, always by default """
+        return True
+
+    def describe(self):
+        return self.name
+
+
+@register_txrdy_pattern('always')
+class AlwaysReady(TxReadyPattern):
+    """ TXRDY held high for the whole packet """
+
+
+@register_txrdy_pattern('duty')
+class DutyCycleReady(TxReadyPattern):
+    """ TXRDY high for a fraction duty of the clocks, spread as evenly as
+        possible. The phase carries on across packets.
+    """
+
+    def __init__(self, duty):
+        if not 0 < duty <= 1:
+            raise ValueError("TXRDY duty must be in (0, 1]")
+        self.duty = duty
+        self.reset()
+
+    def reset(self, seed=None):
+        # Start with the first clock ready, a stall on the first byte is
+        # what FirstByteStallReady is for
+        self._accumulator = 1.0 - self.duty
+
+    def ready(self):
+        self._accumulator += self.duty
+        if self._accumulator >= 1:
+            self._accumulator -= 1
+            return True
+        return False
+
+    def describe(self):
+        return "{}:{}".format(self.name, self.duty)
+
+
+@register_txrdy_pattern('periodic')
+class PeriodicStallReady(TxReadyPattern):
+    """ TXRDY low for stall clocks out of every period, counted from the
+        start of each packet (starting after offset clocks)
+    """
+
+    def __init__(self, period, stall, offset=0):
+        if not 0 <= stall < period:
+            raise ValueError("TXRDY stall must be shorter than the period")
+        self.period = period
+        self.stall = stall
+        self.offset = offset
+        self._cycle = 0
+
+    def start_packet(self):
+        self._cycle = 0
+
+    def ready(self):
+        phase = (self._cycle - self.offset) % self.period
+        self._cycle += 1
+        return phase >= self.stall
+
+    def describe(self):
+        return "{}:{}:{}:{}".format(self.name, self.period, self.stall, self.offset)
+
+
+@register_txrdy_pattern('random')
+class RandomStallReady(TxReadyPattern):
+    """ TXRDY low on each clock with probability stall_probability, from a
+        generator seeded with the test seed
+    """
+
+    def __init__(self, stall_probability, seed=None):
+        if not 0 <= stall_probability < 1:
+            raise ValueError("TXRDY stall probability must be in [0, 1)")
+        self.stall_probability = stall_probability
+        self.seed = seed
+        self._rand = random.Random(seed)
+
+    @property
+    def uses_seed(self):
+        return self.seed is None
+
+    def reset(self, seed=None):
+        if self.seed is None:
+            self._rand.seed(seed)
+
+    def ready(self):
+        return self._rand.random() >= self.stall_probability
+
+    def describe(self):
+        return "{}:{}".format(self.name, self.stall_probability)
+
+
+@register_txrdy_pattern('first')
+class FirstByteStallReady(TxReadyPattern):
+    """ TXRDY low for the first stall clocks of every packet """
+
+    def __init__(self, stall=1):
+        self.stall = stall
+        self._cycle = 0
+
+    def start_packet(self):
+        self._cycle = 0
+
+    def ready(self):
+        self._cycle += 1
+        return self._cycle > self.stall
+
+    def describe(self):
+        return "{}:{}".format(self.name, self.stall)
+
+
+class TxThroughput(object):
+    """ Bytes accepted from the DUT against clocks with TXV high. An underrun
+        is a packet where TXV fell before all the expected bytes were sent.
+    """
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.cycles = 0
+        self.stall_cycles = 0
+        self.underruns = []
+
+    def add_packet(self, index, expected_length, received_length, cycles, stall_cycles):
+        self.packets += 1
+        self.bytes += received_length
+        self.cycles += cycles
+        self.stall_cycles += stall_cycles
+        if received_length < expected_length:
+            self.underruns.append(index)
+
+    def bytes_per_clock(self):
+        if not self.cycles:
+            return 0.0
+        return float(self.bytes) / self.cycles
+
+    def as_dict(self):
+        return {'packets' : self.packets,
+                'bytes' : self.bytes,
+                'cycles' : self.cycles,
+                'stall_cycles' : self.stall_cycles,
+                'bytes_per_clock' : self.bytes_per_clock(),
+                'underruns' : len(self.underruns),
+                'underrun_packets' : self.underruns}
@@ -0,0 +1,103 @@
+# Copyright 2021 XMOS LIMITED.
+# This Software is subject to the terms of the XMOS Public Licence: Version 1.
+
+# Precompiled pin waveforms for packets sent to the DUT
+#
+# compile_tx_waveform() turns a Tx packet into a flat tuple of
+# (edge, port, value) events, where edge counts falling clock edges from the
+# start of the packet (RXA rising). UsbPhy replays the events instead of
+# working out pin values byte by byte. Waveforms are cached on everything
+# that affects them, so identical packets (tokens, handshakes) share one.
+
+# Ports driven by a waveform. WAVE_CHECK_TXV is not a port to drive: the
+# event is a check that the DUT is not transmitting.
+(WAVE_RXA, WAVE_RXDV, WAVE_RXD, WAVE_RXER, WAVE_VLD, WAVE_CHECK_TXV) = range(6)
+
+WAVE_PORT_NAMES = ('rxa', 'rxdv', 'rxd', 'rxer', 'vld', 'check_txv')
+
+# Bound on the number of cached waveforms, data packets with distinct
+# payloads would otherwise each add one
+MAX_CACHED_WAVEFORMS = 4096
+
+_waveform_cache = {}
+
+def waveform_key(packet):
+    """ The packet parameters that determine its waveform """
+    wire_bytes = packet.get_wire_bytes()
+
+    # RXER is only asserted for a byte index other than 0
+    rxe_assert_time = packet.rxe_assert_time
+    if not 0 < rxe_assert_time < len(wire_bytes):
+        rxe_assert_time = 0
+
+    token_valid = None
+    if packet.is_token:
+        token_valid = bool(packet.get_token_valid())
+
+    return (bytes(wire_bytes), packet.get_data_valid_count(), rxe_assert_time,
+            packet.rxa_end_delay, token_valid)
+
+def _compile(wire_bytes, data_valid_count, rxe_assert_time, rxa_end_delay, token_valid):
+    events = []
+    edge = 0
+
+    events.append((edge, WAVE_RXA, 1))
+
+    # RXA rise delay
+    edge += 1
+    events.append((edge, WAVE_VLD, 0))
+
+    for (i, byte) in enumerate(bytearray(wire_bytes)):
+        # xCore should not be trying to send if we are trying to send..
+        events.append((edge, WAVE_CHECK_TXV, None))
+
+        edge += 1
+        events.append((edge, WAVE_RXDV, 1))
+        events.append((edge, WAVE_RXD, byte))
+        if rxe_assert_time and rxe_assert_time == i:
+            events.append((edge, WAVE_RXER, 1))
+
+        for _ in range(data_valid_count):
+            edge += 1
+            events.append((edge, WAVE_RXDV, 0))
+            events.append((edge, WAVE_CHECK_TXV, None))
+
+        if token_valid is not None:
+            events.append((edge, WAVE_VLD, 1 if token_valid else 0))
+
+    # Last byte
+    edge += 1
+    events.append((edge, WAVE_RXDV, 0))
+    events.append((edge, WAVE_RXER, 0))
+
+    # RXA fall delay
+    for _ in range(rxa_end_delay):
+        edge += 1
+        events.append((edge, WAVE_CHECK_TXV, None))
+
+    events.append((edge, WAVE_RXA, 0))
+    return tuple(events)
+
+def compile_tx_waveform(packet):
+    """ Returns the waveform for a Tx packet (or a PacketTrace cursor on
+        one), compiling it if an identical packet has not been seen
+    """
+    key = waveform_key(packet)
+    try:
+        return _waveform_cache[key]
+    except KeyError:
+        pass
+
+    if len(_waveform_cache) >= MAX_CACHED_WAVEFORMS:
+        _waveform_cache.clear()
+
+    waveform = _compile(*key)
+    _waveform_cache[key] = waveform
+    return waveform
+
+def waveform_edges(waveform):
+    """ Number of falling edges a waveform lasts """
+    return waveform[-1][0] if waveform else 0
+
+def clear_waveform_cache():
+    _waveform_cache.clear()